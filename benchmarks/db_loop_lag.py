@@ -0,0 +1,125 @@
+# db_loop_lag.py
+"""Measures event loop lag while the database is under concurrent load.
+
+Runs the same workload twice: once with every query executed directly on the event loop (the old behaviour)
+and once with the queries running on the database thread. A probe task sleeps in short intervals and records how
+late it wakes up, which is the time the event loop was blocked.
+With --uvloop, both runs are repeated on uvloop (see USE_UVLOOP in resources/settings.py) for comparison.
+
+Usage: python benchmarks/db_loop_lag.py [--tasks 50] [--queries 200] [--stall-ms 0] [--uvloop]
+"""
+
+import argparse
+import asyncio
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+BOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BOT_DIR)
+
+from resources import settings
+
+TEMP_DIR = tempfile.mkdtemp(prefix='archmage-bench-')
+settings.DB_FILE = os.path.join(TEMP_DIR, 'archmage_db.db')
+shutil.copyfile(os.path.join(BOT_DIR, 'database/default_db.db'), settings.DB_FILE)
+
+import database
+
+
+PROBE_INTERVAL = 0.005
+
+
+async def run_inline(function, *args, **kwargs):
+    """Replacement for database.run_in_db_thread that blocks the event loop like the old implementation"""
+    return function(*args, **kwargs)
+
+
+async def probe(lags: list, stop: asyncio.Event) -> None:
+    """Records how much later than requested the event loop wakes this task up"""
+    while not stop.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(PROBE_INTERVAL)
+        lags.append(time.perf_counter() - start - PROBE_INTERVAL)
+
+
+async def worker(worker_id: int, queries: int, user_count: int) -> None:
+    """Mix of reads and writes similar to the enchant mute path"""
+    for query in range(queries):
+        user_id = (worker_id * queries + query) % user_count + 1
+        if query % 10 == 0:
+            await database.update_user(user_id, target_enchant=query % len(settings.ENCHANTS))
+        else:
+            await database.get_user(user_id)
+
+
+async def run(tasks: int, queries: int, user_count: int) -> dict:
+    """Runs the workload with a lag probe and returns throughput and lag percentiles"""
+    lags = []
+    stop = asyncio.Event()
+    probe_task = asyncio.create_task(probe(lags, stop))
+    start = time.perf_counter()
+    await asyncio.gather(*(worker(worker_id, queries, user_count) for worker_id in range(tasks)))
+    duration = time.perf_counter() - start
+    stop.set()
+    await probe_task
+    lags_ms = sorted(lag * 1000 for lag in lags) or [0.0]
+    return {
+        'duration': duration,
+        'queries_per_second': tasks * queries / duration,
+        'lag_p50': statistics.median(lags_ms),
+        'lag_p99': lags_ms[min(len(lags_ms) - 1, int(len(lags_ms) * 0.99))],
+        'lag_max': lags_ms[-1],
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--tasks', type=int, default=50, help='Concurrent workers')
+    parser.add_argument('--queries', type=int, default=200, help='Queries per worker')
+    parser.add_argument('--users', type=int, default=5_000, help='Users in the test database')
+    parser.add_argument('--stall-ms', type=float, default=0,
+                        help='Simulated disk stall in ms, added every 1000 SQLite VM instructions')
+    parser.add_argument('--uvloop', action='store_true', help='Also run everything on uvloop')
+    args = parser.parse_args()
+    loops = ['asyncio']
+    if args.uvloop:
+        import uvloop
+        loops.append('uvloop')
+
+    # The cache would hide the database work we want to measure
+    database.USER_CACHE.maxsize = 0
+    database.ARCHMAGE_DB.execute('BEGIN')
+    database.ARCHMAGE_DB.executemany(
+        'INSERT INTO settings_user (user_id, target_enchant) VALUES (?, ?)',
+        ((user_id, settings.ENCHANT_INDEX_NONE) for user_id in range(1, args.users + 1))
+    )
+    database.ARCHMAGE_DB.execute('COMMIT')
+    if args.stall_ms:
+        database.ARCHMAGE_DB.set_progress_handler(lambda: time.sleep(args.stall_ms / 1000) or 0, 1000)
+
+    results = {}
+    run_in_db_thread = database.run_in_db_thread
+    for loop in loops:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy() if loop == 'uvloop' else None)
+        database.run_in_db_thread = run_inline
+        results[('event loop', loop)] = asyncio.run(run(args.tasks, args.queries, args.users))
+        database.run_in_db_thread = run_in_db_thread
+        results[('db thread', loop)] = asyncio.run(run(args.tasks, args.queries, args.users))
+
+    print(f'{args.tasks} tasks x {args.queries} queries, {args.users:,} users, {args.stall_ms} ms stall')
+    print(f'{"mode":<12}{"loop":<9}{"queries/s":>12}{"lag p50 ms":>12}{"lag p99 ms":>12}{"lag max ms":>12}')
+    for (mode, loop), result in results.items():
+        print(
+            f'{mode:<12}{loop:<9}{result["queries_per_second"]:>12,.0f}{result["lag_p50"]:>12.2f}'
+            f'{result["lag_p99"]:>12.2f}{result["lag_max"]:>12.2f}'
+        )
+    database.ARCHMAGE_DB.close()
+    shutil.rmtree(TEMP_DIR, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+# db_profile.py
+"""Compares get_user and update_user with SQLite's default settings and with the tuned profile of database.py.
+
+default: a copy of default_db.db with rollback journal, synchronous=FULL and no migrations (the old behaviour)
+tuned: a copy of default_db.db after database.PRAGMAS and database.MIGRATIONS were applied
+
+Both databases are filled with the same users. get_user is measured with an empty USER_CACHE so every call reads
+from SQLite. update_user is measured with a flush after every call (one transaction per update, the worst case)
+and with flushes of USER_WRITE_BATCH_SIZE updates.
+
+Usage: python benchmarks/db_profile.py [--users 100000] [--operations 2000]
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import shutil
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+
+BOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BOT_DIR)
+
+from resources import settings
+
+TEMP_DIR = tempfile.mkdtemp(prefix='archmage-bench-')
+settings.DB_FILE = os.path.join(TEMP_DIR, 'archmage_db.db')
+shutil.copyfile(os.path.join(BOT_DIR, 'database/default_db.db'), settings.DB_FILE)
+
+import database
+
+
+def open_database(file_name: str, tuned: bool) -> sqlite3.Connection:
+    """Opens a fresh copy of default_db.db like database.py does and makes it the connection of database.py"""
+    shutil.copyfile(os.path.join(BOT_DIR, 'database/default_db.db'), file_name)
+    connection = sqlite3.connect(
+        file_name, isolation_level=None, check_same_thread=False, timeout=settings.DB_BUSY_TIMEOUT
+    )
+    database.ARCHMAGE_DB = connection
+    if tuned:
+        database.DB_EXECUTOR.submit(database._setup).result()
+    return connection
+
+
+def fill(user_count: int) -> None:
+    """Inserts user_count users in one transaction"""
+    updates = {
+        user_id: {'target_enchant': random.randrange(len(settings.ENCHANTS))}
+        for user_id in range(1, user_count + 1)
+    }
+    database.DB_EXECUTOR.submit(database._upsert_users, updates).result()
+
+
+def summarize(durations: list) -> str:
+    durations = sorted(durations)
+    total = sum(durations)
+    return (
+        f'{len(durations) / total:>10,.0f}{durations[len(durations) // 2] * 1e6:>10,.0f}'
+        f'{durations[int(len(durations) * 0.99)] * 1e6:>10,.0f}{statistics.mean(durations) * 1e6:>10,.0f}'
+    )
+
+
+async def run(user_count: int, operations: int) -> dict:
+    """Returns the durations of every get_user, single update and batched update"""
+    user_ids = [random.randint(1, user_count) for _ in range(operations)]
+    results = {'get_user': [], 'update_user (flush every call)': [], 'update_user (batched)': []}
+    for user_id in user_ids:
+        database.USER_CACHE.clear()
+        start = time.perf_counter()
+        await database.get_user(user_id)
+        results['get_user'].append(time.perf_counter() - start)
+    for user_id in user_ids:
+        start = time.perf_counter()
+        await database.update_user(user_id, target_enchant=random.randrange(len(settings.ENCHANTS)))
+        await database.flush_user_updates()
+        results['update_user (flush every call)'].append(time.perf_counter() - start)
+    for user_id in user_ids:
+        start = time.perf_counter()
+        await database.update_user(user_id, target_enchant=random.randrange(len(settings.ENCHANTS)))
+        results['update_user (batched)'].append(time.perf_counter() - start)
+    await database.flush_user_updates()
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=100_000, help='Users in the database')
+    parser.add_argument('--operations', type=int, default=2_000, help='Calls per operation')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    print(f'{args.users:,} users, {args.operations:,} calls per operation')
+    print(f'{"operation":<34}{"mode":<9}{"ops/s":>10}{"p50 µs":>10}{"p99 µs":>10}{"mean µs":>10}')
+    results = {}
+    for mode in ('default', 'tuned'):
+        random.seed(args.seed)
+        connection = open_database(os.path.join(TEMP_DIR, f'{mode}.db'), tuned=mode == 'tuned')
+        fill(args.users)
+        results[mode] = asyncio.run(run(args.users, args.operations))
+        database.DB_EXECUTOR.submit(connection.close).result()
+    for operation in results['default']:
+        for mode in ('default', 'tuned'):
+            print(f'{operation:<34}{mode:<9}{summarize(results[mode][operation])}')
+    database.DB_EXECUTOR.shutdown()
+    shutil.rmtree(TEMP_DIR, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,425 @@
+# load_test.py
+"""End-to-end load test of bot.py against a local mock of the Discord gateway and REST API.
+
+Starts an aiohttp server that acts as the gateway websocket and the REST API and runs the real bot.py against it
+(via DISCORD_API_URL and DB_FILE, see resources/settings.py) with a temporary database. Once the bot is ready,
+EPIC RPG enchant results are sent as MESSAGE_CREATE events at a fixed rate across the fake guilds. A share of them
+is sent again as MESSAGE_UPDATE, the way EPIC RPG edits its messages.
+Every member is registered with the lowest target enchant, so every enchant result has to end in a timeout.
+
+The REST API has rate limits per guild (timeouts) and per channel (messages and reactions), with rate limit headers
+and 429 responses like Discord, so pycord's rate limiter and the outbound scheduler are part of the test.
+
+Reports:
+- detection-to-timeout latency: from sending the MESSAGE_CREATE to receiving the timeout request
+- CPU and RSS of the bot process, read from /proc
+- REST requests and 429 responses
+
+Usage: python benchmarks/load_test.py [--guilds 50] [--members 500] [--rate 50] [--duration 30]
+Other settings, e.g. LOW_MEMORY_MODE or USER_STORE, are passed on to the bot from the environment.
+"""
+
+import argparse
+import asyncio
+from collections import defaultdict, deque
+from datetime import datetime, timezone
+import itertools
+import json
+import os
+import random
+import shutil
+import signal
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+
+from aiohttp import web, WSMsgType
+
+BOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BOT_DIR)
+
+from resources import settings
+
+
+CORPUS_FILE = os.path.join(BOT_DIR, 'benchmarks/corpus/epic_rpg_embeds.json')
+BOT_USER_ID = 900_000_000_000_000_001
+APPLICATION_ID = BOT_USER_ID
+OWNER_ID = 900_000_000_000_000_002
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK')
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+
+# View Channel, Send Messages, Add Reactions, Embed Links and Timeout Members
+BOT_PERMISSIONS = (1 << 10) | (1 << 11) | (1 << 6) | (1 << 14) | (1 << 40)
+
+snowflakes = itertools.count(1_000_000_000_000_000_000)
+
+
+def user_payload(user_id: int, name: str, bot: bool = False) -> dict:
+    return {'id': str(user_id), 'username': name, 'discriminator': '0', 'global_name': None, 'avatar': None,
+            'bot': bot}
+
+
+def member_payload(user: dict, roles: list = ()) -> dict:
+    return {'user': user, 'roles': list(roles), 'joined_at': '2022-01-01T00:00:00+00:00', 'deaf': False,
+            'mute': False, 'flags': 0}
+
+
+def now_iso() -> str:
+    return datetime.now(timezone.utc).isoformat()
+
+
+def json_response(payload, status: int = 200, headers: dict = None) -> web.Response:
+    """Returns a JSON response. pycord only decodes bodies with exactly this content type, without a charset."""
+    return web.Response(body=json.dumps(payload).encode(), status=status, headers=headers,
+                        content_type='application/json')
+
+
+class FakeGuild:
+    """A guild with one channel, the bot and member_count members"""
+    def __init__(self, guild_id: int, member_count: int):
+        self.id = guild_id
+        self.channel_id = next(snowflakes)
+        self.bot_role_id = next(snowflakes)
+        self.members = [
+            user_payload(guild_id * 100_000 + member_number, f'user{guild_id}_{member_number}')
+            for member_number in range(member_count)
+        ]
+
+    def payload(self) -> dict:
+        role = {'color': 0, 'hoist': False, 'managed': False, 'mentionable': False, 'icon': None,
+                'unicode_emoji': None, 'flags': 0}
+        return {
+            'id': str(self.id), 'name': f'Guild {self.id}', 'owner_id': str(OWNER_ID), 'icon': None,
+            'unavailable': False, 'large': len(self.members) > 250, 'member_count': len(self.members) + 1,
+            'features': [], 'emojis': [], 'stickers': [], 'threads': [], 'presences': [], 'voice_states': [],
+            'stage_instances': [], 'guild_scheduled_events': [], 'joined_at': '2022-01-01T00:00:00+00:00',
+            'roles': [
+                {**role, 'id': str(self.id), 'name': '@everyone', 'permissions': '0', 'position': 0},
+                {**role, 'id': str(self.bot_role_id), 'name': 'Archmage', 'permissions': str(BOT_PERMISSIONS),
+                 'position': 1},
+            ],
+            'channels': [
+                {'id': str(self.channel_id), 'type': 0, 'name': 'enchanting', 'position': 0,
+                 'permission_overwrites': [], 'nsfw': False, 'parent_id': None, 'topic': None}
+            ],
+            'members': [member_payload(user) for user in self.members] + [
+                member_payload(user_payload(BOT_USER_ID, 'Archmage', bot=True), [str(self.bot_role_id)])
+            ],
+        }
+
+
+class MockDiscord:
+    """Gateway and REST API stand-in. Records when enchants were sent and when their timeouts arrived."""
+    def __init__(self, guilds: list, bucket_limit: int, bucket_window: float, api_latency: float):
+        self.guilds = guilds
+        self.bucket_limit = bucket_limit
+        self.bucket_window = bucket_window
+        self.api_latency = api_latency
+        self.ready = asyncio.Event()
+        self.ws = None
+        self.sequence = 0
+        self.port = None
+        # (guild id, user id): send times of enchants that still wait for their timeout
+        self.pending_timeouts = defaultdict(deque)
+        self.timeout_latencies = []
+        self.requests = defaultdict(int)
+        self.rate_limited = 0
+        # bucket: (window start, requests in the window)
+        self.buckets = {}
+
+    # --- Gateway ---
+    async def dispatch(self, event: str, data: dict) -> None:
+        self.sequence += 1
+        await self.ws.send_str(json.dumps({'op': 0, 't': event, 's': self.sequence, 'd': data}))
+
+    async def gateway(self, request: web.Request) -> web.WebSocketResponse:
+        ws = web.WebSocketResponse(max_msg_size=0)
+        await ws.prepare(request)
+        self.ws = ws
+        await ws.send_str(json.dumps({'op': 10, 'd': {'heartbeat_interval': 41_250}}))
+        async for message in ws:
+            if message.type != WSMsgType.TEXT:
+                continue
+            payload = json.loads(message.data)
+            op = payload['op']
+            if op == 1:
+                await ws.send_str(json.dumps({'op': 11}))
+            elif op == 2:
+                await self.dispatch('READY', {
+                    'v': 10, 'user': user_payload(BOT_USER_ID, 'Archmage', bot=True), 'session_id': 'load-test',
+                    'resume_gateway_url': f'ws://127.0.0.1:{self.port}/gateway',
+                    'guilds': [{'id': str(guild.id), 'unavailable': True} for guild in self.guilds],
+                    'application': {'id': str(APPLICATION_ID), 'flags': 0},
+                })
+                for guild in self.guilds:
+                    await self.dispatch('GUILD_CREATE', guild.payload())
+            elif op == 3:
+                # The bot sets its presence in on_ready
+                self.ready.set()
+            elif op == 8:
+                await self.dispatch('GUILD_MEMBERS_CHUNK', {
+                    'guild_id': payload['d']['guild_id'], 'members': [], 'chunk_index': 0, 'chunk_count': 1,
+                    'nonce': payload['d'].get('nonce'),
+                })
+        return ws
+
+    async def send_enchant(self, guild: FakeGuild, template: dict, edit: bool, message: dict = None) -> dict:
+        """Sends an enchant result as MESSAGE_CREATE or, if edit is set, the given message as MESSAGE_UPDATE"""
+        if edit:
+            await self.dispatch('MESSAGE_UPDATE', {**message, 'edited_timestamp': now_iso()})
+            return message
+        user = random.choice(guild.members)
+        message_id = next(snowflakes)
+        author_action = template['author_name'].split(' — ', 1)[-1]
+        user_source = message_id % 3
+        if user_source == 1:
+            icon_url = f'https://cdn.discordapp.com/avatars/{user["id"]}/a_3f9c2e.png?size=1024'
+        else:
+            icon_url = f'https://cdn.discordapp.com/embed/avatars/{int(user["id"]) % 6}.png'
+        message = {
+            'id': str(message_id), 'channel_id': str(guild.channel_id), 'guild_id': str(guild.id),
+            'author': user_payload(settings.EPIC_RPG_ID, 'EPIC RPG', bot=True), 'content': '',
+            'timestamp': now_iso(), 'edited_timestamp': None, 'tts': False, 'mention_everyone': False,
+            'mentions': [], 'mention_roles': [], 'attachments': [], 'pinned': False, 'type': 0, 'components': [],
+            'embeds': [{
+                'type': 'rich',
+                'author': {'name': f'{user["username"]} — {author_action}', 'icon_url': icon_url},
+                'fields': [{'name': template['field_name'], 'value': template['field_value'], 'inline': False}],
+            }],
+        }
+        if user_source == 0:
+            message['interaction'] = {'id': str(next(snowflakes)), 'type': 2, 'name': 'enchant', 'user': user}
+        self.pending_timeouts[(guild.id, int(user['id']))].append(time.perf_counter())
+        await self.dispatch('MESSAGE_CREATE', message)
+        return message
+
+    # --- REST API ---
+    def check_rate_limit(self, bucket: tuple) -> tuple:
+        """Returns (allowed, remaining, seconds until the window resets) for a request in this bucket"""
+        now = time.monotonic()
+        window_start, count = self.buckets.get(bucket, (now, 0))
+        if now - window_start >= self.bucket_window:
+            window_start, count = now, 0
+        reset_after = self.bucket_window - (now - window_start)
+        if count >= self.bucket_limit:
+            return False, 0, reset_after
+        self.buckets[bucket] = (window_start, count + 1)
+        return True, self.bucket_limit - count - 1, reset_after
+
+    def limited_response(self, bucket: tuple, payload) -> web.Response:
+        allowed, remaining, reset_after = self.check_rate_limit(bucket)
+        headers = {
+            'X-RateLimit-Limit': str(self.bucket_limit), 'X-RateLimit-Remaining': str(remaining),
+            'X-RateLimit-Reset-After': f'{reset_after:.3f}', 'X-RateLimit-Bucket': ':'.join(map(str, bucket)),
+        }
+        if not allowed:
+            self.rate_limited += 1
+            return json_response(
+                {'message': 'You are being rate limited.', 'retry_after': reset_after, 'global': False},
+                status=429, headers=headers
+            )
+        if payload is None:
+            return web.Response(status=204, headers=headers)
+        return json_response(payload, headers=headers)
+
+    async def rest(self, request: web.Request) -> web.Response:
+        """Answers a REST request after api_latency seconds, like Discord would after the network round trip"""
+        response = await self.handle_rest(request)
+        if self.api_latency:
+            await asyncio.sleep(self.api_latency)
+        return response
+
+    async def handle_rest(self, request: web.Request) -> web.Response:
+        path = request.match_info['path']
+        parts = path.split('/')
+        method = request.method
+        if method == 'GET' and path in ('gateway', 'gateway/bot'):
+            self.requests['gateway'] += 1
+            return json_response({
+                'url': f'ws://127.0.0.1:{self.port}/gateway', 'shards': 1,
+                'session_start_limit': {'total': 1000, 'remaining': 1000, 'reset_after': 0, 'max_concurrency': 1},
+            })
+        if method == 'GET' and path == 'users/@me':
+            return json_response(user_payload(BOT_USER_ID, 'Archmage', bot=True))
+        if parts[0] == 'applications':
+            self.requests['commands'] += 1
+            if method == 'PUT':
+                commands = await request.json()
+                # applications/{application id}/guilds/{guild id}/commands for guild commands
+                guild_id = {'guild_id': parts[3]} if parts[2] == 'guilds' else {}
+                return json_response([
+                    {'type': 1, **command, **guild_id, 'id': str(next(snowflakes)),
+                     'application_id': str(APPLICATION_ID), 'version': '1'}
+                    for command in commands
+                ])
+            return json_response([])
+        if method == 'PATCH' and parts[0] == 'guilds' and parts[2] == 'members':
+            guild_id, user_id = int(parts[1]), int(parts[3])
+            self.requests['timeout'] += 1
+            response = self.limited_response(('timeout', guild_id), member_payload(
+                user_payload(user_id, f'user{user_id}'))
+            )
+            if response.status != 429:
+                sent_times = self.pending_timeouts.get((guild_id, user_id))
+                if sent_times:
+                    self.timeout_latencies.append(time.perf_counter() - sent_times.popleft())
+            return response
+        if method == 'POST' and parts[0] == 'channels' and parts[2] == 'messages':
+            self.requests['send'] += 1
+            body = await request.json()
+            return self.limited_response(('send', int(parts[1])), {
+                'id': str(next(snowflakes)), 'channel_id': parts[1], 'content': body.get('content', ''),
+                'author': user_payload(BOT_USER_ID, 'Archmage', bot=True), 'timestamp': now_iso(),
+                'edited_timestamp': None, 'tts': False, 'mention_everyone': False, 'mentions': [],
+                'mention_roles': [], 'attachments': [], 'embeds': [], 'pinned': False, 'type': 0,
+            })
+        if method == 'PUT' and parts[0] == 'channels' and 'reactions' in parts:
+            self.requests['reaction'] += 1
+            return self.limited_response(('reaction', int(parts[1])), None)
+        self.requests[f'other {method} {parts[0]}'] += 1
+        return json_response({})
+
+
+def read_process_stats(pid: int) -> tuple:
+    """Returns the CPU seconds and the RSS in bytes of a process"""
+    with open(f'/proc/{pid}/stat') as stat_file:
+        fields = stat_file.read().rsplit(')', 1)[1].split()
+    cpu_seconds = (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+    rss = int(fields[21]) * PAGE_SIZE
+    return cpu_seconds, rss
+
+
+def prepare_database(temp_dir: str, guilds: list) -> str:
+    """Creates a temporary database in which every member is registered with the lowest target enchant"""
+    db_file = os.path.join(temp_dir, 'archmage_db.db')
+    shutil.copyfile(os.path.join(BOT_DIR, 'database/default_db.db'), db_file)
+    connection = sqlite3.connect(db_file)
+    with connection:
+        connection.executemany(
+            'INSERT INTO settings_user (user_id, target_enchant) VALUES (?, 0)',
+            ((int(user['id']),) for guild in guilds for user in guild.members)
+        )
+    connection.close()
+    return db_file
+
+
+def percentile(values: list, share: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * share))] if values else float('nan')
+
+
+async def run(args: argparse.Namespace) -> None:
+    random.seed(args.seed)
+    with open(CORPUS_FILE, encoding='utf-8') as corpus_file:
+        templates = [template for template in json.load(corpus_file) if template['kind'] == 'enchant']
+    guilds = [FakeGuild(guild_number + 1, args.members) for guild_number in range(args.guilds)]
+    temp_dir = tempfile.mkdtemp(prefix='archmage-load-test-')
+    db_file = prepare_database(temp_dir, guilds)
+
+    mock = MockDiscord(guilds, args.bucket_limit, args.bucket_window, args.api_latency)
+    app = web.Application()
+    app.router.add_get('/gateway', mock.gateway)
+    app.router.add_route('*', '/api/v10/{path:.*}', mock.rest)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', args.port)
+    await site.start()
+    mock.port = site._server.sockets[0].getsockname()[1]
+
+    env = dict(
+        os.environ, DISCORD_TOKEN='load-test', DEBUG_MODE='OFF', SHARDING='OFF',
+        DISCORD_API_URL=f'http://127.0.0.1:{mock.port}/api/v10', DB_FILE=db_file,
+    )
+    start = time.perf_counter()
+    bot_process = subprocess.Popen([sys.executable, os.path.join(BOT_DIR, 'bot.py')], env=env, cwd=BOT_DIR,
+                                   stdout=subprocess.DEVNULL)
+    try:
+        await asyncio.wait_for(mock.ready.wait(), timeout=120)
+        startup_duration = time.perf_counter() - start
+        _, idle_rss = read_process_stats(bot_process.pid)
+
+        samples = []
+        sent = edits = 0
+        recent_messages = deque(maxlen=100)
+        load_start = time.perf_counter()
+        cpu_start, _ = read_process_stats(bot_process.pid)
+        next_sample = load_start + 1
+        sample_cpu = cpu_start
+        total_events = int(args.rate * args.duration)
+        for event_number in range(total_events):
+            delay = load_start + event_number / args.rate - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            if recent_messages and random.random() < args.edits:
+                guild, message = random.choice(recent_messages)
+                await mock.send_enchant(guild, None, edit=True, message=message)
+                edits += 1
+            else:
+                guild = random.choice(guilds)
+                message = await mock.send_enchant(guild, random.choice(templates), edit=False)
+                recent_messages.append((guild, message))
+                sent += 1
+            if time.perf_counter() >= next_sample:
+                cpu, rss = read_process_stats(bot_process.pid)
+                samples.append((cpu - sample_cpu, rss))
+                sample_cpu = cpu
+                next_sample += 1
+        load_duration = time.perf_counter() - load_start
+        drain_start = time.perf_counter()
+        while (len(mock.timeout_latencies) < sent
+               and time.perf_counter() - drain_start < args.drain_timeout):
+            await asyncio.sleep(0.1)
+        cpu_end, rss_end = read_process_stats(bot_process.pid)
+        busy_duration = time.perf_counter() - load_start
+    finally:
+        bot_process.send_signal(signal.SIGTERM)
+        try:
+            bot_process.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            bot_process.kill()
+        await runner.cleanup()
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+    latencies = mock.timeout_latencies
+    print(f'{args.guilds} guilds x {args.members:,} members, {args.rate:,} events/s for {args.duration} s, '
+          f'rate limit {args.bucket_limit} per {args.bucket_window} s per bucket, '
+          f'API latency {args.api_latency * 1000:,.0f} ms')
+    print(f'startup until ready: {startup_duration:,.1f} s, RSS when ready: {idle_rss / 1024 / 1024:,.1f} MiB')
+    print(f'sent: {sent:,} enchants + {edits:,} edits in {load_duration:,.1f} s, '
+          f'timeouts received: {len(latencies):,}')
+    print(
+        f'detection to timeout ms: p50 {percentile(latencies, 0.5) * 1000:,.1f}, '
+        f'p90 {percentile(latencies, 0.9) * 1000:,.1f}, p99 {percentile(latencies, 0.99) * 1000:,.1f}, '
+        f'max {max(latencies, default=float("nan")) * 1000:,.1f}'
+    )
+    peak_cpu = max((cpu for cpu, _ in samples), default=0)
+    print(
+        f'CPU: {(cpu_end - cpu_start) / busy_duration:.0%} mean, {peak_cpu:.0%} peak (1 s samples), '
+        f'RSS: {rss_end / 1024 / 1024:,.1f} MiB at the end, '
+        f'{max((rss for _, rss in samples), default=rss_end) / 1024 / 1024:,.1f} MiB peak'
+    )
+    print(f'REST requests: {dict(sorted(mock.requests.items()))}, 429 responses: {mock.rate_limited:,}')
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--guilds', type=int, default=50, help='Fake guilds, each with one channel')
+    parser.add_argument('--members', type=int, default=500, help='Members per fake guild')
+    parser.add_argument('--rate', type=float, default=50, help='Gateway events per second')
+    parser.add_argument('--duration', type=float, default=30, help='Seconds of load')
+    parser.add_argument('--edits', type=float, default=0.3, help='Share of events that are MESSAGE_UPDATEs')
+    parser.add_argument('--bucket-limit', type=int, default=5, help='Requests per rate limit bucket and window')
+    parser.add_argument('--bucket-window', type=float, default=5, help='Seconds per rate limit window')
+    parser.add_argument('--api-latency', type=float, default=0, help='Seconds the REST API takes per response')
+    parser.add_argument('--drain-timeout', type=float, default=60,
+                        help='Seconds to wait for outstanding timeouts after the load')
+    parser.add_argument('--port', type=int, default=0, help='Port of the mock server, 0 picks a free one')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    asyncio.run(run(args))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,120 @@
+# maintenance.py
+"""Measures database.run_maintenance() on a database with many old errors.
+
+Fills a temporary database with users and errors, most of them older than ERROR_RETENTION_DAYS, and runs the
+maintenance while a reader keeps looking up users like the enchant mute path does. Reports the database size before
+and after, the archive size and the latency of the user lookups with and without the maintenance running.
+
+Usage: python benchmarks/maintenance.py [--errors 200000] [--error-size 1000] [--users 100000]
+"""
+
+import argparse
+import asyncio
+from datetime import datetime, timedelta
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+BOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BOT_DIR)
+
+from resources import settings
+
+TEMP_DIR = tempfile.mkdtemp(prefix='archmage-bench-')
+settings.DB_FILE = os.path.join(TEMP_DIR, 'archmage_db.db')
+settings.ERROR_ARCHIVE_DIR = os.path.join(TEMP_DIR, 'archive')
+shutil.copyfile(os.path.join(BOT_DIR, 'database/default_db.db'), settings.DB_FILE)
+
+import database
+
+
+def fill(user_count: int, error_count: int, error_size: int) -> None:
+    """Inserts users and errors. Nine in ten errors are older than ERROR_RETENTION_DAYS."""
+    now = datetime.utcnow()
+    cur = database.ARCHMAGE_DB.cursor()
+    cur.execute('BEGIN')
+    cur.executemany(
+        'INSERT INTO settings_user (user_id, target_enchant) VALUES (?, ?)',
+        ((user_id, random.randrange(len(settings.ENCHANTS))) for user_id in range(1, user_count + 1))
+    )
+    cur.executemany(
+        'INSERT INTO errors (timestamp, user_input, error, user_settings) VALUES (?, ?, ?, ?)',
+        (
+            (now - timedelta(days=random.uniform(0, settings.ERROR_RETENTION_DAYS * 10)), 'N/A',
+             f'Error {error_number}: ' + 'x' * error_size, 'N/A')
+            for error_number in range(error_count)
+        )
+    )
+    cur.execute('COMMIT')
+    database.ARCHMAGE_DB.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+
+
+async def look_up_users(user_count: int, latencies: list, stop: asyncio.Event) -> None:
+    """Looks up random users until stop is set and records the latency of every lookup"""
+    while not stop.is_set():
+        start = time.perf_counter()
+        await database.get_user(random.randint(1, user_count))
+        latencies.append(time.perf_counter() - start)
+
+
+def format_latencies(latencies: list) -> str:
+    latencies = sorted(latencies)
+    p50 = latencies[len(latencies) // 2] * 1000
+    p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000
+    return f'{len(latencies):>9,}{p50:>10.2f}{p99:>10.2f}{latencies[-1] * 1000:>10.2f}'
+
+
+async def run(user_count: int) -> tuple:
+    """Returns the maintenance result, its duration and the lookup latencies without and with the maintenance"""
+    idle_latencies = []
+    stop = asyncio.Event()
+    reader = asyncio.create_task(look_up_users(user_count, idle_latencies, stop))
+    await asyncio.sleep(2)
+    stop.set()
+    await reader
+
+    maintenance_latencies = []
+    stop = asyncio.Event()
+    reader = asyncio.create_task(look_up_users(user_count, maintenance_latencies, stop))
+    start = time.perf_counter()
+    result = await database.run_maintenance()
+    duration = time.perf_counter() - start
+    stop.set()
+    await reader
+    return result, duration, idle_latencies, maintenance_latencies
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--errors', type=int, default=200_000, help='Errors in the database')
+    parser.add_argument('--error-size', type=int, default=1_000, help='Characters per error')
+    parser.add_argument('--users', type=int, default=100_000, help='Users in the database')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    # The cache would hide the database work the lookups compete with
+    database.USER_CACHE.maxsize = 0
+    database.DB_EXECUTOR.submit(fill, args.users, args.errors, args.error_size).result()
+    result, duration, idle_latencies, maintenance_latencies = asyncio.run(run(args.users))
+    (errors_left,) = database.ARCHMAGE_DB.execute('SELECT COUNT(*) FROM errors').fetchone()
+
+    print(f'{args.errors:,} errors of {args.error_size:,} characters, {args.users:,} users')
+    print(f'archived {result.archived_errors:,} errors in {duration:,.1f} s, {errors_left:,} left, '
+          f'archive {os.path.getsize(result.archive_file) / 1024 / 1024:,.1f} MiB')
+    print(f'database: {result.size_before.file_size / 1024 / 1024:,.1f} MiB before, '
+          f'{result.size_after.file_size / 1024 / 1024:,.1f} MiB after '
+          f'({result.size_after.free_size / 1024 / 1024:,.1f} MiB free pages left)')
+    print(f'{"get_user":<20}{"lookups":>9}{"p50 ms":>10}{"p99 ms":>10}{"max ms":>10}')
+    print(f'{"idle":<20}{format_latencies(idle_latencies)}')
+    print(f'{"during maintenance":<20}{format_latencies(maintenance_latencies)}')
+    database.ARCHMAGE_DB.close()
+    database.DB_EXECUTOR.shutdown()
+    shutil.rmtree(TEMP_DIR, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+# member_cache_memory.py
+"""Compares the memory used for members in the default mode and in LOW_MEMORY_MODE.
+
+Feeds synthetic GUILD_CREATE payloads with full member lists (what the bot holds after chunking) into a pycord
+ConnectionState configured like bot.py and measures the retained memory with tracemalloc. In the default mode,
+the member name index of resources/members.py is built for every guild as well.
+
+Usage: python benchmarks/member_cache_memory.py [--guilds 50] [--members 5000]
+"""
+
+import argparse
+import asyncio
+import gc
+import os
+import sys
+import tracemalloc
+
+BOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BOT_DIR)
+
+import discord
+from discord.state import ConnectionState
+
+from resources import members
+
+
+def guild_payload(guild_id: int, member_count: int) -> dict:
+    """Returns a minimal GUILD_CREATE payload with member_count members"""
+    return {
+        'id': str(guild_id),
+        'name': f'Guild {guild_id}',
+        'roles': [],
+        'channels': [],
+        'member_count': member_count,
+        'large': member_count > 250,
+        'members': [
+            {
+                'user': {
+                    'id': str(guild_id * 10_000_000 + member_number),
+                    'username': f'user{guild_id}_{member_number}',
+                    'discriminator': '0',
+                    'avatar': None,
+                },
+                'roles': [],
+                'joined_at': '2022-01-01T00:00:00+00:00',
+            }
+            for member_number in range(member_count)
+        ],
+    }
+
+
+def measure(member_cache_flags: discord.MemberCacheFlags, payloads: list, build_name_index: bool) -> tuple:
+    """Returns the retained memory in bytes, the amount of cached members and the amount of cached users"""
+    intents = discord.Intents.none()
+    intents.guilds = intents.messages = intents.members = intents.message_content = True
+    loop = asyncio.new_event_loop()
+    state = ConnectionState(
+        dispatch=lambda *args, **kwargs: None, handlers={}, hooks={}, http=None, loop=loop,
+        intents=intents, member_cache_flags=member_cache_flags, chunk_guilds_at_startup=False,
+    )
+    members.MEMBER_NAME_INDEX.clear()
+    gc.collect()
+    tracemalloc.start()
+    for payload in payloads:
+        guild = state._add_guild_from_data(payload)
+        if build_name_index:
+            members.get_member_from_name_index(guild, '')
+    gc.collect()
+    memory, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    member_count = sum(len(guild.members) for guild in state.guilds)
+    user_count = len(state._users)
+    loop.close()
+    return memory, member_count, user_count
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--guilds', type=int, default=50, help='Synthetic guilds')
+    parser.add_argument('--members', type=int, default=5_000, help='Members per guild')
+    args = parser.parse_args()
+
+    intents = discord.Intents.none()
+    intents.guilds = intents.messages = intents.members = intents.message_content = True
+    payloads = [guild_payload(guild_id, args.members) for guild_id in range(1, args.guilds + 1)]
+    results = {
+        'default': measure(discord.MemberCacheFlags.from_intents(intents), payloads, build_name_index=True),
+        'low memory': measure(discord.MemberCacheFlags.none(), payloads, build_name_index=False),
+    }
+    print(f'{args.guilds} guilds x {args.members:,} members')
+    print(f'{"mode":<12}{"memory MiB":>12}{"members":>12}{"users":>12}{"bytes/member":>14}')
+    for mode, (memory, member_count, user_count) in results.items():
+        print(
+            f'{mode:<12}{memory / 1024 / 1024:>12,.1f}{member_count:>12,}{user_count:>12,}'
+            f'{memory / (args.guilds * args.members):>14,.0f}'
+        )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+# parser.py
+"""Microbenchmark for the enchant embed parser.
+
+Runs every embed of corpus/epic_rpg_embeds.json through the parser that used to live in
+EnchantMuteCog.on_message and through resources.parsers and prints the time per embed.
+
+Usage: python benchmarks/parser.py [--rounds 2000]
+"""
+
+import argparse
+import json
+import os
+import re
+import sys
+import timeit
+
+BOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BOT_DIR)
+
+from resources import parsers, settings
+
+
+CORPUS_FILE = os.path.join(BOT_DIR, 'benchmarks/corpus/epic_rpg_embeds.json')
+
+
+def parse_legacy(author_name: str, icon_url: str, field_name: str):
+    """The parsing steps of the old on_message implementation, without the Discord calls in between"""
+    message_author = author_name.encode('unicode-escape',errors='ignore').decode('ASCII').replace('\\','')
+    enchant_actions = ['enchant', 'refine', 'transmute', 'transcend']
+    enchants_lower = [enchant.lower() for enchant in settings.ENCHANTS]
+    if (
+        any(action in message_author.lower() for action in enchant_actions)
+        and
+        any(enchant in field_name.lower() for enchant in enchants_lower)
+    ):
+        user_id = user_name = None
+        try:
+            user_id = int(re.search(r"avatars\/(.+?)\/", icon_url).group(1))
+        except:
+            for pattern in ["^(.+?) u2014",]:
+                match = re.search(pattern, message_author, re.IGNORECASE)
+                if match is not None: break
+            user_name = match.group(1)
+        try:
+            enchant = re.search(r"~-~> \*\*(.+?)\*\* <~-~", field_name).group(1)
+        except:
+            return None
+        return (enchant, enchants_lower.index(enchant.lower()), user_id, user_name)
+    return None
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rounds', type=int, default=2_000, help='Passes over the corpus')
+    args = parser.parse_args()
+
+    with open(CORPUS_FILE, encoding='utf-8') as corpus_file:
+        corpus = [
+            (embed['author_name'], embed['icon_url'], embed['field_name'])
+            for embed in json.load(corpus_file)
+        ]
+    enchant_count = sum(parsers.parse_enchant(*embed) is not None for embed in corpus)
+    for embed in corpus:
+        legacy_result, result = parse_legacy(*embed), parsers.parse_enchant(*embed)
+        if (legacy_result is None) != (result is None) or (result is not None and result[:3] != legacy_result[:3]):
+            print(f'Parsers disagree on {embed}: {legacy_result} != {result}')
+
+    print(f'{len(corpus)} embeds ({enchant_count} enchant results), {args.rounds:,} rounds')
+    for name, function in (('legacy', parse_legacy), ('parsers', parsers.parse_enchant)):
+        duration = timeit.timeit(lambda: [function(*embed) for embed in corpus], number=args.rounds)
+        print(f'{name:<10}{duration / (args.rounds * len(corpus)) * 1_000_000:>8.2f} µs per embed')
+
+
+if __name__ == '__main__':
+    main()
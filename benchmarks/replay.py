@@ -0,0 +1,305 @@
+# replay.py
+"""Replays EPIC RPG embeds through EnchantMuteCog without a Discord connection.
+
+Builds stub guilds, members and messages around the embeds of a corpus file, runs them through
+EnchantMuteCog.on_message (and on_message_edit for a share of them) on a temporary copy of the database and
+reports the throughput and the p50/p99 latency of every stage.
+
+Stages:
+parse: resources.parsers.parse_enchant_embed
+resolve: user lookup (interaction, member cache / API, name index)
+database: database.get_user and database.update_user
+api: timeout_for, channel.send and add_reaction
+
+Usage: python benchmarks/replay.py [--messages 20000] [--guilds 50] [--members 2000] [--api-latency-ms 0]
+"""
+
+import argparse
+import asyncio
+from collections import defaultdict
+import json
+import os
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+
+BOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BOT_DIR)
+
+from resources import settings
+
+TEMP_DIR = tempfile.mkdtemp(prefix='archmage-replay-')
+settings.DB_FILE = os.path.join(TEMP_DIR, 'archmage_db.db')
+shutil.copyfile(os.path.join(BOT_DIR, 'database/default_db.db'), settings.DB_FILE)
+
+import discord
+
+import database
+from cogs import enchant_mute
+from resources import functions, members, parsers
+
+
+CORPUS_FILE = os.path.join(BOT_DIR, 'benchmarks/corpus/epic_rpg_embeds.json')
+
+# Durations of the current message per stage, moved to STAGE_TIMINGS after every message
+current_timings = defaultdict(float)
+active_stages = set()
+STAGE_TIMINGS = defaultdict(list)
+
+
+def timed(stage: str, function):
+    """Wraps a function or coroutine function so its duration is added to the given stage.
+    Calls nested in another call of the same stage are not counted twice.
+    """
+    if asyncio.iscoroutinefunction(function):
+        async def wrapper(*args, **kwargs):
+            if stage in active_stages:
+                return await function(*args, **kwargs)
+            active_stages.add(stage)
+            start = time.perf_counter()
+            try:
+                return await function(*args, **kwargs)
+            finally:
+                current_timings[stage] += time.perf_counter() - start
+                active_stages.discard(stage)
+    else:
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                current_timings[stage] += time.perf_counter() - start
+    return wrapper
+
+
+# --- Stubs ---
+class StubMember:
+    """Stands in for discord.Member"""
+    def __init__(self, guild: 'StubGuild', user_id: int, name: str, api_latency: float):
+        self.guild = guild
+        self.id = user_id
+        self.name = name
+        self.mention = f'<@{user_id}>'
+        self.api_latency = api_latency
+        self.timeouts = 0
+
+    async def timeout_for(self, duration, *, reason=None) -> None:
+        await asyncio.sleep(self.api_latency)
+        self.timeouts += 1
+
+
+class StubGuild:
+    """Stands in for discord.Guild. Only a share of the members is in the gateway cache."""
+    def __init__(self, guild_id: int, member_count: int, cached_share: float, api_latency: float):
+        self.id = guild_id
+        self.api_latency = api_latency
+        self.me = None # The bot member isn't stubbed, so resources.permissions lets every timeout through
+        self.all_members = {}
+        for member_number in range(member_count):
+            user_id = guild_id * 1_000_000 + member_number
+            self.all_members[user_id] = StubMember(self, user_id, f'user{user_id}', api_latency)
+        self._members = {
+            user_id: member for user_id, member in self.all_members.items() if random.random() < cached_share
+        }
+        self.api_calls = 0
+
+    @property
+    def members(self):
+        return list(self._members.values())
+
+    def get_member(self, user_id: int):
+        return self._members.get(user_id)
+
+    async def fetch_member(self, user_id: int):
+        await asyncio.sleep(self.api_latency)
+        self.api_calls += 1
+        member = self.all_members.get(user_id)
+        if member is None:
+            raise discord.NotFound(SimpleNamespace(status=404, reason='Not Found'), 'Unknown Member')
+        return member
+
+
+class StubChannel:
+    """Stands in for discord.TextChannel"""
+    def __init__(self, channel_id: int, api_latency: float):
+        self.id = channel_id
+        self.api_latency = api_latency
+        self.sent = 0
+
+    async def send(self, content=None, **kwargs):
+        await asyncio.sleep(self.api_latency)
+        self.sent += 1
+
+    async def fetch_message(self, message_id: int):
+        await asyncio.sleep(self.api_latency)
+        raise discord.NotFound(SimpleNamespace(status=404, reason='Not Found'), 'Unknown Message')
+
+
+class StubMessage:
+    """Stands in for discord.Message"""
+    def __init__(self, message_id: int, guild: StubGuild, channel: StubChannel, embed: discord.Embed,
+                 interaction_user=None):
+        self.id = message_id
+        self.author = SimpleNamespace(id=settings.EPIC_RPG_ID)
+        self.guild = guild
+        self.channel = channel
+        self.embeds = [embed]
+        self.components = []
+        self.reference = None
+        self.interaction = SimpleNamespace(user=interaction_user) if interaction_user is not None else None
+        self.reactions = 0
+
+    @property
+    def jump_url(self) -> str:
+        return f'https://discord.com/channels/{self.guild.id}/{self.channel.id}/{self.id}'
+
+    async def add_reaction(self, emoji) -> None:
+        await asyncio.sleep(self.channel.api_latency)
+        self.reactions += 1
+
+
+def build_messages(corpus: list, guilds: list, channels: dict, count: int, duplicate_share: float) -> list:
+    """Builds stub messages from random corpus embeds and random members.
+    A third of them is a slash command response, a third has the user id in the avatar and a third has to be
+    resolved by name. A share of the messages is repeated right after the original, the same way EPIC RPG sends
+    several edits of the same embed.
+    """
+    messages = []
+    for message_number in range(count):
+        template = random.choice(corpus)
+        guild = random.choice(guilds)
+        member = random.choice(list(guild.all_members.values()))
+        author_action = template['author_name'].split(' — ', 1)[-1]
+        user_source = message_number % 3
+        if user_source == 1:
+            icon_url = f'https://cdn.discordapp.com/avatars/{member.id}/a_3f9c2e.png?size=1024'
+        else:
+            icon_url = f'https://cdn.discordapp.com/embed/avatars/{member.id % 6}.png'
+        embed = discord.Embed()
+        embed.set_author(name=f'{member.name} — {author_action}', icon_url=icon_url)
+        embed.add_field(name=template['field_name'], value=template['field_value'])
+        message = StubMessage(message_number + 1, guild, channels[guild.id], embed,
+                              interaction_user=member if user_source == 0 else None)
+        messages.append(message)
+        if random.random() < duplicate_share:
+            messages.append(message)
+    return messages
+
+
+def register_users(guilds: list, share: float) -> None:
+    """Registers a share of all members in the database with a random target enchant"""
+    records = [
+        (user_id, random.randrange(len(settings.ENCHANTS)))
+        for guild in guilds for user_id in guild.all_members if random.random() < share
+    ]
+    database.ARCHMAGE_DB.execute('BEGIN')
+    database.ARCHMAGE_DB.executemany('INSERT INTO settings_user (user_id, target_enchant) VALUES (?, ?)', records)
+    database.ARCHMAGE_DB.execute('COMMIT')
+
+
+def patch_stages() -> None:
+    """Wraps the functions of every stage so their durations are recorded"""
+    parsers.parse_enchant_embed = timed('parse', parsers.parse_enchant_embed)
+    functions.get_interaction_member = timed('resolve', functions.get_interaction_member)
+    members.get_member = timed('resolve', members.get_member)
+    members.get_member_by_name = timed('resolve', members.get_member_by_name)
+    database.get_user = timed('database', database.get_user)
+    database.update_user = timed('database', database.update_user)
+    StubMember.timeout_for = timed('api', StubMember.timeout_for)
+    StubChannel.send = timed('api', StubChannel.send)
+    StubMessage.add_reaction = timed('api', StubMessage.add_reaction)
+
+
+def percentile(values: list, share: float) -> float:
+    """Returns the value at the given share of the sorted values"""
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * share))]
+
+
+async def replay(cog: enchant_mute.EnchantMuteCog, messages: list, edit_share: float) -> tuple:
+    """Runs all messages through the cog and returns the duration and the amount of errors"""
+    errors = 0
+    start = time.perf_counter()
+    for message in messages:
+        message_start = time.perf_counter()
+        try:
+            if random.random() < edit_share:
+                await cog.on_message_edit(message, message)
+            else:
+                await cog.on_message(message)
+        except Exception:
+            errors += 1
+        current_timings['total'] = time.perf_counter() - message_start
+        for stage, duration in current_timings.items():
+            STAGE_TIMINGS[stage].append(duration)
+        current_timings.clear()
+    duration = time.perf_counter() - start
+    await database.flush_user_updates()
+    return duration, errors
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--corpus', default=CORPUS_FILE, help='JSON file with embeds, see the default corpus')
+    parser.add_argument('--messages', type=int, default=20_000, help='Messages to replay')
+    parser.add_argument('--guilds', type=int, default=50, help='Fake guilds')
+    parser.add_argument('--members', type=int, default=2_000, help='Members per fake guild')
+    parser.add_argument('--cached-members', type=float, default=0.9,
+                        help='Share of members that is in the gateway member cache')
+    parser.add_argument('--registered', type=float, default=0.8, help='Share of members that is in the database')
+    parser.add_argument('--edits', type=float, default=0.3, help='Share of messages replayed as edits')
+    parser.add_argument('--duplicates', type=float, default=0.2, help='Share of messages that is sent twice')
+    parser.add_argument('--api-latency-ms', type=float, default=0, help='Simulated latency of every API call')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    api_latency = args.api_latency_ms / 1000
+    with open(args.corpus, encoding='utf-8') as corpus_file:
+        corpus = json.load(corpus_file)
+    guilds = [
+        StubGuild(guild_number + 1, args.members, args.cached_members, api_latency)
+        for guild_number in range(args.guilds)
+    ]
+    channels = {guild.id: StubChannel(guild.id, api_latency) for guild in guilds}
+    register_users(guilds, args.registered)
+    messages = build_messages(corpus, guilds, channels, args.messages, args.duplicates)
+    patch_stages()
+    cog = enchant_mute.EnchantMuteCog(bot=None)
+
+    duration, errors = asyncio.run(replay(cog, messages, args.edits))
+
+    print(
+        f'{len(messages):,} messages ({len(messages) - args.messages:,} duplicates), '
+        f'{args.guilds} guilds x {args.members:,} members, '
+        f'{args.api_latency_ms} ms API latency'
+    )
+    print(
+        f'{len(messages) / duration:,.0f} messages/s, {errors:,} errors, '
+        f'{enchant_mute.SEEN_ENCHANTS.hits:,} duplicates dropped'
+    )
+    print(
+        f'timeouts: {sum(member.timeouts for guild in guilds for member in guild.all_members.values()):,}, '
+        f'messages sent: {sum(channel.sent for channel in channels.values()):,}, '
+        f'reactions: {sum(message.reactions for message in set(messages)):,}, '
+        f'fetch_member calls: {sum(guild.api_calls for guild in guilds):,}'
+    )
+    print(f'{"stage":<10}{"messages":>10}{"p50 µs":>12}{"p99 µs":>12}{"mean µs":>12}')
+    for stage in ('parse', 'resolve', 'database', 'api', 'total'):
+        timings = STAGE_TIMINGS.get(stage)
+        if not timings:
+            continue
+        print(
+            f'{stage:<10}{len(timings):>10,}{percentile(timings, 0.5) * 1e6:>12.1f}'
+            f'{percentile(timings, 0.99) * 1e6:>12.1f}{statistics.mean(timings) * 1e6:>12.1f}'
+        )
+    asyncio.run(database.close())
+    shutil.rmtree(TEMP_DIR, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,118 @@
+# user_store.py
+"""Measures the memory and load times of resources/user_store.py.
+
+Fills a temporary database with synthetic users and compares:
+- the memory of the store with a dict of database.User tuples (what an unbounded USER_CACHE would hold)
+- reading the store from the database with loading it from a snapshot
+- lookups in a store read from the database and in a memory-mapped snapshot
+
+Usage: python benchmarks/user_store.py [--users 1000000] [--lookups 200000]
+"""
+
+import argparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+BOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BOT_DIR)
+
+from resources import settings
+
+TEMP_DIR = tempfile.mkdtemp(prefix='archmage-bench-')
+settings.DB_FILE = os.path.join(TEMP_DIR, 'archmage_db.db')
+settings.USER_STORE_FILE = os.path.join(TEMP_DIR, 'user_store.bin')
+settings.USER_STORE = 'OFF'
+shutil.copyfile(os.path.join(BOT_DIR, 'database/default_db.db'), settings.DB_FILE)
+
+import database
+from resources import user_store
+
+
+def run_in_db_thread(function, *args):
+    return database.DB_EXECUTOR.submit(function, *args).result()
+
+
+def fill(user_count: int) -> list:
+    """Inserts user_count users with random snowflake-like ids and returns the ids"""
+    user_ids = random.sample(range(100_000_000_000_000_000, 1_200_000_000_000_000_000), user_count)
+    def insert() -> None:
+        database.ARCHMAGE_DB.execute('BEGIN')
+        database.ARCHMAGE_DB.executemany(
+            'INSERT INTO settings_user (user_id, target_enchant) VALUES (?, ?)',
+            ((user_id, random.randrange(len(settings.ENCHANTS))) for user_id in user_ids)
+        )
+        database.ARCHMAGE_DB.execute('COMMIT')
+    run_in_db_thread(insert)
+    return user_ids
+
+
+def measure_memory(function) -> tuple:
+    """Returns the result of function and the memory it allocated that is still in use"""
+    tracemalloc.start()
+    result = function()
+    memory, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, memory
+
+
+def time_lookups(store: user_store.UserStore, user_ids: list) -> float:
+    """Returns the mean duration of store.get in seconds"""
+    start = time.perf_counter()
+    for user_id in user_ids:
+        store.get(user_id)
+    return (time.perf_counter() - start) / len(user_ids)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=1_000_000, help='Users in the database')
+    parser.add_argument('--lookups', type=int, default=200_000, help='Lookups per store')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    user_ids = fill(args.users)
+    lookup_ids = [random.choice(user_ids) if random.random() < 0.9 else random.getrandbits(60)
+                  for _ in range(args.lookups)]
+    per_million = 1_000_000 / args.users
+
+    def read_users_dict() -> dict:
+        cur = database.ARCHMAGE_DB.execute('SELECT user_id, target_enchant FROM settings_user')
+        return {user_id: database.User(user_id, target_enchant) for user_id, target_enchant in cur}
+    users_dict, dict_memory = measure_memory(lambda: run_in_db_thread(read_users_dict))
+    del users_dict
+
+    start = time.perf_counter()
+    store, store_memory = measure_memory(lambda: run_in_db_thread(database._read_user_store))
+    read_duration = time.perf_counter() - start
+
+    run_in_db_thread(database.ARCHMAGE_DB.close)
+    database_stat = database.get_database_stat()
+    start = time.perf_counter()
+    store.save(settings.USER_STORE_FILE, database_stat)
+    save_duration = time.perf_counter() - start
+    start = time.perf_counter()
+    snapshot_store = user_store.UserStore.load(settings.USER_STORE_FILE, database_stat)
+    load_duration = time.perf_counter() - start
+    assert snapshot_store is not None and len(snapshot_store) == args.users
+
+    print(f'{args.users:,} users')
+    print(f'memory per million users: store {store_memory * per_million / 1024 / 1024:,.1f} MiB, '
+          f'dict of User {dict_memory * per_million / 1024 / 1024:,.1f} MiB')
+    print(f'snapshot file: {os.path.getsize(settings.USER_STORE_FILE) / 1024 / 1024:,.1f} MiB, '
+          f'saved in {save_duration * 1000:,.1f} ms')
+    print(f'startup: read from database {read_duration * 1000:,.1f} ms, '
+          f'load snapshot {load_duration * 1000:,.3f} ms')
+    print(f'lookup: array {time_lookups(store, lookup_ids) * 1e6:,.2f} µs, '
+          f'memory-mapped snapshot {time_lookups(snapshot_store, lookup_ids) * 1e6:,.2f} µs')
+    database.DB_EXECUTOR.shutdown()
+    shutil.rmtree(TEMP_DIR, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+# warm_restart.py
+"""Compares the first enchants after a cold start with the first enchants after a restart with warm state.
+
+Uses the stubs of replay.py. Both runs handle the same batch of messages with empty caches, the warm run restores
+the warm state saved after an earlier batch from the same members first (like /dev restart does).
+Reports when the first enchant was handled and the latency of the first messages.
+Reconnecting to the gateway and chunking are not part of this, they take the same time in both cases.
+
+Usage: python benchmarks/warm_restart.py [--messages 500] [--members 20000] [--api-latency-ms 0]
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import shutil
+import statistics
+import time
+
+import replay
+from replay import database, enchant_mute, members
+
+from resources import caches, warm_state
+
+
+WARM_STATE_FILE = os.path.join(replay.TEMP_DIR, 'warm_state.pickle')
+# Matching database stat passed to save and restore, the database is still open during the benchmark
+DATABASE_STAT = (0, 0)
+
+
+def reset() -> None:
+    """Empties all caches like a fresh process"""
+    for cache in caches.CACHES.values():
+        cache.clear()
+    members.MEMBER_NAME_INDEX.clear()
+    members._restored_guilds.clear()
+
+
+async def run(cog: enchant_mute.EnchantMuteCog, messages: list) -> tuple:
+    """Returns the seconds until the first enchant was handled and the latency of every message"""
+    first_enchant = None
+    latencies = []
+    start = time.perf_counter()
+    for message in messages:
+        message_start = time.perf_counter()
+        await cog.on_message(message)
+        latencies.append(time.perf_counter() - message_start)
+        if first_enchant is None and enchant_mute.SEEN_ENCHANTS.get((
+            message.id, message.embeds[0].author.name, message.embeds[0].fields[0].name
+        ), count=False) is not None:
+            first_enchant = time.perf_counter() - start
+    await database.flush_user_updates()
+    return first_enchant, latencies
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--messages', type=int, default=500, help='Messages per batch')
+    parser.add_argument('--guilds', type=int, default=5, help='Fake guilds')
+    parser.add_argument('--members', type=int, default=20_000, help='Members per fake guild')
+    parser.add_argument('--api-latency-ms', type=float, default=0, help='Simulated latency of every API call')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    api_latency = args.api_latency_ms / 1000
+    with open(replay.CORPUS_FILE, encoding='utf-8') as corpus_file:
+        corpus = json.load(corpus_file)
+    guilds = [replay.StubGuild(guild_number + 1, args.members, 1.0, api_latency) for guild_number in range(args.guilds)]
+    channels = {guild.id: replay.StubChannel(guild.id, api_latency) for guild in guilds}
+    replay.register_users(guilds, 1.0)
+    earlier_batch = replay.build_messages(corpus, guilds, channels, args.messages, 0)
+    batch = replay.build_messages(corpus, guilds, channels, args.messages, 0)
+    for message in batch:
+        message.id += args.messages
+    cog = enchant_mute.EnchantMuteCog(bot=None)
+
+    async def measure() -> dict:
+        results = {}
+        reset()
+        results['cold'] = await run(cog, batch)
+        reset()
+        await run(cog, earlier_batch)
+        warm_state.save(WARM_STATE_FILE, DATABASE_STAT)
+        reset()
+        restore_start = time.perf_counter()
+        warm_state.restore(WARM_STATE_FILE, DATABASE_STAT)
+        print(f'Warm state restored in {(time.perf_counter() - restore_start) * 1000:,.1f} ms')
+        results['warm'] = await run(cog, batch)
+        return results
+    results = asyncio.run(measure())
+
+    print(f'{args.messages:,} messages, {args.guilds} guilds x {args.members:,} members, '
+          f'{args.api_latency_ms} ms API latency')
+    print(f'{"start":<6}{"first enchant ms":>18}{"first 50 mean ms":>18}{"all mean ms":>14}')
+    for mode, (first_enchant, latencies) in results.items():
+        print(f'{mode:<6}{first_enchant * 1000:>18,.1f}{statistics.mean(latencies[:50]) * 1000:>18,.2f}'
+              f'{statistics.mean(latencies) * 1000:>14,.2f}')
+    asyncio.run(database.close())
+    shutil.rmtree(replay.TEMP_DIR, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
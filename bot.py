@@ -1,25 +1,92 @@
 # bot.py
 
+import asyncio
+import os
+import sqlite3
+import sys
+
 import discord
 
 from discord.ext import commands
 
-from resources import settings
+import database
+from resources import logs, loop_monitor, settings, stats, warm_state
 
 
 intents = discord.Intents.none()
 intents.guilds = True       # For on_guild_join() and all guild objects
 intents.messages = True
-intents.members = True      # To get the user object from the user name
+intents.members = True      # To get the user object from the user name and to query members in LOW_MEMORY_MODE
 intents.message_content = True # For detecting enchants
 
 
+class ArchmageBotMixin:
+    """Monitors the event loop and, if other processes share the database, checks for their changes while
+    running. Writes all queued database changes, stats and the warm state before shutting down.
+    """
+    # Set by /dev restart, the process replaces itself after the bot is closed
+    restart_requested = False
+
+    async def start(self, *args, **kwargs) -> None:
+        loop_monitor.start()
+        database.start()
+        await super().start(*args, **kwargs)
+
+    async def close(self) -> None:
+        if self.is_closed():
+            return
+        loop_monitor.stop()
+        await super().close()
+        try:
+            await stats.flush()
+        except sqlite3.Error:
+            pass
+        await database.close()
+        try:
+            warm_state.save(settings.WARM_STATE_FILE, database.get_database_stat())
+        except OSError as error:
+            logs.logger.error(f'Error saving the warm state: {error}')
+
+
+class ArchmageBot(ArchmageBotMixin, commands.Bot):
+    """Bot with a single gateway connection"""
+
+
+class ArchmageShardedBot(ArchmageBotMixin, commands.AutoShardedBot):
+    """Bot with one gateway connection per shard. Runs SHARD_IDS only if set (see launcher.py)."""
+
+
+if settings.DISCORD_API_URL is not None:
+    discord.http.Route.base = property(lambda route: settings.DISCORD_API_URL)
+
+# The bot runs on the current event loop when it is created, so uvloop has to be set before that
+if settings.USE_UVLOOP == 'ON':
+    try:
+        import uvloop
+    except ImportError:
+        logs.logger.warning('USE_UVLOOP is ON, but uvloop is not installed. Using the asyncio event loop.')
+    else:
+        asyncio.set_event_loop(uvloop.new_event_loop())
+
+bot_options = {}
+if settings.SHARDING == 'ON':
+    bot_class = ArchmageShardedBot
+    if settings.SHARD_COUNT is not None:
+        bot_options['shard_count'] = settings.SHARD_COUNT
+    if settings.SHARD_IDS is not None:
+        bot_options['shard_ids'] = settings.SHARD_IDS
+else:
+    bot_class = ArchmageBot
+if settings.LOW_MEMORY_MODE == 'ON':
+    bot_options['member_cache_flags'] = discord.MemberCacheFlags.none()
+    bot_options['chunk_guilds_at_startup'] = False
+
 if settings.DEBUG_MODE == 'ON': # Make sure you have debug mode set to ON when debugging
-    bot = commands.Bot(help_command=None, case_insensitive=True, intents=intents,
-                       debug_guilds=settings.DEV_GUILDS, owner_id=settings.OWNER_ID)
+    bot = bot_class(help_command=None, case_insensitive=True, intents=intents,
+                    debug_guilds=settings.DEV_GUILDS, owner_id=settings.OWNER_ID, **bot_options)
 else:
-    bot = commands.Bot(help_command=None, case_insensitive=True, intents=intents,
-                       owner_id=settings.OWNER_ID)
+    bot = bot_class(help_command=None, case_insensitive=True, intents=intents,
+                    owner_id=settings.OWNER_ID, **bot_options)
 
 EXTENSIONS = [
     'cogs.main',
@@ -31,6 +98,11 @@ EXTENSIONS = [
 if __name__ == '__main__':
     for extension in EXTENSIONS:
         bot.load_extension(extension)
+    warm_state.restore(settings.WARM_STATE_FILE, database.get_database_stat())
+
 
+bot.run(settings.TOKEN)
 
-bot.run(settings.TOKEN)
\ No newline at end of file
+if bot.restart_requested:
+    logs.listener.stop()
+    os.execv(sys.executable, [sys.executable, *sys.argv])
\ No newline at end of file
@@ -1,20 +1,40 @@
 # dev.py
 """Contains internal dev commands"""
 
+import asyncio
+import cProfile
 import importlib
+import io
+import pstats
+import sqlite3
 import sys
+import time
+import tracemalloc
+from typing import Optional
 
 import discord
 from discord.commands import SlashCommandGroup, Option
-from discord.ext import commands
+from discord.ext import commands, tasks
 
-from resources import settings, views
+import database
+from resources import caches, logs, members, metrics, settings, views
 
 
 class DevCog(commands.Cog):
     """Cog with internal dev commands"""
     def __init__(self, bot: commands.Bot):
         self.bot = bot
+        self.profiling = False
+        self.tracing_memory = False
+        if settings.METRICS_FILE is not None:
+            self.write_metrics_file.start()
+        # With launcher.py, only the first cluster maintains the shared database
+        if settings.CLUSTER_ID in (None, '0'):
+            self.run_database_maintenance.start()
+
+    def cog_unload(self) -> None:
+        self.write_metrics_file.cancel()
+        self.run_database_maintenance.cancel()
 
     dev = SlashCommandGroup(
         "dev",
@@ -81,7 +101,260 @@ class DevCog(commands.Cog):
         else:
             await message.edit('Shutdown aborted.')
 
+    @dev.command()
+    @discord.default_permissions(administrator=True)
+    async def restart(self, ctx: discord.ApplicationContext):
+        """Restarts the bot and keeps its caches"""
+        if ctx.author.id != settings.OWNER_ID:
+            await ctx.respond('As you might have guessed, you are not allowed to use this command.', ephemeral=True)
+            return
+        view = views.ConfirmCancelView(ctx)
+        await ctx.respond(f'**{ctx.author.name}**, are you **SURE**?', view=view)
+        view.message = message = await ctx.interaction.original_message()
+        await view.wait()
+        if view.value is None:
+            await message.edit(f'**{ctx.author.name}**, you didn\'t answer in time.')
+        elif view.value == 'confirm':
+            await message.edit('Restarting.')
+            self.bot.restart_requested = True
+            await self.bot.close()
+        else:
+            await message.edit('Restart aborted.')
+
+    @dev.command()
+    @discord.default_permissions(administrator=True)
+    async def stats(self, ctx: discord.ApplicationContext) -> None:
+        """Shows latency histograms, counters and cache stats"""
+        if ctx.author.id != settings.OWNER_ID:
+            await ctx.respond('As you might have guessed, you are not allowed to use this command.', ephemeral=True)
+            return
+        report = format_stats()
+        if len(report) > 1_900:
+            await ctx.respond(file=discord.File(io.BytesIO(report.encode('utf-8')), filename='stats.txt'))
+        else:
+            await ctx.respond(f'```\n{report}\n```')
+
+    @dev.command()
+    @discord.default_permissions(administrator=True)
+    async def profile(
+        self,
+        ctx: discord.ApplicationContext,
+        seconds: Option(int, 'Seconds to profile the bot for', min_value=1, max_value=settings.PROFILE_MAX_SECONDS,
+                        default=10),
+    ) -> None:
+        """Profiles the event loop for a while and sends the functions that took the most time"""
+        if ctx.author.id != settings.OWNER_ID:
+            await ctx.respond('As you might have guessed, you are not allowed to use this command.', ephemeral=True)
+            return
+        if self.profiling:
+            await ctx.respond('There is already a profile running.', ephemeral=True)
+            return
+        await ctx.defer()
+        # The profiler only exists while this command runs, so the bot runs without any overhead otherwise
+        profiler = cProfile.Profile()
+        self.profiling = True
+        profiler.enable()
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            profiler.disable()
+            self.profiling = False
+        report = format_profile(profiler, seconds)
+        await ctx.respond(file=discord.File(io.BytesIO(report.encode('utf-8')), filename='profile.txt'))
+
+    @dev.command()
+    @discord.default_permissions(administrator=True)
+    async def memory(
+        self,
+        ctx: discord.ApplicationContext,
+        seconds: Option(int, 'Seconds to trace allocations for if they aren\'t traced already', min_value=1,
+                        max_value=settings.PROFILE_MAX_SECONDS, default=settings.MEMORY_TRACE_SECONDS),
+    ) -> None:
+        """Shows the source lines that allocated the most memory and the sizes of all caches"""
+        if ctx.author.id != settings.OWNER_ID:
+            await ctx.respond('As you might have guessed, you are not allowed to use this command.', ephemeral=True)
+            return
+        # A second call would see the tracing of the first one as tracing since the start, and stop it
+        if self.tracing_memory:
+            await ctx.respond('There is already a memory trace running.', ephemeral=True)
+            return
+        await ctx.defer()
+        # Allocations are only traced while this command runs, unless the bot was started with PYTHONTRACEMALLOC.
+        # In that case all allocations since the start are reported right away.
+        self.tracing_memory = True
+        try:
+            if tracemalloc.is_tracing():
+                snapshot = tracemalloc.take_snapshot()
+                traced_seconds = None
+            else:
+                tracemalloc.start()
+                try:
+                    await asyncio.sleep(seconds)
+                    snapshot = tracemalloc.take_snapshot()
+                finally:
+                    tracemalloc.stop()
+                traced_seconds = seconds
+        finally:
+            self.tracing_memory = False
+        report = format_memory(self.bot, snapshot, traced_seconds)
+        await ctx.respond(file=discord.File(io.BytesIO(report.encode('utf-8')), filename='memory.txt'))
+
+    @dev.command()
+    @discord.default_permissions(administrator=True)
+    async def maintenance(self, ctx: discord.ApplicationContext) -> None:
+        """Archives old errors and compacts the database now"""
+        if ctx.author.id != settings.OWNER_ID:
+            await ctx.respond('As you might have guessed, you are not allowed to use this command.', ephemeral=True)
+            return
+        await ctx.defer()
+        try:
+            result = await database.run_maintenance()
+        except (sqlite3.Error, OSError) as error:
+            await ctx.respond(f'Maintenance failed: {error}')
+            return
+        await ctx.respond(f'```\n{format_maintenance(result)}\n```')
+
+    # Tasks
+    @tasks.loop(seconds=settings.METRICS_INTERVAL)
+    async def write_metrics_file(self) -> None:
+        """Writes all metrics to METRICS_FILE in the Prometheus text format.
+        The metrics are rendered on the event loop because the loop keeps changing them, only the file is written in
+        the executor. Errors are logged so a single failure doesn't stop the task.
+        """
+        try:
+            text = metrics.render_prometheus()
+            await asyncio.get_running_loop().run_in_executor(
+                None, metrics.write_prometheus_file, settings.METRICS_FILE, text
+            )
+        except OSError as error:
+            logs.logger.error(f'Error writing metrics file: {error}')
+        except Exception as error:
+            logs.logger.error(f'Error rendering metrics: {error!r}', exc_info=error)
+
+    @tasks.loop(seconds=settings.MAINTENANCE_CHECK_INTERVAL)
+    async def run_database_maintenance(self) -> None:
+        """Archives old errors and compacts the database, see database.run_maintenance(), if the last maintenance
+        finished more than MAINTENANCE_INTERVAL seconds ago. That time is stored in the database, so a bot that
+        restarts often still runs it. Errors are logged so a single failure doesn't stop the task.
+        """
+        try:
+            last_maintenance = await database.get_last_maintenance()
+            if last_maintenance is not None and time.time() - last_maintenance < settings.MAINTENANCE_INTERVAL:
+                return
+            await database.run_maintenance()
+        except Exception as error:
+            logs.logger.error(f'Error running the database maintenance: {error!r}', exc_info=error)
+
+    @run_database_maintenance.before_loop
+    async def before_database_maintenance(self) -> None:
+        """Lets the bot finish starting before an overdue maintenance runs"""
+        await self.bot.wait_until_ready()
+
 
 # Initialization
 def setup(bot):
-    bot.add_cog(DevCog(bot))
\ No newline at end of file
+    bot.add_cog(DevCog(bot))
+
+
+# --- Functions ---
+def format_stats() -> str:
+    """Returns all histograms, counters, gauges and cache stats as a text table"""
+    def format_ms(seconds: float) -> str:
+        return f'{seconds * 1000:,.1f}' if seconds != float('inf') else 'inf'
+
+    lines = [f'{"Timing (ms)":<30}{"calls":>9}{"p50 <=":>9}{"p99 <=":>9}{"mean":>9}']
+    for name, histogram in sorted(metrics.HISTOGRAMS.items()):
+        lines.append(
+            f'{name:<30}{histogram.count:>9,}{format_ms(histogram.percentile(0.5)):>9}'
+            f'{format_ms(histogram.percentile(0.99)):>9}{format_ms(histogram.mean):>9}'
+        )
+    lines.append('')
+    lines.append(f'{"Counter":<30}{"count":>9}')
+    for name, counter_group in sorted(metrics.COUNTERS.items()):
+        for label, count in counter_group.items():
+            lines.append(f'{f"{name} {label}":<30}{count:>9,}')
+    lines.append('')
+    lines.append(f'{"Gauge":<30}{"value":>9}')
+    for name, function in sorted(metrics.GAUGES.items()):
+        for label, value in function().items():
+            lines.append(f'{f"{name} {label}":<30}{value:>9,}')
+    lines.append('')
+    lines.append(f'{"Cache":<30}{"entries":>9}{"hits":>9}{"misses":>9}{"evicted":>9}')
+    for name, cache in sorted(caches.CACHES.items()):
+        lines.append(f'{name:<30}{len(cache):>9,}{cache.hits:>9,}{cache.misses:>9,}{cache.evictions:>9,}')
+    return '\n'.join(lines)
+
+
+def format_profile(profiler: cProfile.Profile, seconds: int) -> str:
+    """Returns the functions with the most own time and the most cumulative time of a profile.
+    Only the event loop is profiled, database queries run in the database thread and are not part of it.
+    """
+    stream = io.StringIO()
+    profile_stats = pstats.Stats(profiler, stream=stream).strip_dirs()
+    stream.write(f'Event loop profile of {seconds} seconds\n\n')
+    for sort_key in (pstats.SortKey.TIME, pstats.SortKey.CUMULATIVE):
+        profile_stats.sort_stats(sort_key).print_stats(settings.PROFILE_TOP_FUNCTIONS)
+    return stream.getvalue()
+
+
+def format_memory(bot: discord.Bot, snapshot: tracemalloc.Snapshot, traced_seconds: Optional[int]) -> str:
+    """Returns the source lines that allocated the most memory in a snapshot and the sizes of all caches.
+    traced_seconds is how long allocations were traced for, None if they were traced since the start.
+    """
+    snapshot = snapshot.filter_traces((
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+        tracemalloc.Filter(False, '<frozen importlib._bootstrap_external>'),
+    ))
+    top_lines = snapshot.statistics('lineno')
+    traced_size = sum(statistic.size for statistic in top_lines)
+    if traced_seconds is None:
+        lines = [f'Allocations since the start that are still in use: {traced_size / 1024 / 1024:,.1f} MiB']
+    else:
+        lines = [f'Allocations of the last {traced_seconds} seconds that are still in use: '
+                 f'{traced_size / 1024 / 1024:,.1f} MiB']
+    lines.append(f'{"KiB":>10}{"blocks":>10}  source line')
+    for statistic in top_lines[:settings.MEMORY_TOP_ALLOCATIONS]:
+        frame = statistic.traceback[0]
+        lines.append(f'{statistic.size / 1024:>10,.1f}{statistic.count:>10,}  {frame.filename}:{frame.lineno}')
+    lines.append('')
+    lines.append(f'{"pycord cache":<30}{"entries":>12}')
+    pycord_caches = {
+        'guilds': len(bot.guilds),
+        'channels': sum(len(guild.channels) for guild in bot.guilds),
+        'roles': sum(len(guild.roles) for guild in bot.guilds),
+        'members': sum(len(guild.members) for guild in bot.guilds),
+        'users': len(bot.users),
+        'messages': len(bot.cached_messages),
+        'emojis': len(bot.emojis),
+        'stickers': len(bot.stickers),
+    }
+    for name, entries in pycord_caches.items():
+        lines.append(f'{name:<30}{entries:>12,}')
+    lines.append('')
+    lines.append(f'{"Bot cache":<30}{"entries":>12}{"max":>12}')
+    for name, cache in sorted(caches.CACHES.items()):
+        lines.append(f'{name:<30}{len(cache):>12,}{cache.maxsize:>12,}')
+    name_index_entries = sum(len(index) for index in members.MEMBER_NAME_INDEX.values())
+    lines.append(f'{"member name index":<30}{name_index_entries:>12,}'
+                 f'{"":>12}  {members.get_name_index_size() / 1024:,.0f} KiB')
+    if database.USER_STORE is not None:
+        lines.append(f'{"user store":<30}{len(database.USER_STORE):>12,}'
+                     f'{"":>12}  {database.USER_STORE.nbytes / 1024:,.0f} KiB')
+    return '\n'.join(lines)
+
+
+def format_maintenance(result: database.MaintenanceResult) -> str:
+    """Returns the result of a database maintenance as text"""
+    def format_mib(size: int) -> str:
+        return f'{size / 1024 / 1024:,.1f} MiB'
+
+    lines = [f'Archived errors: {result.archived_errors:,}']
+    if result.archive_file is not None:
+        lines.append(f'Archive: {result.archive_file}')
+    lines.append(f'{"":<16}{"before":>12}{"after":>12}')
+    lines.append(f'{"file size":<16}{format_mib(result.size_before.file_size):>12}'
+                 f'{format_mib(result.size_after.file_size):>12}')
+    lines.append(f'{"free pages":<16}{format_mib(result.size_before.free_size):>12}'
+                 f'{format_mib(result.size_after.free_size):>12}')
+    return '\n'.join(lines)
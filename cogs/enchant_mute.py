@@ -2,13 +2,30 @@
 """Contains the enchant mute event"""
 
 from datetime import timedelta
-import re
+import itertools
+import time
+from typing import Optional
 
 import discord
 from discord.ext import commands
 
 import database
-from resources import emojis, exceptions, functions, settings
+from resources import caches, emojis, exceptions, functions, logs, members, metrics, outbound, parsers, permissions, settings, single_flight, stats
+
+
+# (message id, embed author, embed field) of enchant results that were already handled.
+# Every hit is a duplicate event that was dropped.
+SEEN_ENCHANTS = caches.LRUCache('seen_enchants', maxsize=settings.SEEN_ENCHANTS_SIZE, ttl=settings.SEEN_ENCHANTS_TTL)
+
+# Number of the newest enchant result per (guild_id, user_id). Only the newest one decides the mute, older ones
+# that are still being handled are dropped.
+NEWEST_ENCHANTS = caches.LRUCache('newest_enchants', maxsize=settings.SEEN_ENCHANTS_SIZE,
+                                  ttl=settings.SEEN_ENCHANTS_TTL)
+_enchant_numbers = itertools.count()
+
+# User settings lookups that are running, user_id: lookup. Concurrent enchants of the same user share one lookup,
+# so new users are only welcomed and registered once.
+USER_SETTINGS_LOOKUPS = single_flight.SingleFlight('user settings')
 
 
 class EnchantMuteCog(commands.Cog):
@@ -16,6 +33,68 @@ class EnchantMuteCog(commands.Cog):
     def __init__(self, bot: commands.Bot):
         self.bot = bot
 
+    # Events
+    @commands.Cog.listener()
+    async def on_member_join(self, member: discord.Member) -> None:
+        """Adds new members to the name index"""
+        members.add_member(member)
+
+    @commands.Cog.listener()
+    async def on_member_remove(self, member: discord.Member) -> None:
+        """Removes leaving members from the name index and the member cache"""
+        members.remove_member(member)
+
+    @commands.Cog.listener()
+    async def on_member_update(self, member_before: discord.Member, member_after: discord.Member) -> None:
+        """Keeps the name index and the member cache up to date. Changes of the bot's own roles invalidate the
+        permission cache of the guild."""
+        members.update_member(member_before, member_after)
+        if member_after.id == self.bot.user.id:
+            permissions.invalidate_guild(member_after.guild)
+
+    @commands.Cog.listener()
+    async def on_user_update(self, user_before: discord.User, user_after: discord.User) -> None:
+        """Keeps the name index up to date when a user changes their name"""
+        members.rename_user(user_before, user_after)
+
+    @commands.Cog.listener()
+    async def on_guild_remove(self, guild: discord.Guild) -> None:
+        """Drops the name index and the permission cache of guilds the bot left"""
+        members.remove_guild(guild)
+        permissions.invalidate_guild(guild)
+
+    @commands.Cog.listener()
+    async def on_guild_update(self, guild_before: discord.Guild, guild_after: discord.Guild) -> None:
+        """Invalidates the permission cache, e.g. if the owner changed"""
+        permissions.invalidate_guild(guild_after)
+
+    @commands.Cog.listener()
+    async def on_guild_role_create(self, role: discord.Role) -> None:
+        """Invalidates the permission cache of the guild"""
+        permissions.invalidate_guild(role.guild)
+
+    @commands.Cog.listener()
+    async def on_guild_role_delete(self, role: discord.Role) -> None:
+        """Invalidates the permission cache of the guild"""
+        permissions.invalidate_guild(role.guild)
+
+    @commands.Cog.listener()
+    async def on_guild_role_update(self, role_before: discord.Role, role_after: discord.Role) -> None:
+        """Invalidates the permission cache of the guild"""
+        permissions.invalidate_guild(role_after.guild)
+
+    @commands.Cog.listener()
+    async def on_guild_channel_update(
+        self, channel_before: discord.abc.GuildChannel, channel_after: discord.abc.GuildChannel
+    ) -> None:
+        """Invalidates the permission cache of the channel"""
+        permissions.invalidate_channel(channel_after)
+
+    @commands.Cog.listener()
+    async def on_guild_channel_delete(self, channel: discord.abc.GuildChannel) -> None:
+        """Drops the permission cache of the channel"""
+        permissions.invalidate_channel(channel)
+
     @commands.Cog.listener()
     async def on_message_edit(self, message_before: discord.Message, message_after: discord.Message) -> None:
         """Runs when a message is edited in a channel."""
@@ -28,90 +107,109 @@ class EnchantMuteCog(commands.Cog):
     @commands.Cog.listener()
     async def on_message(self, message: discord.Message) -> None:
         """Runs when a message is sent in a channel."""
+        if message.author.id == settings.EPIC_RPG_ID:
+            functions.add_interaction_message(message)
         if message.author.id == settings.EPIC_RPG_ID and message.embeds:
+            embed = message.embeds[0]
+            seen_key = (message.id, embed.author.name, embed.fields[0].name if embed.fields else None)
+            if SEEN_ENCHANTS.get(seen_key) is not None:
+                return
             try:
-                message_author = (
-                    str(message.embeds[0].author.name)
-                    .encode('unicode-escape',errors='ignore')
-                    .decode('ASCII').replace('\\','')
-                )
-                message_field = str(message.embeds[0].fields[0].name)
-                icon_url = message.embeds[0].author.icon_url
-            except:
+                with metrics.timer('enchant.parse'):
+                    enchant_result = parsers.parse_enchant_embed(embed)
+            except exceptions.NoDataFoundError as error:
+                await outbound.add_reaction(message, emojis.WARNING)
+                await database.log_error(error)
                 return
-            enchant_actions = ['enchant', 'refine', 'transmute', 'transcend']
-            enchants_lower = [enchant.lower() for enchant in settings.ENCHANTS]
-            if (
-                any(action in message_author.lower() for action in enchant_actions)
-                and
-                any(enchant in message_field.lower() for enchant in enchants_lower)
-            ):
-                user_id = user_name = user = None
-                user = await functions.get_interaction_user(message)
-                if user is not None: user = await message.guild.fetch_member(user.id)
-                if user is None:
-                    try:
-                        user_id = int(re.search("avatars\/(.+?)\/", icon_url).group(1))
-                    except:
-                        try:
-                            search_patterns = [
-                                "^(.+?) u2014", #All languages
-                            ]
-                            user_name_match = await functions.get_match_from_patterns(search_patterns, message_author)
-                            user_name = user_name_match.group(1)
-                        except Exception as error:
-                            await message.add_reaction(emojis.WARNING)
-                            await database.log_error(error)
-                            return
-                    if user_id is not None:
-                        user = await message.guild.fetch_member(user_id)
-                    else:
-                        for member in message.guild.members:
-                            member_name = member.name.encode('unicode-escape',errors='ignore').decode('ASCII').replace('\\','')
-                            if member_name == user_name:
-                                user = member
-                                break
-                    if user is None:
-                        await message.add_reaction(emojis.WARNING)
-                        await database.log_error(f'User not determinable in enchant message: {message}')
-                        return
-                try:
-                    enchant = re.search('~-~> \*\*(.+?)\*\* <~-~', message_field).group(1)
-                except Exception as error:
-                    await message.add_reaction(emojis.WARNING)
-                    await database.log_error(error)
-                    return
+            if enchant_result is None:
+                return
+            SEEN_ENCHANTS.set(seen_key, True)
+            stats.increase(message.guild.id, stats.get_enchant_stat(enchant_result.enchant_index))
+            with metrics.timer('enchant.total'):
+                await self.handle_enchant(message, enchant_result)
+            if 'startup.first_enchant' not in metrics.HISTOGRAMS:
+                time_to_first_enchant = time.monotonic() - metrics.STARTED_AT
+                metrics.observe('startup.first_enchant', time_to_first_enchant)
+                logs.logger.info(f'First enchant handled {time_to_first_enchant:,.1f} seconds after the start')
+
+    async def handle_enchant(self, message: discord.Message, enchant_result: parsers.EnchantResult) -> None:
+        """Finds the user of an enchant result and mutes them if they reached their target enchant"""
+        # Numbered before the first await, so the numbers follow the order the results arrived in
+        enchant_number = next(_enchant_numbers)
+        with metrics.timer('enchant.resolve'):
+            user = await functions.get_interaction_member(message)
+            if user is None:
+                if enchant_result.user_id is not None:
+                    user = await members.get_member(message.guild, enchant_result.user_id)
+                elif enchant_result.user_name is not None:
+                    user = await members.get_member_by_name(message.guild, enchant_result.user_name)
+        if user is None:
+            await outbound.add_reaction(message, emojis.WARNING)
+            # The message goes into the user input, so the same failure on many messages is collapsed into one error
+            if enchant_result.user_id is None and enchant_result.user_name is None:
+                await database.log_error('User name not found in enchant message', user_input=message.jump_url)
+            else:
+                await database.log_error('User not determinable in enchant message', user_input=message.jump_url)
+            return
+        newest_key = (message.guild.id, user.id)
+        if NEWEST_ENCHANTS.get(newest_key, -1, count=False) < enchant_number:
+            NEWEST_ENCHANTS.set(newest_key, enchant_number)
+        with metrics.timer('enchant.database'):
+            user_settings = await USER_SETTINGS_LOOKUPS.run(user.id, self.get_user_settings, user, message.channel)
+        if user_settings is None:
+            return
+        if NEWEST_ENCHANTS.get(newest_key, count=False) != enchant_number:
+            single_flight.CONTENTION['superseded enchants'] += 1
+            return
+        if enchant_result.enchant_index >= user_settings.target_enchant:
+            target_enchant_name = settings.ENCHANTS[user_settings.target_enchant]
+            channel = message.channel
+            mute_message = f'{user.mention} Nice! Looks like you enchanted **{enchant_result.enchant}**.'
+            muted = False
+            if permissions.can_timeout(user, channel):
                 try:
-                    user_settings: database.User = await database.get_user(user.id)
-                except exceptions.NoDataFoundError:
-                    await message.channel.send(
-                        f'Hey, **{user.name}**, I can help you with your enchanting if you like!\n'
-                        f'Use `/set enchant` to set the enchant you are going for and I will mute you once you reach '
-                        f'the set enchant (or a higher one, of course).'
-                    )
-                    await database.update_user(user.id, target_enchant=settings.ENCHANTS.index('None'))
-                    return
-                enchant_index = enchants_lower.index(enchant.lower())
-                if enchant_index >= user_settings.target_enchant:
-                    target_enchant_name = settings.ENCHANTS[user_settings.target_enchant]
-                    channel = message.channel
-                    mute_message = f'{user.mention} Nice! Looks like you enchanted **{enchant}**.'
-                    try:
-                        await user.timeout_for(timedelta(seconds=5), reason='Enchant mute')
-                        mute_message = (
-                            f'{mute_message}\n'
-                            f'Because you set **{target_enchant_name}** as your target, you are now muted for 5 seconds.'
-                        )
-                    except Exception as error:
-                        mute_message = (
-                            f'{mute_message}\n'
-                            f'Sadly I was unable to mute you. This is probably due to one of the following reasons:\n'
-                            f'{emojis.BP} I lack the permission `Timeout Members`\n'
-                            f'{emojis.BP} My role is below your highest role\n'
-                            f'{emojis.BP} You are an administrator\n'
-                        )
-
-                    await channel.send(mute_message)
+                    with metrics.timer('enchant.timeout'):
+                        await outbound.timeout(user, timedelta(seconds=5), reason='Enchant mute')
+                    muted = True
+                except Exception:
+                    pass
+            if muted:
+                stats.increase(message.guild.id, stats.STAT_MUTES)
+                mute_message = (
+                    f'{mute_message}\n'
+                    f'Because you set **{target_enchant_name}** as your target, you are now muted for 5 seconds.'
+                )
+            else:
+                stats.increase(message.guild.id, stats.STAT_MUTE_FAILURES)
+                mute_message = (
+                    f'{mute_message}\n'
+                    f'Sadly I was unable to mute you. This is probably due to one of the following reasons:\n'
+                    f'{emojis.BP} I lack the permission `Timeout Members`\n'
+                    f'{emojis.BP} My role is below your highest role\n'
+                    f'{emojis.BP} You are an administrator\n'
+                )
+
+            with metrics.timer('enchant.send'):
+                await outbound.send(channel, mute_message)
+
+    async def get_user_settings(self, user: discord.Member,
+                                channel: discord.abc.Messageable) -> Optional[database.User]:
+        """Returns the settings of a user. Users that aren't in the database yet get a welcome message in the channel
+        and are added without a target enchant, None is returned for them.
+        """
+        try:
+            return await database.get_user(user.id)
+        except exceptions.NoDataFoundError:
+            pass
+        with metrics.timer('enchant.send'):
+            await outbound.send(
+                channel,
+                f'Hey, **{user.name}**, I can help you with your enchanting if you like!\n'
+                f'Use `/set enchant` to set the enchant you are going for and I will mute you once you reach '
+                f'the set enchant (or a higher one, of course).'
+            )
+        await database.update_user(user.id, target_enchant=settings.ENCHANT_INDEX_NONE)
+        return None
 
 
 # Initialization
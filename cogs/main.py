@@ -1,14 +1,16 @@
 # main.py
 """Contains error handling and the help and about commands"""
 
+from collections import Counter
 from datetime import datetime
+import math
 
 import discord
 from discord.commands import slash_command
 from discord.ext import commands
 
 import database
-from resources import emojis, logs, settings
+from resources import caches, emojis, logs, members, settings, stats
 
 
 class MainCog(commands.Cog):
@@ -33,6 +35,12 @@ class MainCog(commands.Cog):
         embed = await embed_about(self.bot, ctx, api_latency)
         await ctx.interaction.edit_original_response(content=None, embed=embed)
 
+    @slash_command(name='stats')
+    async def stats_command(self, ctx: discord.ApplicationContext) -> None:
+        """Shows enchant and mute stats"""
+        embed = await embed_stats(ctx)
+        await ctx.respond(embed=embed)
+
      # Events
     @commands.Cog.listener()
     async def on_application_command_error(self, ctx: discord.ApplicationContext, error: Exception) -> None:
@@ -107,21 +115,77 @@ async def embed_main_help(ctx: discord.ApplicationContext) -> discord.Embed:
     )
     embed.set_footer(text=settings.DEFAULT_FOOTER)
     embed.add_field(name='USER SETTINGS', value=user_settings, inline=False)
+    embed.add_field(name='STATS', value=f'{emojis.BP} `/stats` : Enchant and mute stats', inline=False)
     return embed
 
 
 async def embed_about(bot: commands.Bot, ctx: discord.ApplicationContext, api_latency: datetime) -> discord.Embed:
     """Bot info embed"""
-    user_count = await database.get_user_count(ctx)
+    total_stats = await stats.get_stats()
+    user_count = total_stats[stats.STAT_USERS]
     general = (
         f'{emojis.BP} {len(bot.guilds):,} servers\n'
         f'{emojis.BP} {user_count:,} users\n'
         f'{emojis.BP} {round(bot.latency * 1000):,} ms bot latency\n'
         f'{emojis.BP} {round(api_latency.total_seconds() * 1000):,} ms API latency'
     )
+    user_cache = database.USER_CACHE
+    cache = (
+        f'{emojis.BP} {len(user_cache):,} / {user_cache.maxsize:,} user settings cached\n'
+        f'{emojis.BP} {user_cache.hits:,} hits, {user_cache.misses:,} misses ({user_cache.hit_rate:.1%} hit rate)\n'
+        f'{emojis.BP} {user_cache.evictions:,} evictions\n'
+        f'{emojis.BP} {sum(len(index) for index in members.MEMBER_NAME_INDEX.values()):,} member names indexed '
+        f'in {len(members.MEMBER_NAME_INDEX):,} servers ({members.get_name_index_size() / 1024:,.0f} KiB)\n'
+        f'{emojis.BP} Members found in gateway cache: {members.MEMBER_LOOKUPS["gateway"]:,}, '
+        f'member cache: {members.MEMBER_LOOKUPS["cache"]:,}, API: {members.MEMBER_LOOKUPS["api"]:,}\n'
+        f'{emojis.BP} {caches.CACHES["seen_enchants"].hits:,} duplicate enchant events dropped'
+    )
     creator = f'{emojis.BP} Miriel#0001'
     embed = discord.Embed(color = settings.EMBED_COLOR, title = 'ABOUT ARCHMAGE')
     embed.add_field(name='BOT STATS', value=general, inline=False)
+    if isinstance(bot, discord.AutoShardedClient):
+        guild_counts = Counter(guild.shard_id for guild in bot.guilds)
+        latencies = sorted(bot.latencies)
+        shards = ''
+        for shard_id, latency in latencies:
+            latency = f'{round(latency * 1000):,} ms' if math.isfinite(latency) else 'not connected'
+            shards = f'{shards}\n{emojis.BP} Shard {shard_id}: {guild_counts[shard_id]:,} servers, {latency}'
+        if len(shards) > 1_024:
+            connected_latencies = [latency for _, latency in latencies if math.isfinite(latency)] or [0]
+            shards = (
+                f'{emojis.BP} {len(latencies):,} shards, {len(connected_latencies):,} connected\n'
+                f'{emojis.BP} {round(min(connected_latencies) * 1000):,} - '
+                f'{round(max(connected_latencies) * 1000):,} ms latency'
+            )
+        cluster = f' (CLUSTER {settings.CLUSTER_ID})' if settings.CLUSTER_ID is not None else ''
+        embed.add_field(name=f'SHARDS{cluster}', value=shards.strip(), inline=False)
+    embed.add_field(name='CACHE', value=cache, inline=False)
     embed.add_field(name='CREATOR', value=creator, inline=False)
 
-    return embed
\ No newline at end of file
+    return embed
+
+
+async def embed_stats(ctx: discord.ApplicationContext) -> discord.Embed:
+    """Stats embed"""
+    total_stats = await stats.get_stats()
+    embed = discord.Embed(color = settings.EMBED_COLOR, title = 'ARCHMAGE STATS')
+    embed.set_footer(text=settings.DEFAULT_FOOTER)
+    fields = [('OVERALL', total_stats)]
+    if ctx.guild is not None:
+        fields.append(('THIS SERVER', await stats.get_stats(ctx.guild.id)))
+    for field_name, field_stats in fields:
+        enchants = ''
+        for enchant_index, enchant in enumerate(settings.ENCHANTS):
+            enchant_count = field_stats[stats.get_enchant_stat(enchant_index)]
+            if enchant_count:
+                enchants = f'{enchants}\n{emojis.BP} {enchant}: {enchant_count:,}'
+        if not enchants:
+            enchants = f'{emojis.BP} No enchants seen yet'
+        mutes = (
+            f'{emojis.BP} {field_stats[stats.STAT_MUTES]:,} mutes\n'
+            f'{emojis.BP} {field_stats[stats.STAT_MUTE_FAILURES]:,} failed mutes'
+        )
+        if field_stats is total_stats:
+            mutes = f'{emojis.BP} {total_stats[stats.STAT_USERS]:,} users\n{mutes}'
+        embed.add_field(name=field_name, value=f'{mutes}\n{enchants.strip()}', inline=True)
+    return embed
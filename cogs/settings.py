@@ -7,7 +7,7 @@ from discord.commands import slash_command, Option, SlashCommandGroup
 from discord.ext import commands
 
 import database
-from resources import emojis, settings
+from resources import emojis, permissions, settings
 
 
 class SettingsCog(commands.Cog):
@@ -27,7 +27,7 @@ class SettingsCog(commands.Cog):
         -------
         List with all missing permissions: list(str)
         """
-        channel_permissions = ctx.channel.permissions_for(ctx.guild.me)
+        channel_permissions = permissions.get_channel_permissions(ctx.channel)
         missing_perms = []
         if not channel_permissions.view_channel:
             missing_perms.append('View Channel')
@@ -52,7 +52,7 @@ class SettingsCog(commands.Cog):
             )
             return
         target_enchant = settings.ENCHANTS[user_settings.target_enchant]
-        if user_settings.target_enchant == settings.ENCHANTS.index('None'):
+        if user_settings.target_enchant == settings.ENCHANT_INDEX_NONE:
             answer = (
                 f'**{ctx.author.name}**, you don\'t have a target enchant set.\n'
                 f'Use `/set enchant` to set one.'
@@ -79,7 +79,7 @@ class SettingsCog(commands.Cog):
         enchant: Option(str, 'Enchant you are going for', choices=settings.ENCHANTS),
     ) -> None:
         """Sets the enchant you are going for. You will be muted if you get the selected or a higher enchant."""
-        enchant_index = settings.ENCHANTS.index(enchant)
+        enchant_index = settings.ENCHANT_INDEXES[enchant.lower()]
         await database.update_user(ctx.author.id, target_enchant=enchant_index)
         if enchant_index < len(settings.ENCHANTS) - 1:
             answer = (
@@ -1,16 +1,57 @@
 # database.py
 """Access to the database"""
 
-from datetime import datetime
+import asyncio
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+import functools
+import gzip
+import json
+import os
 import sqlite3
-from typing import NamedTuple, Optional, Union
+import time
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Tuple, Union
 
 import discord
 
-from resources import exceptions, logs, settings
+from resources import caches, exceptions, logs, metrics, settings, user_store
 
 
-ARCHMAGE_DB = sqlite3.connect(settings.DB_FILE, isolation_level=None)
+# The connection is only ever used by the single thread of DB_EXECUTOR, see run_in_db_thread()
+ARCHMAGE_DB = sqlite3.connect(
+    settings.DB_FILE, isolation_level=None, check_same_thread=False, timeout=settings.DB_BUSY_TIMEOUT
+)
+DB_EXECUTOR = ThreadPoolExecutor(max_workers=1, thread_name_prefix='archmage-db')
+USER_CACHE = caches.LRUCache('user_settings', maxsize=settings.USER_CACHE_SIZE, ttl=settings.USER_CACHE_TTL)
+# All user settings if USER_STORE is ON, USER_CACHE is not used then
+USER_STORE: Optional[user_store.UserStore] = None
+
+# Queued user updates (user_id: {column: value}), written by flush_user_updates()
+PENDING_USER_UPDATES: Dict[int, dict] = {}
+# Updates flush_user_updates() is writing right now. They stay visible to get_user() until they are committed.
+_IN_FLIGHT_USER_UPDATES: Dict[int, dict] = {}
+_user_flush_lock = asyncio.Lock()
+_user_flush_handle: Optional[asyncio.TimerHandle] = None
+_closed = False
+
+# Errors collected by log_error() until flush_errors() writes them,
+# (command name, error text): [timestamp, user input, error text, user settings, count]
+PENDING_ERRORS: OrderedDict = OrderedDict()
+_error_flush_handle: Optional[asyncio.TimerHandle] = None
+# (command name, error text): (start of the current hour, records written in it)
+_error_rate_limits: Dict[Tuple[str, str], Tuple[float, int]] = {}
+ERROR_RATE_LIMIT_WINDOW = 3_600
+ERROR_COUNTS = metrics.counters('errors', ('written', 'collapsed', 'rate limited', 'dropped'))
+
+# Other processes can only change the database if it is shared by the clusters of launcher.py or by processes that
+# run some of the shards each. Only then it is checked for their changes, see check_external_changes().
+SHARED_DATABASE = settings.CLUSTER_ID is not None or settings.SHARDING == 'ON'
+# Last PRAGMA data_version and version of settings_user this process saw, see _users_changed_externally().
+# Only used on the database thread.
+_data_version: Optional[int] = None
+_users_version: Optional[int] = None
+_change_check_task: Optional[asyncio.Task] = None
 
 
 INTERNAL_ERROR_SQLITE3 = 'Error executing SQL.\nError: {error}\nTable: {table}\nFunction: {function}\SQL: {sql}'
@@ -23,48 +64,419 @@ class User(NamedTuple):
     target_enchant: int
 
 
-async def log_error(error: Union[Exception, str], ctx: Optional[discord.ApplicationContext] = None):
-    """Logs an error to the database and the logfile
+# --- Database thread ---
+async def run_in_db_thread(function: Callable, *args, **kwargs) -> Any:
+    """Runs a blocking function on the database thread and waits for its result without blocking the event loop.
+    Every access to ARCHMAGE_DB has to go through this function.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(DB_EXECUTOR, functools.partial(function, *args, **kwargs))
 
-    Arguments
-    ---------
-    error: Exception or a simple string.
-    ctx: If context is available, the function will log the user input, the message timestamp
-    and the user settings. If not, current time is used, settings and input are logged as "N/A".
+
+def _execute(sql: str, parameters: Union[Tuple, dict] = ()) -> None:
+    """Executes a statement. Only call this on the database thread."""
+    cur = ARCHMAGE_DB.cursor()
+    cur.execute(sql, parameters)
+
+
+def _get_data_version() -> int:
+    """Returns PRAGMA data_version. Only call this on the database thread."""
+    (data_version,) = ARCHMAGE_DB.execute('PRAGMA data_version').fetchone()
+    return data_version
+
+
+def _get_users_version() -> int:
+    """Returns the version of settings_user, which triggers increase on every change.
+    Only call this on the database thread.
+    """
+    (users_version,) = ARCHMAGE_DB.execute(
+        "SELECT version FROM table_versions WHERE name = 'settings_user'"
+    ).fetchone()
+    return users_version
+
+
+def _users_changed_externally() -> bool:
+    """Returns True if another process changed settings_user since the last call. data_version only changes on
+    commits of other connections, but these also include e.g. their stats. The version of settings_user is only
+    read then and tells if users changed. Only call this on the database thread.
+    """
+    global _data_version, _users_version
+    data_version = _get_data_version()
+    if data_version == _data_version:
+        return False
+    _data_version = data_version
+    users_version = _get_users_version()
+    if users_version == _users_version:
+        return False
+    _users_version = users_version
+    return True
+
+
+async def check_external_changes() -> None:
+    """Clears USER_CACHE and reloads USER_STORE if another process changed settings_user, e.g. another cluster
+    started by launcher.py. Only works if SHARED_DATABASE is True.
 
     Raises
     ------
-    sqlite3.Error when something goes wrong in the database. Also logs this error to the log file.
+    sqlite3.Error if something happened within the database.
+    """
+    if not await run_in_db_thread(_users_changed_externally):
+        return
+    USER_CACHE.clear()
+    if USER_STORE is not None:
+        await reload_user_store()
+
+
+async def _check_external_changes_periodically() -> None:
+    """Runs check_external_changes() every DB_CHANGE_CHECK_INTERVAL seconds, so get_user() never waits for it"""
+    table = 'settings_user'
+    function_name = 'check_external_changes'
+    while True:
+        await asyncio.sleep(settings.DB_CHANGE_CHECK_INTERVAL)
+        try:
+            await check_external_changes()
+        except sqlite3.Error as error:
+            await log_error(
+                INTERNAL_ERROR_SQLITE3.format(error=error, table=table, function=function_name, sql='PRAGMA data_version')
+            )
+
+
+def start() -> None:
+    """Starts checking for changes of other processes if SHARED_DATABASE is True. Called when the bot starts."""
+    global _change_check_task
+    if SHARED_DATABASE and (_change_check_task is None or _change_check_task.done()):
+        _change_check_task = asyncio.create_task(_check_external_changes_periodically())
+
+
+def _fetchone(sql: str, parameters: Union[Tuple, dict] = ()) -> Optional[sqlite3.Row]:
+    """Executes a query and returns the first record. Only call this on the database thread."""
+    cur = ARCHMAGE_DB.cursor()
+    cur.row_factory = sqlite3.Row
+    cur.execute(sql, parameters)
+    return cur.fetchone()
+
+
+# --- Setup ---
+# PRAGMA auto_vacuum value of incremental vacuum, see _enable_incremental_vacuum()
+AUTO_VACUUM_INCREMENTAL = 2
+
+# Applied to the connection on every start. journal_mode is stored in the database file, the others are not.
+PRAGMAS = (
+    ('journal_mode', 'WAL'),
+    ('synchronous', settings.DB_SYNCHRONOUS),
+    ('cache_size', -settings.DB_CACHE_SIZE),
+    ('mmap_size', settings.DB_MMAP_SIZE),
+    ('busy_timeout', settings.DB_BUSY_TIMEOUT * 1_000),
+    ('temp_store', 'MEMORY'),
+)
+
+# Schema migrations. Migration n (counting from 1) brings the database from PRAGMA user_version n-1 to n.
+# Never change a migration that was shipped, add a new one instead.
+MIGRATIONS = (
+    # 1: Base schema, so the bot can start with an empty database. Databases copied from default_db.db have it.
+    (
+        'CREATE TABLE IF NOT EXISTS settings_guild (guild_id INTEGER UNIQUE PRIMARY KEY, prefix TEXT DEFAULT (\'$\'))',
+        'CREATE TABLE IF NOT EXISTS settings_user (user_id INTEGER UNIQUE PRIMARY KEY, target_enchant INTEGER)',
+        'CREATE TABLE IF NOT EXISTS errors (timestamp DATETIME, user_input TEXT, error TEXT, user_settings TEXT)',
+    ),
+    # 2: user_id already is the rowid, the UNIQUE constraint only added a second index that every write updated
+    (
+        'CREATE TABLE settings_user_new (user_id INTEGER PRIMARY KEY, target_enchant INTEGER)',
+        'INSERT INTO settings_user_new (user_id, target_enchant) SELECT user_id, target_enchant FROM settings_user',
+        'DROP TABLE settings_user',
+        'ALTER TABLE settings_user_new RENAME TO settings_user',
+    ),
+    # 3: Errors are read and deleted by age
+    (
+        'CREATE INDEX IF NOT EXISTS idx_errors_timestamp ON errors (timestamp)',
+    ),
+    # 4: Stats, see resources/stats.py. Guild id 0 holds the overall stats. The user count is kept by triggers.
+    (
+        'CREATE TABLE stats (guild_id INTEGER NOT NULL, stat TEXT NOT NULL, count INTEGER NOT NULL, '
+        'PRIMARY KEY (guild_id, stat)) WITHOUT ROWID',
+        "INSERT INTO stats (guild_id, stat, count) SELECT 0, 'users', COUNT(user_id) FROM settings_user",
+        "CREATE TRIGGER stats_user_insert AFTER INSERT ON settings_user BEGIN "
+        "UPDATE stats SET count = count + 1 WHERE guild_id = 0 AND stat = 'users'; END",
+        "CREATE TRIGGER stats_user_delete AFTER DELETE ON settings_user BEGIN "
+        "UPDATE stats SET count = count - 1 WHERE guild_id = 0 AND stat = 'users'; END",
+    ),
+    # 5: Version of settings_user, increased by triggers on every change. Other processes only reload their users if
+    # it changed, see _users_changed_externally().
+    (
+        'CREATE TABLE table_versions (name TEXT PRIMARY KEY, version INTEGER NOT NULL) WITHOUT ROWID',
+        "INSERT INTO table_versions (name, version) VALUES ('settings_user', 0)",
+        "CREATE TRIGGER version_user_insert AFTER INSERT ON settings_user BEGIN "
+        "UPDATE table_versions SET version = version + 1 WHERE name = 'settings_user'; END",
+        "CREATE TRIGGER version_user_update AFTER UPDATE ON settings_user BEGIN "
+        "UPDATE table_versions SET version = version + 1 WHERE name = 'settings_user'; END",
+        "CREATE TRIGGER version_user_delete AFTER DELETE ON settings_user BEGIN "
+        "UPDATE table_versions SET version = version + 1 WHERE name = 'settings_user'; END",
+    ),
+    # 6: When the last maintenance finished, see run_maintenance(). Stored in the database so restarts don't reset it.
+    (
+        'CREATE TABLE maintenance_runs (name TEXT PRIMARY KEY, finished_at REAL NOT NULL) WITHOUT ROWID',
+    ),
+)
+
+
+def _apply_pragmas() -> None:
+    """Applies PRAGMAS to the connection. Only call this on the database thread."""
+    cur = ARCHMAGE_DB.cursor()
+    for pragma, value in PRAGMAS:
+        cur.execute(f'PRAGMA {pragma} = {value}')
+
+
+def _get_schema_version() -> int:
+    """Returns PRAGMA user_version. Only call this on the database thread."""
+    (user_version,) = ARCHMAGE_DB.execute('PRAGMA user_version').fetchone()
+    return user_version
+
+
+def _migrate() -> None:
+    """Runs all migrations the database doesn't have yet, each in its own transaction.
+    Only call this on the database thread.
+
+    Raises
+    ------
+    sqlite3.Error if a migration fails. The database stays at the last successful migration.
+    RuntimeError if the database is newer than this version of the bot.
+    """
+    cur = ARCHMAGE_DB.cursor()
+    cur.execute('BEGIN IMMEDIATE')
+    try:
+        schema_version = _get_schema_version()
+        if schema_version > len(MIGRATIONS):
+            raise RuntimeError(
+                f'Database schema version {schema_version} is newer than the latest known version {len(MIGRATIONS)}.'
+            )
+        # Other processes (see launcher.py) might migrate at the same time, so the version is read while holding
+        # the write lock
+        for version in range(schema_version + 1, len(MIGRATIONS) + 1):
+            for sql in MIGRATIONS[version - 1]:
+                cur.execute(sql)
+            cur.execute(f'PRAGMA user_version = {version}')
+            cur.execute('COMMIT')
+            logs.logger.info(f'Migrated database to schema version {version}')
+            cur.execute('BEGIN IMMEDIATE')
+        cur.execute('COMMIT')
+    except BaseException:
+        if ARCHMAGE_DB.in_transaction:
+            cur.execute('ROLLBACK')
+        raise
+
+
+def _enable_incremental_vacuum() -> None:
+    """Switches the database to incremental auto vacuum, so run_maintenance() can release free pages without a full
+    VACUUM. Databases created without it need one full VACUUM for this, which runs on the first start after the
+    update. Only call this on the database thread.
+    """
+    (auto_vacuum,) = ARCHMAGE_DB.execute('PRAGMA auto_vacuum').fetchone()
+    if auto_vacuum == AUTO_VACUUM_INCREMENTAL:
+        return
+    start = time.perf_counter()
+    ARCHMAGE_DB.execute('PRAGMA auto_vacuum = INCREMENTAL')
+    try:
+        ARCHMAGE_DB.execute('VACUUM')
+    except sqlite3.Error as error:
+        logs.logger.warning(f'Could not switch the database to incremental vacuum, trying again on the next start: {error}')
+        return
+    logs.logger.info(f'Switched the database to incremental vacuum in {time.perf_counter() - start:,.1f} seconds')
+
+
+def _setup() -> None:
+    """Applies the pragmas, runs the migrations, enables incremental vacuum and reads the versions
+    _users_changed_externally() compares with. Only call this on the database thread.
+    """
+    global _data_version, _users_version
+    _apply_pragmas()
+    _migrate()
+    # The full VACUUM blocks the database, so with launcher.py only the cluster that runs the maintenance does it
+    if settings.CLUSTER_ID in (None, '0'):
+        _enable_incremental_vacuum()
+    if SHARED_DATABASE:
+        _data_version = _get_data_version()
+        _users_version = _get_users_version()
+
+
+DB_EXECUTOR.submit(_setup).result()
+
+
+# --- User store ---
+def get_database_stat() -> Optional[Tuple[int, int]]:
+    """Returns (size, modification time in ns) of the database file.
+    Returns None if the WAL file contains changes that are not in the database file yet, e.g. because another process
+    has the database open.
+    """
+    wal_file = f'{settings.DB_FILE}-wal'
+    if os.path.isfile(wal_file) and os.path.getsize(wal_file) > 0:
+        return None
+    database_stat = os.stat(settings.DB_FILE)
+    return (database_stat.st_size, database_stat.st_mtime_ns)
+
+
+def _read_user_store() -> user_store.UserStore:
+    """Reads all users from the database into a new store. Only call this on the database thread."""
+    cur = ARCHMAGE_DB.execute(
+        'SELECT user_id, COALESCE(target_enchant, ?) FROM settings_user ORDER BY user_id',
+        (settings.ENCHANT_INDEX_NONE,)
+    )
+    return user_store.UserStore.from_records(cur)
+
+
+def _load_user_store() -> user_store.UserStore:
+    """Loads the snapshot if it belongs to the current database file, otherwise reads the database.
+    Only call this on the database thread.
+    """
+    database_stat = get_database_stat()
+    if database_stat is not None:
+        store = user_store.UserStore.load(settings.USER_STORE_FILE, database_stat)
+        if store is not None:
+            logs.logger.info(f'Loaded {len(store):,} users from the user store snapshot')
+            return store
+    store = _read_user_store()
+    logs.logger.info(f'Loaded {len(store):,} users from the database')
+    return store
+
+
+def _save_user_store() -> None:
+    """Writes the snapshot of USER_STORE. Call this after the database was closed."""
+    database_stat = get_database_stat()
+    if database_stat is None:
+        logs.logger.info('User store snapshot not saved, the database is still in use by another process')
+        return
+    USER_STORE.save(settings.USER_STORE_FILE, database_stat)
+
+
+async def reload_user_store() -> None:
+    """Reads USER_STORE from the database again, e.g. after another process changed it. Queued updates are kept.
+    USER_STORE keeps serving the old data while the database is read.
+    """
+    global USER_STORE
+    # No flush can commit between the read and the swap, so every update is either in the read data or still queued
+    async with _user_flush_lock:
+        store = await run_in_db_thread(_read_user_store)
+        for user_id, columns in PENDING_USER_UPDATES.items():
+            if 'target_enchant' in columns:
+                store.set(user_id, columns['target_enchant'])
+        USER_STORE = store
+
+
+if settings.USER_STORE == 'ON':
+    USER_STORE = DB_EXECUTOR.submit(_load_user_store).result()
+
+
+# --- Errors ---
+@metrics.timed('database.log_error')
+async def log_error(error: Union[Exception, str], ctx: Optional[discord.ApplicationContext] = None,
+                    user_input: Optional[str] = None) -> None:
+    """Logs an error to the database.
+    Errors are collected in PENDING_ERRORS and written by flush_errors(). Identical errors (same command and error
+    text) that occur until the next write are collapsed into one record with a count. Only ERROR_RATE_LIMIT records
+    per identical error are written per hour. If PENDING_ERRORS is full, the oldest error is dropped.
+
+    Arguments
+    ---------
+    error: Exception or a simple string.
+    ctx: If context is available, the function will log the user input and the user settings.
+    If not, settings and input are logged as "N/A".
+    user_input: Input that caused the error if there is no context, e.g. the message a listener handled. It is not
+    part of the error text, so errors that only differ in their input are still collapsed, with the first input kept.
     """
-    table = 'errors'
-    function_name = 'log_error'
-    sql = 'INSERT INTO errors VALUES (?, ?, ?, ?, ?)'
     if ctx is not None:
-        timestamp = ctx.author.created_at
         command_name = f'{ctx.command.full_parent_name} {ctx.command.name}'.strip()
-        command_data = str(ctx.interaction.data)
+        user_input = f'{command_name}: {ctx.interaction.data}'
     else:
-        timestamp = datetime.utcnow()
         command_name = 'N/A'
-        command_data = 'N/A'
+        if user_input is None:
+            user_input = 'N/A'
+    signature = (command_name, str(error))
+    pending_error = PENDING_ERRORS.get(signature)
+    if pending_error is not None:
+        pending_error[-1] += 1
+        ERROR_COUNTS['collapsed'] += 1
+        return
+    user_settings = 'N/A'
+    if ctx is not None:
+        try:
+            user_settings = str(await get_user(ctx.author.id))
+        except Exception:
+            pass
+    PENDING_ERRORS[signature] = [datetime.utcnow(), user_input, str(error), user_settings, 1]
+    if len(PENDING_ERRORS) > settings.ERROR_BUFFER_SIZE:
+        PENDING_ERRORS.popitem(last=False)
+        ERROR_COUNTS['dropped'] += 1
+    _schedule_error_flush()
+
+
+def _insert_errors(records: List[Tuple]) -> None:
+    """Inserts error records in one transaction. Only call this on the database thread."""
+    cur = ARCHMAGE_DB.cursor()
+    cur.execute('BEGIN IMMEDIATE')
     try:
-        user_settings = await get_user(ctx.author.id)
-    except:
-        user_settings = 'N/A'
+        cur.executemany(
+            'INSERT INTO errors (timestamp, user_input, error, user_settings) VALUES (?, ?, ?, ?)', records
+        )
+        cur.execute('COMMIT')
+    except sqlite3.Error:
+        cur.execute('ROLLBACK')
+        raise
+
+
+async def flush_errors() -> None:
+    """Writes all errors collected by log_error() to the database.
+    Database errors are only logged to the log file to avoid a loop.
+    """
+    global _error_flush_handle
+    table = 'errors'
+    function_name = 'flush_errors'
+    if _error_flush_handle is not None:
+        _error_flush_handle.cancel()
+        _error_flush_handle = None
+    if not PENDING_ERRORS:
+        return
+    now = time.monotonic()
+    records = []
+    for signature, (timestamp, user_input, error, user_settings, count) in PENDING_ERRORS.items():
+        window_start, written = _error_rate_limits.get(signature, (now, 0))
+        if now - window_start >= ERROR_RATE_LIMIT_WINDOW:
+            window_start, written = now, 0
+        if written >= settings.ERROR_RATE_LIMIT:
+            ERROR_COUNTS['rate limited'] += count
+            continue
+        _error_rate_limits[signature] = (window_start, written + 1)
+        if count > 1:
+            error = f'{error}\n(Occurred {count} times since {timestamp:%Y-%m-%d %H:%M:%S} UTC)'
+        records.append((timestamp, user_input, error, user_settings))
+    PENDING_ERRORS.clear()
+    for signature, (window_start, _) in list(_error_rate_limits.items()):
+        if now - window_start >= ERROR_RATE_LIMIT_WINDOW:
+            del _error_rate_limits[signature]
+    if not records:
+        return
+    sql = 'INSERT INTO errors (timestamp, user_input, error, user_settings) VALUES (?, ?, ?, ?)'
     try:
-        cur = ARCHMAGE_DB.cursor()
-        cur.execute(sql, (timestamp, command_name, command_data, str(error), user_settings))
+        await run_in_db_thread(_insert_errors, records)
     except sqlite3.Error as error:
         logs.logger.error(
-            INTERNAL_ERROR_SQLITE3.format(error=error, table=table, function=function_name, sql=sql),
-            ctx
+            INTERNAL_ERROR_SQLITE3.format(error=error, table=table, function=function_name, sql=sql)
+        )
+        return
+    ERROR_COUNTS['written'] += len(records)
+
+
+def _schedule_error_flush() -> None:
+    """Makes sure collected errors are written after ERROR_FLUSH_INTERVAL seconds at the latest"""
+    global _error_flush_handle
+    if _error_flush_handle is None:
+        _error_flush_handle = asyncio.get_running_loop().call_later(
+            settings.ERROR_FLUSH_INTERVAL, lambda: asyncio.ensure_future(flush_errors())
         )
-        raise
 
 
 # --- Get Data ---
+@metrics.timed('database.get_user')
 async def get_user(user_id: int) -> User:
-    """Gets user settings.
+    """Gets user settings. Served from USER_STORE or USER_CACHE if possible, queued updates are applied to the result.
 
     Returns
     -------
@@ -80,63 +492,96 @@ async def get_user(user_id: int) -> User:
     table = 'settings_user'
     function_name = 'get_user'
     sql = 'SELECT * FROM settings_user where user_id=?'
+    if USER_STORE is not None:
+        target_enchant = USER_STORE.get(user_id)
+        if target_enchant is None:
+            raise exceptions.NoDataFoundError('User not in database')
+        return User(user_id=user_id, target_enchant=target_enchant)
+    user_settings = USER_CACHE.get(user_id)
+    if user_settings is not None:
+        return user_settings
     try:
-        cur = ARCHMAGE_DB.cursor()
-        cur.row_factory = sqlite3.Row
-        cur.execute(sql, (user_id,))
-        record = cur.fetchone()
+        record = await run_in_db_thread(_fetchone, sql, (user_id,))
     except sqlite3.Error as error:
         await log_error(
             INTERNAL_ERROR_SQLITE3.format(error=error, table=table, function=function_name, sql=sql)
         )
         raise
-    if not record:
+    pending_update = _get_queued_update(user_id)
+    if not record and pending_update is None:
         raise exceptions.NoDataFoundError('User not in database')
     try:
-        user_settings = User(
-            user_id = record['user_id'],
-            target_enchant = record['target_enchant'],
-        )
+        if record:
+            user_settings = User(
+                user_id = record['user_id'],
+                target_enchant = record['target_enchant'],
+            )
+        else:
+            user_settings = User(user_id=user_id, target_enchant=settings.ENCHANT_INDEX_NONE)
+        if pending_update is not None:
+            user_settings = user_settings._replace(**pending_update)
     except Exception as error:
         await log_error(
             INTERNAL_ERROR_LOOKUP.format(error=error, table=table, function=function_name, record=record)
         )
         raise LookupError
+    USER_CACHE.set(user_id, user_settings)
 
     return user_settings
 
 
-async def get_user_count(ctx: discord.ApplicationContext) -> int:
-    """Gets the amount of users in the database.
+def _fetch_stats(guild_ids: Optional[Tuple[int, ...]] = None) -> Dict[int, Dict[str, int]]:
+    """Reads the stats of the given guilds or of all guilds. Only call this on the database thread."""
+    sql = 'SELECT guild_id, stat, count FROM stats'
+    if guild_ids is not None:
+        sql = f'{sql} WHERE guild_id IN ({", ".join("?" * len(guild_ids))})'
+    stats = {}
+    for guild_id, stat, count in ARCHMAGE_DB.execute(sql, guild_ids or ()):
+        stats.setdefault(guild_id, {})[stat] = count
+    return stats
+
+
+@metrics.timed('database.get_stats')
+async def get_stats() -> Dict[int, Dict[str, int]]:
+    """Gets all stats. Use resources/stats.py instead, this is only used to load them.
 
     Returns
     -------
-    Amound of users: int
+    Dict with guild id: {stat: count}. Guild id 0 contains the overall stats.
 
     Raises
     ------
-    sqlite3.Error if something happened within the database. Also logs this error to the log file.
+    sqlite3.Error if something happened within the database. Also logs this error to the database.
     """
-    table = 'settings_user'
-    function_name = 'get_user_count'
-    sql = 'SELECT COUNT(user_id) FROM settings_user'
+    table = 'stats'
+    function_name = 'get_stats'
+    sql = 'SELECT guild_id, stat, count FROM stats'
     try:
-        cur = ARCHMAGE_DB.cursor()
-        cur.execute(sql)
-        record = cur.fetchone()
+        return await run_in_db_thread(_fetch_stats)
     except sqlite3.Error as error:
         await log_error(
-            INTERNAL_ERROR_SQLITE3.format(error=error, table=table, function=function_name, sql=sql),
-            ctx
+            INTERNAL_ERROR_SQLITE3.format(error=error, table=table, function=function_name, sql=sql)
         )
         raise
-    (user_count,) = record
-    return user_count
 
 
 # --- Write Data ---
+def _get_queued_update(user_id: int) -> Optional[dict]:
+    """Returns the updates of a user that are queued or being written, None if there are none"""
+    in_flight_update = _IN_FLIGHT_USER_UPDATES.get(user_id)
+    pending_update = PENDING_USER_UPDATES.get(user_id)
+    if in_flight_update is None:
+        return pending_update
+    if pending_update is None:
+        return in_flight_update
+    return {**in_flight_update, **pending_update}
+
+
+@metrics.timed('database.update_user')
 async def update_user(user_id: int, **kwargs) -> None:
-    """Updates guild settings.
+    """Updates user settings. Writes through USER_STORE and USER_CACHE.
+    The change is queued and written to the database by flush_user_updates(), together with all other queued
+    changes. Changes for the same user are merged.
 
     Arguments
     ---------
@@ -157,28 +602,382 @@ async def update_user(user_id: int, **kwargs) -> None:
             INTERNAL_ERROR_NO_ARGUMENTS.format(table=table, function=function_name)
         )
         raise exceptions.NoArgumentsError('You need to specify at least one keyword argument.')
+    for column in kwargs:
+        if column not in User._fields or column == 'user_id':
+            error = sqlite3.OperationalError(f'no such column: {column}')
+            await log_error(
+                INTERNAL_ERROR_SQLITE3.format(error=error, table=table, function=function_name, sql='UPSERT')
+            )
+            raise error
+    PENDING_USER_UPDATES.setdefault(user_id, {}).update(kwargs)
+    if USER_STORE is not None and 'target_enchant' in kwargs:
+        USER_STORE.set(user_id, kwargs['target_enchant'])
+    user_settings = USER_CACHE.get(user_id, count=False)
+    if user_settings is not None:
+        USER_CACHE.set(user_id, user_settings._replace(**kwargs))
+    if len(PENDING_USER_UPDATES) >= settings.USER_WRITE_BATCH_SIZE:
+        await flush_user_updates()
+    else:
+        _schedule_user_flush()
+
+
+def _upsert_users(updates: Dict[int, dict]) -> None:
+    """Writes queued user updates in one transaction. Only call this on the database thread."""
+    global _users_version
+    defaults = {'target_enchant': settings.ENCHANT_INDEX_NONE}
+    statements = {}
+    for user_id, columns in updates.items():
+        statements.setdefault(tuple(columns), []).append({**defaults, **columns, 'user_id': user_id})
     cur = ARCHMAGE_DB.cursor()
+    cur.execute('BEGIN IMMEDIATE')
     try:
-        await get_user(user_id)
-    except exceptions.NoDataFoundError:
-        sql = 'INSERT INTO settings_user (user_id, target_enchant) VALUES (?, ?)'
+        users_version = _get_users_version() if SHARED_DATABASE else None
+        for columns, records in statements.items():
+            sql = (
+                f'INSERT INTO settings_user (user_id, target_enchant) VALUES (:user_id, :target_enchant) '
+                f'ON CONFLICT(user_id) DO UPDATE SET {", ".join(f"{column} = excluded.{column}" for column in columns)}'
+            )
+            cur.executemany(sql, records)
+        new_users_version = _get_users_version() if SHARED_DATABASE else None
+        cur.execute('COMMIT')
+    except sqlite3.Error:
+        cur.execute('ROLLBACK')
+        raise
+    # Our own changes don't need a reload. If another process changed users before, the version stays behind, so
+    # _users_changed_externally() still notices that.
+    if SHARED_DATABASE and users_version == _users_version:
+        _users_version = new_users_version
+
+
+@metrics.timed('database.flush_user_updates')
+async def flush_user_updates() -> None:
+    """Writes all queued user updates to the database in a single transaction.
+
+    Raises
+    ------
+    sqlite3.Error if something happened within the database. The updates stay queued in that case.
+    Also logs all errors to the database.
+    """
+    global _user_flush_handle
+    table = 'settings_user'
+    function_name = 'flush_user_updates'
+    if _user_flush_handle is not None:
+        _user_flush_handle.cancel()
+        _user_flush_handle = None
+    # Flushes run one after another, so a flush that is called while another one writes waits for it and then
+    # writes what was queued since
+    async with _user_flush_lock:
+        if not PENDING_USER_UPDATES:
+            return
+        _IN_FLIGHT_USER_UPDATES.update(PENDING_USER_UPDATES)
+        PENDING_USER_UPDATES.clear()
         try:
-            cur.execute(sql, (user_id, settings.ENCHANTS.index('None')))
+            await run_in_db_thread(_upsert_users, _IN_FLIGHT_USER_UPDATES)
         except sqlite3.Error as error:
+            for user_id, columns in _IN_FLIGHT_USER_UPDATES.items():
+                PENDING_USER_UPDATES[user_id] = {**columns, **PENDING_USER_UPDATES.get(user_id, {})}
+            _schedule_user_flush()
             await log_error(
-                INTERNAL_ERROR_SQLITE3.format(error=error, table=table, function=function_name, sql=sql)
+                INTERNAL_ERROR_SQLITE3.format(error=error, table=table, function=function_name, sql='UPSERT')
             )
             raise
+        finally:
+            _IN_FLIGHT_USER_UPDATES.clear()
+
+
+def _add_stats(increases: Dict[int, Dict[str, int]]) -> Dict[int, Dict[str, int]]:
+    """Adds stat increases and returns the new stats of the changed guilds and the overall stats in one transaction.
+    Only call this on the database thread.
+    """
+    records = [
+        (guild_id, stat, count)
+        for guild_id, guild_increases in increases.items() for stat, count in guild_increases.items()
+    ]
+    cur = ARCHMAGE_DB.cursor()
+    cur.execute('BEGIN IMMEDIATE')
+    try:
+        cur.executemany(
+            'INSERT INTO stats (guild_id, stat, count) VALUES (?, ?, ?) '
+            'ON CONFLICT(guild_id, stat) DO UPDATE SET count = count + excluded.count',
+            records
+        )
+        stats = _fetch_stats(tuple({0, *increases}))
+        cur.execute('COMMIT')
+    except sqlite3.Error:
+        cur.execute('ROLLBACK')
+        raise
+    return stats
+
+
+@metrics.timed('database.add_stats')
+async def add_stats(increases: Dict[int, Dict[str, int]]) -> Dict[int, Dict[str, int]]:
+    """Adds increases to the stats. Use resources/stats.py instead, this is only used to write them.
+
+    Arguments
+    ---------
+    increases: Dict with guild id: {stat: increase}. Guild id 0 contains the overall stats.
+
+    Returns
+    -------
+    The new stats of the changed guilds and the overall stats, same format as increases.
+
+    Raises
+    ------
+    sqlite3.Error if something happened within the database. Also logs this error to the database.
+    """
+    table = 'stats'
+    function_name = 'add_stats'
     try:
-        sql = 'UPDATE settings_user SET'
-        for kwarg in kwargs:
-            sql = f'{sql} {kwarg} = :{kwarg},'
-        sql = sql.strip(",")
-        kwargs['user_id'] = user_id
-        sql = f'{sql} WHERE user_id = :user_id'
-        cur.execute(sql, kwargs)
+        return await run_in_db_thread(_add_stats, increases)
+    except sqlite3.Error as error:
+        await log_error(
+            INTERNAL_ERROR_SQLITE3.format(error=error, table=table, function=function_name, sql='UPSERT')
+        )
+        raise
+
+
+async def _flush_user_updates_in_background() -> None:
+    """Runs flush_user_updates() from the flush timer. Errors are already logged there."""
+    try:
+        await flush_user_updates()
+    except sqlite3.Error:
+        pass
+
+
+def _schedule_user_flush() -> None:
+    """Makes sure queued user updates are flushed after USER_WRITE_INTERVAL seconds at the latest"""
+    global _user_flush_handle
+    if _user_flush_handle is None:
+        _user_flush_handle = asyncio.get_running_loop().call_later(
+            settings.USER_WRITE_INTERVAL, lambda: asyncio.ensure_future(_flush_user_updates_in_background())
+        )
+
+
+# --- Maintenance ---
+class DatabaseSize(NamedTuple):
+    file_size: int # Bytes of the database and WAL files on disk
+    free_size: int # Bytes of free pages within the database file
+
+
+class MaintenanceResult(NamedTuple):
+    archived_errors: int
+    archive_file: Optional[str]
+    size_before: DatabaseSize
+    size_after: DatabaseSize
+
+
+# Held by run_maintenance(), so the scheduled and a manual maintenance never archive the same errors twice
+_maintenance_lock = asyncio.Lock()
+
+
+def _get_database_size() -> DatabaseSize:
+    """Returns the size of the database. Only call this on the database thread."""
+    (page_size,) = ARCHMAGE_DB.execute('PRAGMA page_size').fetchone()
+    (free_pages,) = ARCHMAGE_DB.execute('PRAGMA freelist_count').fetchone()
+    file_size = sum(
+        os.path.getsize(file_name) for file_name in (settings.DB_FILE, f'{settings.DB_FILE}-wal')
+        if os.path.isfile(file_name)
+    )
+    return DatabaseSize(file_size=file_size, free_size=free_pages * page_size)
+
+
+def _fetch_old_errors(cutoff: datetime) -> List[Tuple]:
+    """Returns up to MAINTENANCE_BATCH_SIZE errors older than cutoff, oldest first, with their rowid first.
+    Only call this on the database thread.
+    """
+    return ARCHMAGE_DB.execute(
+        'SELECT rowid, timestamp, user_input, error, user_settings FROM errors WHERE timestamp < ? '
+        'ORDER BY timestamp LIMIT ?',
+        (cutoff, settings.MAINTENANCE_BATCH_SIZE)
+    ).fetchall()
+
+
+def _append_to_archive(archive_file: str, rows: List[Tuple]) -> None:
+    """Appends errors returned by _fetch_old_errors() to the archive file, one JSON object per line.
+    Runs outside the database thread, so compressing doesn't hold up queries.
+    """
+    os.makedirs(os.path.dirname(archive_file), exist_ok=True)
+    # Every batch is appended as its own gzip member, gzip readers read them as one file
+    with gzip.open(archive_file, 'at', encoding='utf-8') as archive:
+        for _, timestamp, user_input, error, user_settings in rows:
+            archive.write(json.dumps(
+                {'timestamp': timestamp, 'user_input': user_input, 'error': error, 'user_settings': user_settings}
+            ))
+            archive.write('\n')
+
+
+def _delete_errors(rowids: List[int]) -> None:
+    """Deletes errors by rowid in one transaction. Only call this on the database thread."""
+    cur = ARCHMAGE_DB.cursor()
+    cur.execute('BEGIN IMMEDIATE')
+    try:
+        cur.executemany('DELETE FROM errors WHERE rowid = ?', ((rowid,) for rowid in rowids))
+        cur.execute('COMMIT')
+    except sqlite3.Error:
+        cur.execute('ROLLBACK')
+        raise
+
+
+def _vacuum_step() -> int:
+    """Releases up to VACUUM_STEP_PAGES free pages to the file system. Does nothing if the database doesn't use
+    incremental vacuum. Only call this on the database thread.
+
+    Returns
+    -------
+    The amount of free pages left.
+    """
+    (auto_vacuum,) = ARCHMAGE_DB.execute('PRAGMA auto_vacuum').fetchone()
+    if auto_vacuum != AUTO_VACUUM_INCREMENTAL:
+        return 0
+    # The pragma releases one page per statement step. execute() only runs the first step, executescript() all.
+    ARCHMAGE_DB.executescript(f'PRAGMA incremental_vacuum({settings.VACUUM_STEP_PAGES})')
+    (free_pages,) = ARCHMAGE_DB.execute('PRAGMA freelist_count').fetchone()
+    return free_pages
+
+
+def _checkpoint() -> None:
+    """Writes the WAL into the database file and truncates it. Only call this on the database thread."""
+    ARCHMAGE_DB.execute('PRAGMA wal_checkpoint(TRUNCATE)').fetchone()
+
+
+def _fetch_last_maintenance() -> Optional[float]:
+    """Returns the unix time the last maintenance finished, None if there never was one.
+    Only call this on the database thread.
+    """
+    record = ARCHMAGE_DB.execute("SELECT finished_at FROM maintenance_runs WHERE name = 'database'").fetchone()
+    return record[0] if record else None
+
+
+def _set_last_maintenance(finished_at: float) -> None:
+    """Stores the unix time the last maintenance finished. Only call this on the database thread."""
+    ARCHMAGE_DB.execute(
+        "INSERT INTO maintenance_runs (name, finished_at) VALUES ('database', ?) "
+        "ON CONFLICT(name) DO UPDATE SET finished_at = excluded.finished_at",
+        (finished_at,)
+    )
+
+
+async def get_last_maintenance() -> Optional[float]:
+    """Gets the unix time the last maintenance finished.
+
+    Returns
+    -------
+    Unix time or None if there never was a maintenance.
+
+    Raises
+    ------
+    sqlite3.Error if something happened within the database.
+    Also logs all errors to the database.
+    """
+    table = 'maintenance_runs'
+    function_name = 'get_last_maintenance'
+    sql = 'SELECT finished_at FROM maintenance_runs'
+    try:
+        return await run_in_db_thread(_fetch_last_maintenance)
     except sqlite3.Error as error:
         await log_error(
             INTERNAL_ERROR_SQLITE3.format(error=error, table=table, function=function_name, sql=sql)
         )
-        raise
\ No newline at end of file
+        raise
+
+
+@metrics.timed('database.maintenance')
+async def run_maintenance() -> MaintenanceResult:
+    """Moves errors older than ERROR_RETENTION_DAYS to a gzipped JSON lines file in ERROR_ARCHIVE_DIR, releases the
+    free pages and checkpoints the WAL. Errors are moved in batches and pages are released in steps, each in its
+    own database thread call, so the queries of the bot are not held up for more than one batch or step.
+    Only one maintenance runs at a time, a second call waits for the first. The time it finished is stored, see
+    get_last_maintenance().
+
+    Returns
+    -------
+    MaintenanceResult with the amount of archived errors, the archive file (None if nothing was archived) and the
+    database size before and after.
+
+    Raises
+    ------
+    sqlite3.Error if something happened within the database.
+    OSError if the archive couldn't be written. Errors that were not archived are not deleted.
+    Also logs all errors to the database.
+    """
+    async with _maintenance_lock:
+        return await _run_maintenance()
+
+
+async def _run_maintenance() -> MaintenanceResult:
+    """Runs the maintenance, see run_maintenance(). Only call this while holding _maintenance_lock."""
+    table = 'errors'
+    function_name = 'run_maintenance'
+    now = datetime.utcnow()
+    cutoff = now - timedelta(days=settings.ERROR_RETENTION_DAYS)
+    archive_file = os.path.join(settings.ERROR_ARCHIVE_DIR, f'errors-{now:%Y-%m-%d}.jsonl.gz')
+    sql = 'PRAGMA page_count'
+    try:
+        size_before = await run_in_db_thread(_get_database_size)
+        archived_errors = 0
+        while True:
+            sql = 'SELECT FROM errors'
+            rows = await run_in_db_thread(_fetch_old_errors, cutoff)
+            if not rows:
+                break
+            # Archived before they are deleted, so a crash in between can only archive errors twice, never lose them
+            await asyncio.get_running_loop().run_in_executor(None, _append_to_archive, archive_file, rows)
+            sql = 'DELETE FROM errors'
+            await run_in_db_thread(_delete_errors, [row[0] for row in rows])
+            archived_errors += len(rows)
+            if len(rows) < settings.MAINTENANCE_BATCH_SIZE:
+                break
+        sql = 'PRAGMA incremental_vacuum'
+        free_pages = None
+        while free_pages is None or free_pages > 0:
+            free_pages_left = await run_in_db_thread(_vacuum_step)
+            # Other processes can hold pages, stop if there is no progress
+            if free_pages is not None and free_pages_left >= free_pages:
+                break
+            free_pages = free_pages_left
+        sql = 'PRAGMA wal_checkpoint'
+        await run_in_db_thread(_checkpoint)
+        size_after = await run_in_db_thread(_get_database_size)
+        sql = 'INSERT INTO maintenance_runs'
+        await run_in_db_thread(_set_last_maintenance, time.time())
+    except sqlite3.Error as error:
+        await log_error(
+            INTERNAL_ERROR_SQLITE3.format(error=error, table=table, function=function_name, sql=sql)
+        )
+        raise
+    except OSError as error:
+        await log_error(f'Error writing the error archive {archive_file}: {error}')
+        raise
+    logs.logger.info(
+        f'Database maintenance: archived {archived_errors:,} errors, size '
+        f'{size_before.file_size / 1024 / 1024:,.1f} MiB -> {size_after.file_size / 1024 / 1024:,.1f} MiB'
+    )
+    return MaintenanceResult(
+        archived_errors=archived_errors,
+        archive_file=archive_file if archived_errors else None,
+        size_before=size_before,
+        size_after=size_after,
+    )
+
+
+async def close() -> None:
+    """Flushes all queued writes and closes the database. Called when the bot is closed.
+    If USER_STORE is used and all updates were written, its snapshot is saved for the next start.
+    """
+    global _closed
+    if _closed:
+        return
+    _closed = True
+    if _change_check_task is not None:
+        _change_check_task.cancel()
+    try:
+        await flush_user_updates()
+    finally:
+        await flush_errors()
+        await run_in_db_thread(ARCHMAGE_DB.close)
+        if USER_STORE is not None and not PENDING_USER_UPDATES:
+            try:
+                await run_in_db_thread(_save_user_store)
+            except OSError as error:
+                logs.logger.error(f'Error saving the user store snapshot: {error}')
+        DB_EXECUTOR.shutdown()
@@ -0,0 +1,98 @@
+# launcher.py
+"""Runs the bot as several processes (clusters) that split the shards between them.
+
+Every cluster is a normal bot.py process with SHARDING=ON and its own SHARD_IDS. All clusters use the same
+database. Clusters that crash are restarted, clusters that were shut down (e.g. with /dev shutdown) are not.
+SIGINT and SIGTERM are passed on to all clusters so they can write their queued database changes before they exit.
+
+Usage: python launcher.py --clusters 4 [--shards 16]
+If --shards is not set, the shard count recommended by Discord is used.
+"""
+
+import argparse
+import json
+import os
+import signal
+import subprocess
+import sys
+import time
+import urllib.request
+from typing import Dict, List
+
+from resources import settings
+
+
+RESTART_DELAY = 5
+
+
+def get_recommended_shard_count() -> int:
+    """Asks Discord how many shards the bot should use"""
+    request = urllib.request.Request(
+        'https://discord.com/api/v10/gateway/bot',
+        headers={'Authorization': f'Bot {settings.TOKEN}', 'User-Agent': 'Archmage launcher'}
+    )
+    with urllib.request.urlopen(request, timeout=10) as response:
+        return json.load(response)['shards']
+
+
+def split_shards(shard_count: int, cluster_count: int) -> List[List[int]]:
+    """Splits the shard ids into cluster_count contiguous ranges of (almost) the same size"""
+    shard_ranges = []
+    for cluster_id in range(cluster_count):
+        start = shard_count * cluster_id // cluster_count
+        end = shard_count * (cluster_id + 1) // cluster_count
+        if end > start:
+            shard_ranges.append(list(range(start, end)))
+    return shard_ranges
+
+
+def start_cluster(cluster_id: int, shard_ids: List[int], shard_count: int) -> subprocess.Popen:
+    """Starts bot.py with the given shards"""
+    env = dict(
+        os.environ,
+        SHARDING='ON',
+        SHARD_COUNT=str(shard_count),
+        SHARD_IDS=','.join(str(shard_id) for shard_id in shard_ids),
+        CLUSTER_ID=str(cluster_id),
+    )
+    print(f'Starting cluster {cluster_id} with shards {shard_ids[0]}-{shard_ids[-1]}')
+    return subprocess.Popen([sys.executable, os.path.join(settings.BOT_DIR, 'bot.py')], env=env, cwd=settings.BOT_DIR)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--clusters', type=int, required=True, help='Amount of processes')
+    parser.add_argument('--shards', type=int, help='Total amount of shards, defaults to the recommended amount')
+    args = parser.parse_args()
+
+    shard_count = args.shards if args.shards is not None else get_recommended_shard_count()
+    shard_ranges = split_shards(shard_count, args.clusters)
+    clusters: Dict[int, subprocess.Popen] = {
+        cluster_id: start_cluster(cluster_id, shard_ids, shard_count)
+        for cluster_id, shard_ids in enumerate(shard_ranges)
+    }
+
+    stopping = False
+    def stop(signal_number, frame) -> None:
+        nonlocal stopping
+        stopping = True
+        for process in clusters.values():
+            if process.poll() is None:
+                process.send_signal(signal.SIGTERM)
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+
+    while not stopping and any(process.poll() is None for process in clusters.values()):
+        time.sleep(1)
+        for cluster_id, process in clusters.items():
+            return_code = process.poll()
+            if return_code and not stopping:
+                print(f'Cluster {cluster_id} exited with code {return_code}, restarting in {RESTART_DELAY} seconds')
+                time.sleep(RESTART_DELAY)
+                clusters[cluster_id] = start_cluster(cluster_id, shard_ranges[cluster_id], shard_count)
+    for process in clusters.values():
+        process.wait()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+# caches.py
+"""Contains the in-memory caches"""
+
+from collections import OrderedDict
+import time
+from typing import Any, Dict, Hashable, Iterable, List, Optional, Tuple
+
+
+CACHES: Dict[str, 'LRUCache'] = {}
+
+_MISSING = object()
+
+
+class LRUCache:
+    """Bounded least recently used cache with an optional time to live.
+
+    Arguments
+    ---------
+    name: Name the cache is registered under in CACHES.
+    maxsize: Maximum amount of entries. The least recently used entry is evicted when this is exceeded.
+    ttl: Seconds an entry stays valid. None means entries never expire.
+    """
+    def __init__(self, name: str, maxsize: int, ttl: Optional[float] = None):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data: OrderedDict = OrderedDict()
+        CACHES[name] = self
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return self.get(key, _MISSING, count=False) is not _MISSING
+
+    def get(self, key: Hashable, default: Any = None, count: bool = True) -> Any:
+        """Returns the cached value or default if the key is missing or expired."""
+        entry = self._data.get(key)
+        if entry is not None:
+            value, expires_at = entry
+            if expires_at is None or expires_at > time.monotonic():
+                self._data.move_to_end(key)
+                if count: self.hits += 1
+                return value
+            del self._data[key]
+        if count: self.misses += 1
+        return default
+
+    def set(self, key: Hashable, value: Any) -> None:
+        """Adds or replaces an entry and evicts the least recently used entries if the cache is full."""
+        expires_at = time.monotonic() + self.ttl if self.ttl is not None else None
+        self._data[key] = (value, expires_at)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        """Removes an entry and returns its value."""
+        entry = self._data.pop(key, None)
+        return entry[0] if entry is not None else default
+
+    def export(self) -> List[Tuple[Hashable, Any, Optional[float]]]:
+        """Returns all valid entries as (key, value, seconds until they expire), least recently used first.
+        The seconds are None if entries never expire.
+        """
+        now = time.monotonic()
+        return [
+            (key, value, expires_at - now if expires_at is not None else None)
+            for key, (value, expires_at) in self._data.items()
+            if expires_at is None or expires_at > now
+        ]
+
+    def restore(self, entries: Iterable[Tuple[Hashable, Any, Optional[float]]], elapsed: float = 0) -> None:
+        """Adds entries returned by export(). elapsed is subtracted from their remaining time to live."""
+        now = time.monotonic()
+        for key, value, time_left in entries:
+            if time_left is not None:
+                time_left -= elapsed
+                if time_left <= 0:
+                    continue
+            self._data[key] = (value, now + time_left if time_left is not None else None)
+            self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def clear(self) -> None:
+        """Removes all entries. Counters are kept."""
+        self._data.clear()
+
+    @property
+    def hit_rate(self) -> float:
+        """Share of lookups that were served from the cache, 0 if there were no lookups yet."""
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
@@ -1,26 +1,49 @@
 # functions.py
 
 import re
-from typing import List
+from typing import List, Optional
 
 import discord
 
+from resources import caches, members, settings
+
+
+# message_id: id of the user that used the slash command of the message, 0 if it wasn't a slash command
+INTERACTION_USER_CACHE = caches.LRUCache(
+    'interaction_users', maxsize=settings.INTERACTION_USER_CACHE_SIZE, ttl=settings.INTERACTION_USER_CACHE_TTL
+)
+
 
 # --- Misc ---
-async def get_interaction(message: discord.Message) -> discord.User:
-    """Returns the interaction object if the message was triggered by a slash command. Returns None if no user was found."""
-    if message.reference is not None:
-        if message.reference.cached_message is not None:
-            message = message.reference.cached_message
-        else:
-            message = await message.channel.fetch_message(message.reference.message_id)
-    return message.interaction
-
-
-async def get_interaction_user(message: discord.Message) -> discord.User:
-    """Returns the user object if the message was triggered by a slash command. Returns None if no user was found."""
-    interaction = await get_interaction(message)
-    return interaction.user if interaction is not None else None
+def add_interaction_message(message: discord.Message) -> None:
+    """Stores the user that triggered the message in INTERACTION_USER_CACHE if it is a slash command response"""
+    if message.interaction is not None:
+        INTERACTION_USER_CACHE.set(message.id, message.interaction.user.id)
+
+
+async def get_interaction_user_id(message: discord.Message) -> Optional[int]:
+    """Returns the id of the user if the message was triggered by a slash command. Returns None if no user was found.
+    Uses INTERACTION_USER_CACHE for referenced messages and only fetches them if they aren't cached.
+    """
+    if message.interaction is not None:
+        return message.interaction.user.id
+    if message.reference is None:
+        return None
+    referenced_message = message.reference.cached_message
+    if referenced_message is None:
+        user_id = INTERACTION_USER_CACHE.get(message.reference.message_id)
+        if user_id is not None:
+            return user_id if user_id != 0 else None
+        referenced_message = await message.channel.fetch_message(message.reference.message_id)
+    interaction = referenced_message.interaction
+    INTERACTION_USER_CACHE.set(referenced_message.id, interaction.user.id if interaction is not None else 0)
+    return interaction.user.id if interaction is not None else None
+
+
+async def get_interaction_member(message: discord.Message) -> Optional[discord.Member]:
+    """Returns the member object if the message was triggered by a slash command. Returns None if no member was found."""
+    user_id = await get_interaction_user_id(message)
+    return await members.get_member(message.guild, user_id) if user_id is not None else None
 
 
 # --- Regex ---
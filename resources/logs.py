@@ -1,17 +1,46 @@
 # logs.py
-"""Contains the logger"""
+"""Contains the logger.
+Records are put into a bounded queue and written to the log file by a background thread, so logging never blocks
+the event loop. If the queue is full, records are dropped.
+"""
 
+import atexit
 import logging
 import logging.handlers
 import os
+import queue
+import random
 
-from resources import settings
+from resources import metrics, settings
 
 
 settings.LOG_FILE = os.path.join(settings.BOT_DIR, 'logs/discord.log')
 if not os.path.isfile(settings.LOG_FILE):
+    os.makedirs(os.path.dirname(settings.LOG_FILE), exist_ok=True)
     open(settings.LOG_FILE, 'a').close()
 
+LOG_COUNTS = metrics.counters('log_records', ('dropped', 'sampled out'))
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """Queue handler that drops records instead of raising when the queue is full"""
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            LOG_COUNTS['dropped'] += 1
+
+
+class DebugSamplingFilter(logging.Filter):
+    """Only lets the share LOG_DEBUG_SAMPLE_RATE of DEBUG records through. Other levels are never filtered."""
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno > logging.DEBUG or settings.LOG_DEBUG_SAMPLE_RATE >= 1:
+            return True
+        if random.random() < settings.LOG_DEBUG_SAMPLE_RATE:
+            return True
+        LOG_COUNTS['sampled out'] += 1
+        return False
+
 
 logger = logging.getLogger('discord')
 if settings.DEBUG_MODE == 'ON':
@@ -20,4 +49,12 @@ else:
     logger.setLevel(logging.INFO)
 handler = logging.handlers.TimedRotatingFileHandler(filename=settings.LOG_FILE,when='D',interval=1, encoding='utf-8', utc=True)
 handler.setFormatter(logging.Formatter('%(asctime)s:%(levelname)s:%(name)s: %(message)s'))
-logger.addHandler(handler)
\ No newline at end of file
+log_queue = queue.Queue(maxsize=settings.LOG_QUEUE_SIZE)
+queue_handler = DroppingQueueHandler(log_queue)
+queue_handler.addFilter(DebugSamplingFilter())
+logger.addHandler(queue_handler)
+# asyncio reports slow callbacks in debug mode and exceptions nobody retrieved
+logging.getLogger('asyncio').addHandler(queue_handler)
+listener = logging.handlers.QueueListener(log_queue, handler, respect_handler_level=True)
+listener.start()
+atexit.register(listener.stop)
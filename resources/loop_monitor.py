@@ -0,0 +1,90 @@
+# loop_monitor.py
+"""Contains the event loop monitor.
+
+A task wakes up every LOOP_LAG_INTERVAL seconds and records how much later than requested it woke up in the
+'loop.lag' histogram. That is the time the event loop was busy with something else and couldn't run anything.
+A watchdog thread checks that this task keeps waking up. If the event loop is blocked for longer than
+SLOW_CALLBACK_DURATION, it logs the stack of the event loop thread, which shows the call that blocks it.
+
+If LOOP_DEBUG is ON, asyncio's debug mode is enabled as well and asyncio logs every callback that runs for longer
+than SLOW_CALLBACK_DURATION. Debug mode slows down the event loop, so only use it while looking for a problem.
+"""
+
+import asyncio
+import sys
+import threading
+import time
+import traceback
+from typing import Optional
+
+from resources import logs, metrics, settings
+
+
+# Frames of the event loop stack that are logged when it is blocked, innermost last
+STACK_DEPTH = 12
+
+_task: Optional[asyncio.Task] = None
+_watchdog: Optional[threading.Thread] = None
+_stop_watchdog = threading.Event()
+# When the monitor task last woke up, and the id of the event loop thread
+_last_tick = 0.0
+_loop_thread_id: Optional[int] = None
+
+BLOCKED_COUNTS = metrics.counters('event_loop', ('blocked',))
+
+
+def start() -> None:
+    """Starts the monitor on the running event loop. Does nothing if it is already running."""
+    global _task, _watchdog, _last_tick, _loop_thread_id
+    if _task is not None and not _task.done():
+        return
+    loop = asyncio.get_running_loop()
+    if settings.LOOP_DEBUG == 'ON':
+        loop.slow_callback_duration = settings.SLOW_CALLBACK_DURATION
+        loop.set_debug(True)
+    _last_tick = time.monotonic()
+    _loop_thread_id = threading.get_ident()
+    _task = asyncio.create_task(_measure_lag())
+    _stop_watchdog.clear()
+    _watchdog = threading.Thread(target=_watch, name='event loop watchdog', daemon=True)
+    _watchdog.start()
+
+
+def stop() -> None:
+    """Stops the monitor"""
+    global _task, _watchdog
+    if _task is not None:
+        _task.cancel()
+        _task = None
+    if _watchdog is not None:
+        _stop_watchdog.set()
+        _watchdog = None
+
+
+async def _measure_lag() -> None:
+    """Records how much later than requested the event loop wakes this task up"""
+    global _last_tick
+    interval = settings.LOOP_LAG_INTERVAL
+    while True:
+        await asyncio.sleep(interval)
+        now = time.monotonic()
+        metrics.observe('loop.lag', max(now - _last_tick - interval, 0))
+        _last_tick = now
+
+
+def _watch() -> None:
+    """Runs in the watchdog thread. Logs the stack of the event loop thread once per blocking call."""
+    reported_tick = None
+    threshold = settings.LOOP_LAG_INTERVAL + settings.SLOW_CALLBACK_DURATION
+    while not _stop_watchdog.wait(settings.SLOW_CALLBACK_DURATION / 2):
+        tick = _last_tick
+        since_tick = time.monotonic() - tick
+        if since_tick < threshold or tick == reported_tick:
+            continue
+        reported_tick = tick
+        frame = sys._current_frames().get(_loop_thread_id)
+        if frame is None:
+            continue
+        BLOCKED_COUNTS['blocked'] += 1
+        stack = ''.join(traceback.format_stack(frame, limit=STACK_DEPTH))
+        logs.logger.warning(f'Event loop blocked for at least {(since_tick - settings.LOOP_LAG_INTERVAL) * 1000:,.0f} ms, currently running:\n{stack}')
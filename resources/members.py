@@ -0,0 +1,179 @@
+# members.py
+"""Contains the member lookups used to find the user of an enchant"""
+
+import asyncio
+import sys
+from typing import Dict, Optional, Set
+
+import discord
+
+from resources import caches, metrics, settings, single_flight
+
+
+# guild_id: {member name: member id}. Guilds are indexed on their first name lookup.
+MEMBER_NAME_INDEX: Dict[int, Dict[str, int]] = {}
+# Guilds whose name index was restored after a restart, see restore_name_index()
+_restored_guilds: Set[int] = set()
+
+# Members that had to be fetched from the API, (guild_id, user_id): member
+MEMBER_CACHE = caches.LRUCache('members', maxsize=settings.MEMBER_CACHE_SIZE, ttl=settings.MEMBER_CACHE_TTL)
+
+# Members found by a gateway query in low memory mode, (guild_id, member name): member
+MEMBER_NAME_CACHE = caches.LRUCache('member_names', maxsize=settings.MEMBER_CACHE_SIZE, ttl=settings.MEMBER_CACHE_TTL)
+
+# Where get_member() and get_member_by_name() found their members
+MEMBER_LOOKUPS = metrics.counters('member_lookups', ('gateway', 'cache', 'api', 'query', 'not found'))
+
+# API fetches and gateway queries that are running, so concurrent lookups of the same member share them
+MEMBER_FETCHES = single_flight.SingleFlight('member fetches')
+MEMBER_QUERIES = single_flight.SingleFlight('member queries')
+
+
+# --- Member resolver ---
+async def get_member(guild: discord.Guild, user_id: int) -> Optional[discord.Member]:
+    """Returns a member of a guild. Checks the gateway member cache and MEMBER_CACHE first and only fetches the
+    member from the API if it isn't in either of them. Returns None if the user is not a member of the guild.
+
+    Raises
+    ------
+    discord.HTTPException if fetching the member failed.
+    """
+    member = guild.get_member(user_id)
+    if member is not None:
+        MEMBER_LOOKUPS['gateway'] += 1
+        return member
+    member = MEMBER_CACHE.get((guild.id, user_id))
+    if member is not None:
+        MEMBER_LOOKUPS['cache'] += 1
+        return member
+    return await MEMBER_FETCHES.run((guild.id, user_id), _fetch_member, guild, user_id)
+
+
+async def _fetch_member(guild: discord.Guild, user_id: int) -> Optional[discord.Member]:
+    """Fetches a member from the API and adds it to MEMBER_CACHE"""
+    try:
+        member = await guild.fetch_member(user_id)
+    except discord.NotFound:
+        MEMBER_LOOKUPS['not found'] += 1
+        return None
+    MEMBER_LOOKUPS['api'] += 1
+    MEMBER_CACHE.set((guild.id, user_id), member)
+    return member
+
+
+# --- Name lookup ---
+async def get_member_by_name(guild: discord.Guild, name: str) -> Optional[discord.Member]:
+    """Returns the member with this name. Returns None if no member was found.
+    Uses the guild's name index, or a gateway query in low memory mode because the member cache is empty there.
+    """
+    if settings.LOW_MEMORY_MODE == 'ON':
+        return await query_member_by_name(guild, name)
+    return get_member_from_name_index(guild, name)
+
+
+async def query_member_by_name(guild: discord.Guild, name: str) -> Optional[discord.Member]:
+    """Returns the member with this name from MEMBER_NAME_CACHE or queries it from the gateway.
+    Returns None if no member was found.
+    """
+    key = (guild.id, name)
+    member = MEMBER_NAME_CACHE.get(key)
+    if member is not None:
+        MEMBER_LOOKUPS['cache'] += 1
+        return member
+    return await MEMBER_QUERIES.run(key, _query_member, guild, name)
+
+
+async def _query_member(guild: discord.Guild, name: str) -> Optional[discord.Member]:
+    """Queries the member with this name from the gateway and adds it to MEMBER_NAME_CACHE"""
+    key = (guild.id, name)
+    try:
+        found_members = await guild.query_members(query=name, limit=100, cache=False)
+    except asyncio.TimeoutError:
+        found_members = []
+    for member in found_members:
+        if member.name == name:
+            MEMBER_LOOKUPS['query'] += 1
+            MEMBER_NAME_CACHE.set(key, member)
+            return member
+    MEMBER_LOOKUPS['not found'] += 1
+    return None
+
+
+def get_member_from_name_index(guild: discord.Guild, name: str) -> Optional[discord.Member]:
+    """Returns the member with this name from the guild's name index. Builds the index if the guild has none yet.
+    Returns None if no member was found.
+    """
+    index = MEMBER_NAME_INDEX.get(guild.id)
+    if index is None:
+        index = MEMBER_NAME_INDEX[guild.id] = {}
+        for member in guild.members:
+            index.setdefault(member.name, member.id)
+    member_id = index.get(name)
+    member = guild.get_member(member_id) if member_id is not None else None
+    if member is not None and member.name == name:
+        return member
+    if guild.id in _restored_guilds:
+        # A restored index misses members that joined or were renamed while the bot was offline
+        _restored_guilds.discard(guild.id)
+        del MEMBER_NAME_INDEX[guild.id]
+        return get_member_from_name_index(guild, name)
+    return None
+
+
+def add_member(member: discord.Member) -> None:
+    """Adds a member to the name index of its guild"""
+    index = MEMBER_NAME_INDEX.get(member.guild.id)
+    if index is not None:
+        index.setdefault(member.name, member.id)
+
+
+def remove_member(member: discord.Member) -> None:
+    """Removes a member from the name index of its guild, MEMBER_CACHE and MEMBER_NAME_CACHE"""
+    MEMBER_CACHE.pop((member.guild.id, member.id))
+    MEMBER_NAME_CACHE.pop((member.guild.id, member.name))
+    index = MEMBER_NAME_INDEX.get(member.guild.id)
+    if index is not None and index.get(member.name) == member.id:
+        del index[member.name]
+
+
+def update_member(member_before: discord.Member, member_after: discord.Member) -> None:
+    """Updates a member in the name index of its guild and in MEMBER_CACHE"""
+    key = (member_after.guild.id, member_after.id)
+    cached = key in MEMBER_CACHE
+    if member_before.name != member_after.name:
+        remove_member(member_before)
+        add_member(member_after)
+    if cached:
+        MEMBER_CACHE.set(key, member_after)
+
+
+def rename_user(user_before: discord.abc.User, user_after: discord.abc.User) -> None:
+    """Updates the name of a user in all indexed guilds"""
+    if user_before.name == user_after.name:
+        return
+    for index in MEMBER_NAME_INDEX.values():
+        if index.get(user_before.name) == user_before.id:
+            del index[user_before.name]
+            index.setdefault(user_after.name, user_after.id)
+
+
+def remove_guild(guild: discord.Guild) -> None:
+    """Drops the name index of a guild"""
+    MEMBER_NAME_INDEX.pop(guild.id, None)
+    _restored_guilds.discard(guild.id)
+
+
+def restore_name_index(name_index: Dict[int, Dict[str, int]]) -> None:
+    """Adds name indexes saved before a restart. A restored index is rebuilt once a name is not found in it."""
+    MEMBER_NAME_INDEX.update(name_index)
+    _restored_guilds.update(name_index)
+
+
+def get_name_index_size() -> int:
+    """Returns the approximate memory used by the name index in bytes"""
+    size = sys.getsizeof(MEMBER_NAME_INDEX)
+    for guild_id, index in MEMBER_NAME_INDEX.items():
+        size += sys.getsizeof(guild_id) + sys.getsizeof(index)
+        for name, member_id in index.items():
+            size += sys.getsizeof(name) + sys.getsizeof(member_id)
+    return size
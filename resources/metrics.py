@@ -0,0 +1,147 @@
+# metrics.py
+"""Contains the latency histograms and counters"""
+
+from bisect import bisect_left
+from contextlib import contextmanager
+import functools
+import os
+import time
+from typing import Callable, Dict, Iterable, Iterator
+
+from resources import caches
+
+
+# Upper bounds of the histogram buckets in seconds
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+HISTOGRAMS: Dict[str, 'Histogram'] = {}
+
+# When the process started, close enough as this module is imported right at the start
+STARTED_AT = time.monotonic()
+
+# Name: {label: count}
+COUNTERS: Dict[str, Dict[str, int]] = {}
+
+# Name: function returning {label: current value}
+GAUGES: Dict[str, Callable[[], Dict[str, float]]] = {}
+
+
+class Histogram:
+    """Latency histogram with the fixed buckets in BUCKETS. The last count is for values above all buckets."""
+    __slots__ = ('name', 'counts', 'count', 'sum')
+
+    def __init__(self, name: str):
+        self.name = name
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds: float) -> None:
+        self.counts[bisect_left(BUCKETS, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+
+    def percentile(self, share: float) -> float:
+        """Returns the upper bound of the bucket the given share of values falls into.
+        Values above all buckets are reported as infinite.
+        """
+        if not self.count:
+            return 0.0
+        target = share * self.count
+        cumulative = 0
+        for bucket_index, bucket_count in enumerate(self.counts):
+            cumulative += bucket_count
+            if cumulative >= target:
+                return BUCKETS[bucket_index] if bucket_index < len(BUCKETS) else float('inf')
+        return float('inf')
+
+    @property
+    def mean(self) -> float:
+        return self.sum / self.count if self.count else 0.0
+
+
+def observe(name: str, seconds: float) -> None:
+    """Records a duration in the histogram with this name"""
+    histogram = HISTOGRAMS.get(name)
+    if histogram is None:
+        histogram = HISTOGRAMS[name] = Histogram(name)
+    histogram.observe(seconds)
+
+
+@contextmanager
+def timer(name: str) -> Iterator[None]:
+    """Records the duration of the with block in the histogram with this name"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start)
+
+
+def timed(name: str) -> Callable:
+    """Decorator that records the duration of every call of a coroutine function in the histogram with this name"""
+    def decorator(function: Callable) -> Callable:
+        @functools.wraps(function)
+        async def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await function(*args, **kwargs)
+            finally:
+                observe(name, time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+
+def counters(name: str, labels: Iterable[str]) -> Dict[str, int]:
+    """Registers a group of counters and returns its dict. Increase the counters by changing the dict."""
+    counter_group = COUNTERS[name] = {label: 0 for label in labels}
+    return counter_group
+
+
+def gauges(name: str, function: Callable[[], Dict[str, float]]) -> None:
+    """Registers a group of gauges. The function is called on every export and returns the current values."""
+    GAUGES[name] = function
+
+
+# --- Export ---
+def render_prometheus() -> str:
+    """Returns all histograms, counters, gauges and cache stats in the Prometheus text format"""
+    lines = []
+    for histogram in HISTOGRAMS.values():
+        metric = f'archmage_{histogram.name.replace(".", "_")}_seconds'
+        lines.append(f'# TYPE {metric} histogram')
+        cumulative = 0
+        for bucket, bucket_count in zip(BUCKETS, histogram.counts):
+            cumulative += bucket_count
+            lines.append(f'{metric}_bucket{{le="{bucket}"}} {cumulative}')
+        lines.append(f'{metric}_bucket{{le="+Inf"}} {histogram.count}')
+        lines.append(f'{metric}_sum {histogram.sum}')
+        lines.append(f'{metric}_count {histogram.count}')
+    for name, counter_group in COUNTERS.items():
+        metric = f'archmage_{name.replace(".", "_")}_total'
+        lines.append(f'# TYPE {metric} counter')
+        for label, count in counter_group.items():
+            lines.append(f'{metric}{{type="{label}"}} {count}')
+    for name, function in GAUGES.items():
+        metric = f'archmage_{name.replace(".", "_")}'
+        lines.append(f'# TYPE {metric} gauge')
+        for label, value in function().items():
+            lines.append(f'{metric}{{type="{label}"}} {value}')
+    for stat in ('hits', 'misses', 'evictions'):
+        lines.append(f'# TYPE archmage_cache_{stat}_total counter')
+        for cache in caches.CACHES.values():
+            lines.append(f'archmage_cache_{stat}_total{{cache="{cache.name}"}} {getattr(cache, stat)}')
+    lines.append('# TYPE archmage_cache_entries gauge')
+    for cache in caches.CACHES.values():
+        lines.append(f'archmage_cache_entries{{cache="{cache.name}"}} {len(cache)}')
+    return '\n'.join(lines) + '\n'
+
+
+def write_prometheus_file(file_name: str, text: str) -> None:
+    """Writes the output of render_prometheus() to a file. The file is replaced atomically so scrapers never read
+    half a file. Doesn't touch any metrics, so it can run outside of the event loop thread.
+    """
+    temp_file_name = f'{file_name}.tmp'
+    with open(temp_file_name, 'w', encoding='utf-8') as metrics_file:
+        metrics_file.write(text)
+    os.replace(temp_file_name, file_name)
@@ -0,0 +1,256 @@
+# outbound.py
+"""Contains the outbound scheduler for timeouts, messages and reactions.
+
+Up to OUTBOUND_GUILD_CONCURRENCY timeouts are sent at the same time per guild, messages and reactions one after
+another per channel. This way a burst of enchants doesn't fire lots of parallel requests into the same Discord rate
+limit bucket. pycord waits for the buckets itself, so the queues don't wait for each other, except after a request
+was rate limited anyway (HTTP 429): then the guild pauses all its requests until the rate limit is over.
+Messages that are waiting for the same channel are merged into one message.
+"""
+
+import asyncio
+from collections import deque
+from datetime import timedelta
+import time
+from typing import Any, Deque, Dict, List, NamedTuple, Optional
+
+import discord
+
+from resources import metrics, settings
+
+
+MESSAGE_MAX_LENGTH = 2_000
+MESSAGE_SEPARATOR = '\n\n'
+
+# Seconds a guild pauses after a 429 response without a Retry-After header
+RATE_LIMIT_BACKOFF = 1.0
+
+OUTBOUND_COUNTS = metrics.counters(
+    'outbound', ('timeouts', 'messages sent', 'messages merged', 'reactions', 'rate limited')
+)
+
+
+class OutboundItem(NamedTuple):
+    """A queued request. The future gets the result of the request."""
+    payload: Any
+    future: asyncio.Future
+    queued_at: float
+
+
+class GuildQueue:
+    """Pending timeouts of a guild and the workers that send them"""
+    def __init__(self):
+        self.timeouts: Deque[OutboundItem] = deque()
+        self.workers = 0
+
+
+class ChannelQueue:
+    """Pending messages and reactions of a channel"""
+    def __init__(self, guild_id: Optional[int]):
+        self.guild_id = guild_id
+        self.messages: Deque[OutboundItem] = deque()
+        self.reactions: Deque[OutboundItem] = deque()
+        self.task: Optional[asyncio.Task] = None
+
+
+# Queues only exist while they have pending requests
+GUILD_QUEUES: Dict[int, GuildQueue] = {}
+CHANNEL_QUEUES: Dict[int, ChannelQueue] = {}
+# Guilds that got a 429 response and when their requests may continue (time.monotonic())
+RATE_LIMITED_UNTIL: Dict[int, float] = {}
+
+
+# --- Requests ---
+async def timeout(member: discord.Member, duration: timedelta, reason: Optional[str] = None) -> None:
+    """Queues a timeout for a member and waits until it is done
+
+    Raises
+    ------
+    The exception of member.timeout_for if the timeout failed.
+    """
+    guild_queue = GUILD_QUEUES.get(member.guild.id)
+    if guild_queue is None:
+        guild_queue = GUILD_QUEUES[member.guild.id] = GuildQueue()
+    future = asyncio.get_running_loop().create_future()
+    guild_queue.timeouts.append(OutboundItem((member, duration, reason), future, time.perf_counter()))
+    if guild_queue.workers < settings.OUTBOUND_GUILD_CONCURRENCY:
+        guild_queue.workers += 1
+        asyncio.create_task(_process_timeouts(member.guild.id, guild_queue))
+    await future
+
+
+async def send(channel: discord.abc.Messageable, content: str) -> discord.Message:
+    """Queues a message and waits until it is sent. If there are other messages waiting for the same channel, they
+    are sent together as one message.
+
+    Returns
+    -------
+    The sent message. This can contain other merged messages as well.
+
+    Raises
+    ------
+    The exception of channel.send if the message couldn't be sent.
+    """
+    future = asyncio.get_running_loop().create_future()
+    _get_channel_queue(channel).messages.append(OutboundItem(content, future, time.perf_counter()))
+    return await future
+
+
+async def add_reaction(message: discord.Message, emoji: str) -> None:
+    """Queues a reaction and waits until it is added. Reactions are added after all pending messages of the channel.
+
+    Raises
+    ------
+    The exception of message.add_reaction if the reaction couldn't be added.
+    """
+    future = asyncio.get_running_loop().create_future()
+    _get_channel_queue(message.channel).reactions.append(OutboundItem((message, emoji), future, time.perf_counter()))
+    await future
+
+
+def get_queue_depths() -> Dict[str, int]:
+    """Returns the amount of pending timeouts, messages and reactions"""
+    return {
+        'timeouts': sum(len(guild_queue.timeouts) for guild_queue in GUILD_QUEUES.values()),
+        'messages': sum(len(channel_queue.messages) for channel_queue in CHANNEL_QUEUES.values()),
+        'reactions': sum(len(channel_queue.reactions) for channel_queue in CHANNEL_QUEUES.values()),
+    }
+
+
+metrics.gauges('outbound_queue_depth', get_queue_depths)
+
+
+# --- Workers ---
+def _get_channel_queue(channel: discord.abc.Messageable) -> ChannelQueue:
+    """Returns the queue of a channel and starts its worker if the queue is new"""
+    channel_queue = CHANNEL_QUEUES.get(channel.id)
+    if channel_queue is None:
+        guild = getattr(channel, 'guild', None)
+        channel_queue = CHANNEL_QUEUES[channel.id] = ChannelQueue(guild.id if guild is not None else None)
+        channel_queue.task = asyncio.create_task(_process_channel(channel, channel_queue))
+    return channel_queue
+
+
+def _set_result(future: asyncio.Future, result: Any = None, error: Optional[BaseException] = None) -> None:
+    """Resolves a future unless the waiting caller was cancelled"""
+    if future.done():
+        return
+    if error is not None:
+        future.set_exception(error)
+    else:
+        future.set_result(result)
+
+
+async def _wait_for_rate_limit(guild_id: Optional[int]) -> None:
+    """Waits until the rate limit of a guild is over, if it got a 429 response"""
+    rate_limited_until = RATE_LIMITED_UNTIL.get(guild_id)
+    if rate_limited_until is None:
+        return
+    delay = rate_limited_until - time.monotonic()
+    if delay <= 0:
+        RATE_LIMITED_UNTIL.pop(guild_id, None)
+        return
+    await asyncio.sleep(delay)
+
+
+def _check_rate_limit(guild_id: Optional[int], error: Exception) -> None:
+    """Pauses the requests of a guild if error is a 429 response"""
+    if guild_id is None or not isinstance(error, discord.HTTPException) or error.status != 429:
+        return
+    OUTBOUND_COUNTS['rate limited'] += 1
+    try:
+        retry_after = float(error.response.headers['Retry-After'])
+    except (AttributeError, KeyError, TypeError, ValueError):
+        retry_after = RATE_LIMIT_BACKOFF
+    RATE_LIMITED_UNTIL[guild_id] = max(RATE_LIMITED_UNTIL.get(guild_id, 0), time.monotonic() + retry_after)
+
+
+async def _process_timeouts(guild_id: int, guild_queue: GuildQueue) -> None:
+    """Sends the queued timeouts of a guild until the queue is empty. Up to OUTBOUND_GUILD_CONCURRENCY of these
+    workers run per guild, the last one removes the queue.
+    """
+    try:
+        while guild_queue.timeouts:
+            await _wait_for_rate_limit(guild_id)
+            if not guild_queue.timeouts:
+                break
+            item = guild_queue.timeouts.popleft()
+            if item.future.done():
+                continue
+            metrics.observe('outbound.timeout_wait', time.perf_counter() - item.queued_at)
+            member, duration, reason = item.payload
+            try:
+                await member.timeout_for(duration, reason=reason)
+            except Exception as error:
+                _check_rate_limit(guild_id, error)
+                _set_result(item.future, error=error)
+            else:
+                _set_result(item.future)
+            OUTBOUND_COUNTS['timeouts'] += 1
+    finally:
+        guild_queue.workers -= 1
+        if guild_queue.workers == 0:
+            del GUILD_QUEUES[guild_id]
+
+
+async def _process_channel(channel: discord.abc.Messageable, channel_queue: ChannelQueue) -> None:
+    """Sends the queued messages and reactions of a channel until the queue is empty"""
+    while channel_queue.messages or channel_queue.reactions:
+        await _wait_for_rate_limit(channel_queue.guild_id)
+        if channel_queue.messages:
+            items = [item for item in channel_queue.messages if not item.future.done()]
+            channel_queue.messages.clear()
+            for batch in _batch_messages(items):
+                await _send_batch(channel, channel_queue.guild_id, batch)
+        else:
+            item = channel_queue.reactions.popleft()
+            if item.future.done():
+                continue
+            metrics.observe('outbound.reaction_wait', time.perf_counter() - item.queued_at)
+            message, emoji = item.payload
+            try:
+                await message.add_reaction(emoji)
+            except Exception as error:
+                _check_rate_limit(channel_queue.guild_id, error)
+                _set_result(item.future, error=error)
+            else:
+                _set_result(item.future)
+            OUTBOUND_COUNTS['reactions'] += 1
+    del CHANNEL_QUEUES[channel.id]
+
+
+def _batch_messages(items: List[OutboundItem]) -> List[List[OutboundItem]]:
+    """Splits queued messages into batches that fit into one Discord message"""
+    batches = []
+    batch = []
+    batch_length = 0
+    for item in items:
+        item_length = len(item.payload) + (len(MESSAGE_SEPARATOR) if batch else 0)
+        if batch and batch_length + item_length > MESSAGE_MAX_LENGTH:
+            batches.append(batch)
+            batch = []
+            batch_length = 0
+            item_length = len(item.payload)
+        batch.append(item)
+        batch_length += item_length
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+async def _send_batch(channel: discord.abc.Messageable, guild_id: Optional[int], batch: List[OutboundItem]) -> None:
+    """Sends a batch of queued messages as one message"""
+    now = time.perf_counter()
+    for item in batch:
+        metrics.observe('outbound.send_wait', now - item.queued_at)
+    try:
+        message = await channel.send(MESSAGE_SEPARATOR.join(item.payload for item in batch))
+    except Exception as error:
+        _check_rate_limit(guild_id, error)
+        for item in batch:
+            _set_result(item.future, error=error)
+    else:
+        for item in batch:
+            _set_result(item.future, message)
+    OUTBOUND_COUNTS['messages sent'] += 1
+    OUTBOUND_COUNTS['messages merged'] += len(batch) - 1
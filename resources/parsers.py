@@ -0,0 +1,56 @@
+# parsers.py
+"""Contains the parsers for EPIC RPG embeds"""
+
+import re
+from typing import NamedTuple, Optional
+
+import discord
+
+from resources import exceptions, settings
+
+
+REGEX_ENCHANT_ACTION = re.compile(r'enchant|refine|transmute|transcend', re.IGNORECASE)
+REGEX_ENCHANT = re.compile(r'~-~> \*\*(.+?)\*\* <~-~')
+REGEX_USER_ID_FROM_AVATAR = re.compile(r'avatars/(\d+)/')
+REGEX_USER_NAME_FROM_AUTHOR = re.compile(r'^(.+?) —') # All languages
+
+
+class EnchantResult(NamedTuple):
+    enchant: str # Enchant name as shown in the embed
+    enchant_index: int # Index in settings.ENCHANTS
+    user_id: Optional[int] # None if the user has no custom avatar
+    user_name: Optional[str] # Only read if user_id is None, None if it could not be read
+
+
+def parse_enchant(author_name: str, icon_url: str, field_name: str) -> Optional[EnchantResult]:
+    """Parses the parts of an embed that are relevant for enchants.
+    Returns None if the embed is not an enchant result.
+
+    Raises
+    ------
+    exceptions.NoDataFoundError if the embed is an enchant result but the enchant is unknown.
+    """
+    if '~-~>' not in field_name:
+        return None
+    if REGEX_ENCHANT_ACTION.search(author_name) is None:
+        return None
+    enchant_match = REGEX_ENCHANT.search(field_name)
+    if enchant_match is None:
+        return None
+    enchant = enchant_match.group(1)
+    enchant_index = settings.ENCHANT_INDEXES.get(enchant.lower())
+    if enchant_index is None:
+        raise exceptions.NoDataFoundError(f'Unknown enchant in enchant message: {enchant}')
+    user_id_match = REGEX_USER_ID_FROM_AVATAR.search(icon_url)
+    if user_id_match is not None:
+        return EnchantResult(enchant, enchant_index, int(user_id_match.group(1)), None)
+    user_name_match = REGEX_USER_NAME_FROM_AUTHOR.search(author_name)
+    user_name = user_name_match.group(1) if user_name_match is not None else None
+    return EnchantResult(enchant, enchant_index, None, user_name)
+
+
+def parse_enchant_embed(embed: discord.Embed) -> Optional[EnchantResult]:
+    """Parses an EPIC RPG embed, see parse_enchant(). Returns None if the embed is not an enchant result."""
+    if not embed.fields:
+        return None
+    return parse_enchant(str(embed.author.name), str(embed.author.icon_url), str(embed.fields[0].name))
@@ -0,0 +1,88 @@
+# permissions.py
+"""Contains the cache of the bot's own channel permissions.
+
+Entries are dropped by the listeners in cogs/enchant_mute.py whenever roles, channels, the guild or the bot's own
+member change. Invalidating a whole guild only bumps its generation, stale entries are replaced on the next lookup.
+"""
+
+from typing import Dict, Union
+
+import discord
+
+from resources import caches, metrics, settings
+
+
+# (guild id, channel id): (guild generation, permissions)
+PERMISSION_CACHE = caches.LRUCache(
+    'channel_permissions', maxsize=settings.PERMISSION_CACHE_SIZE, ttl=settings.PERMISSION_CACHE_TTL
+)
+
+# Guild id: generation, increased whenever all channel permissions of the guild become invalid
+_guild_generations: Dict[int, int] = {}
+
+TIMEOUTS_SKIPPED = metrics.counters(
+    'timeouts_skipped', ('missing permission', 'owner', 'administrator', 'role hierarchy')
+)
+
+ChannelType = Union[discord.abc.GuildChannel, discord.Thread]
+
+
+def _get_key(channel: ChannelType) -> tuple:
+    """Threads use the permissions of their parent channel"""
+    channel_id = channel.parent_id if isinstance(channel, discord.Thread) else channel.id
+    return (channel.guild.id, channel_id)
+
+
+# --- Lookups ---
+def get_channel_permissions(channel: ChannelType) -> discord.Permissions:
+    """Returns the permissions the bot has in a channel.
+    If the bot member is not cached, all permissions are returned (and not cached) so nothing is skipped.
+    """
+    me = channel.guild.me
+    if me is None:
+        return discord.Permissions.all()
+    key = _get_key(channel)
+    generation = _guild_generations.get(channel.guild.id, 0)
+    cached = PERMISSION_CACHE.get(key)
+    if cached is not None and cached[0] == generation:
+        return cached[1]
+    channel_permissions = channel.permissions_for(me)
+    PERMISSION_CACHE.set(key, (generation, channel_permissions))
+    return channel_permissions
+
+
+def can_timeout(member: discord.Member, channel: ChannelType) -> bool:
+    """Checks if a timeout of this member can succeed, so doomed API calls can be skipped.
+    Returns True if this can't be determined.
+    """
+    guild = member.guild
+    me = guild.me
+    if me is None:
+        return True
+    if not get_channel_permissions(channel).moderate_members:
+        TIMEOUTS_SKIPPED['missing permission'] += 1
+        return False
+    if member.id == guild.owner_id:
+        TIMEOUTS_SKIPPED['owner'] += 1
+        return False
+    if member.guild_permissions.administrator:
+        TIMEOUTS_SKIPPED['administrator'] += 1
+        return False
+    if member.top_role >= me.top_role:
+        TIMEOUTS_SKIPPED['role hierarchy'] += 1
+        return False
+    return True
+
+
+# --- Invalidation ---
+def invalidate_channel(channel: ChannelType) -> None:
+    """Drops the cached permissions of a channel. Categories invalidate the whole guild."""
+    if isinstance(channel, discord.CategoryChannel):
+        invalidate_guild(channel.guild)
+    else:
+        PERMISSION_CACHE.pop(_get_key(channel))
+
+
+def invalidate_guild(guild: discord.Guild) -> None:
+    """Drops the cached permissions of all channels of a guild"""
+    _guild_generations[guild.id] = _guild_generations.get(guild.id, 0) + 1
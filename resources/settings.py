@@ -10,10 +10,40 @@ load_dotenv()
 TOKEN = os.getenv('DISCORD_TOKEN')
 DEBUG_MODE = os.getenv('DEBUG_MODE')
 
+# Sharding, see launcher.py. SHARD_COUNT and SHARD_IDS are set by the launcher for each process.
+SHARDING = os.getenv('SHARDING', 'OFF')
+SHARD_COUNT = int(os.getenv('SHARD_COUNT')) if os.getenv('SHARD_COUNT') else None
+SHARD_IDS = [int(shard_id) for shard_id in os.getenv('SHARD_IDS').split(',')] if os.getenv('SHARD_IDS') else None
+CLUSTER_ID = os.getenv('CLUSTER_ID')
+
+# Low memory mode: no member cache and no chunking, members are fetched or queried when needed
+LOW_MEMORY_MODE = os.getenv('LOW_MEMORY_MODE', 'OFF')
+
+# User store: all user settings are loaded into memory at startup and get_user never reads from the database,
+# see resources/user_store.py
+USER_STORE = os.getenv('USER_STORE', 'OFF')
+
+# Event loop: uvloop is used instead of the asyncio event loop if it is installed, see resources/loop_monitor.py for
+# the debug mode
+USE_UVLOOP = os.getenv('USE_UVLOOP', 'OFF')
+LOOP_DEBUG = os.getenv('LOOP_DEBUG', 'OFF')
+
+# Overrides for benchmarks/load_test.py, which runs the bot against a local mock of Discord and a temporary database
+DISCORD_API_URL = os.getenv('DISCORD_API_URL')
+
 BOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-DB_FILE = os.path.join(BOT_DIR, 'database/archmage_db.db')
+DB_FILE = os.getenv('DB_FILE') or os.path.join(BOT_DIR, 'database/archmage_db.db')
+USER_STORE_FILE = os.path.join(os.path.dirname(DB_FILE), 'user_store.bin')
+# Every cluster of launcher.py has its own warm state
+WARM_STATE_FILE = os.path.join(
+    os.path.dirname(DB_FILE), 'warm_state.pickle' if CLUSTER_ID is None else f'warm_state_{CLUSTER_ID}.pickle'
+)
+ERROR_ARCHIVE_DIR = os.path.join(os.path.dirname(DB_FILE), 'archive')
 LOG_FILE = os.path.join(BOT_DIR, 'logs/discord.log')
 
+LOG_QUEUE_SIZE = 10_000 # Maximum amount of log records waiting to be written, new records are dropped if it is full
+LOG_DEBUG_SAMPLE_RATE = 1.0 # Share of DEBUG records that is logged, e.g. 0.1 to log about every tenth record
+
 DEV_GUILDS = [730115558766411857,] # Change to your own dev guild id(s)
 OWNER_ID = 619879176316649482 # Change to your own user id
 
@@ -23,6 +53,45 @@ EMBED_COLOR = 0xDD9624
 
 DEFAULT_FOOTER = 'You look simply enchanting today.'
 
+USER_CACHE_SIZE = 10_000 # Maximum amount of user settings kept in memory
+USER_CACHE_TTL = 3_600 # Seconds until cached user settings are read from the database again
+USER_WRITE_BATCH_SIZE = 100 # Queued user updates that trigger an immediate write
+USER_WRITE_INTERVAL = 5 # Seconds queued user updates wait at most before they are written
+DB_CHANGE_CHECK_INTERVAL = 2 # Seconds between checks for database changes by other processes, see launcher.py
+DB_BUSY_TIMEOUT = 10 # Seconds a query waits for a lock held by another process
+DB_SYNCHRONOUS = 'NORMAL' # SQLite synchronous level. NORMAL can lose the last commits on power loss, but never corrupts the database in WAL mode
+DB_CACHE_SIZE = 16_384 # KiB of page cache
+DB_MMAP_SIZE = 268_435_456 # Bytes of the database file that are memory-mapped
+ERROR_FLUSH_INTERVAL = 30 # Seconds errors are collected and collapsed before they are written
+ERROR_BUFFER_SIZE = 500 # Maximum amount of different errors collected until the next write, the oldest is dropped
+ERROR_RATE_LIMIT = 10 # Maximum amount of records written per hour for the same error
+ERROR_RETENTION_DAYS = 30 # Errors older than this are moved from the database to ERROR_ARCHIVE_DIR by the maintenance
+MAINTENANCE_INTERVAL = 86_400 # Seconds between database maintenance runs, see database.run_maintenance()
+MAINTENANCE_CHECK_INTERVAL = 3_600 # Seconds between checks whether the database maintenance is due
+MAINTENANCE_BATCH_SIZE = 250 # Errors archived and deleted per transaction during the maintenance
+VACUUM_STEP_PAGES = 256 # Free database pages released per step of the incremental vacuum
+MEMBER_CACHE_SIZE = 5_000 # Maximum amount of members fetched from the API that are kept in memory
+MEMBER_CACHE_TTL = 300 # Seconds until members fetched from the API are fetched again
+INTERACTION_USER_CACHE_SIZE = 20_000 # Maximum amount of slash command messages whose user is kept in memory
+INTERACTION_USER_CACHE_TTL = 900 # Seconds the user of a slash command message is kept in memory
+SEEN_ENCHANTS_SIZE = 10_000 # Maximum amount of handled enchant results that are remembered to drop duplicate events
+SEEN_ENCHANTS_TTL = 300 # Seconds a handled enchant result is remembered
+PERMISSION_CACHE_SIZE = 50_000 # Maximum amount of channels whose permissions of the bot are kept in memory
+PERMISSION_CACHE_TTL = 3_600 # Seconds until cached channel permissions are calculated again, events invalidate them earlier
+
+LOOP_LAG_INTERVAL = 0.1 # Seconds between event loop lag measurements, see resources/loop_monitor.py
+SLOW_CALLBACK_DURATION = 0.1 # Seconds the event loop can be blocked before the blocking call is logged
+
+STATS_FLUSH_INTERVAL = 60 # Seconds stats are counted in memory before they are written, see resources/stats.py
+OUTBOUND_GUILD_CONCURRENCY = 4 # Timeouts sent at the same time per guild, see resources/outbound.py
+
+METRICS_FILE = None # Set to a file path to write all metrics in the Prometheus text format, e.g. os.path.join(BOT_DIR, 'logs/metrics.prom')
+METRICS_INTERVAL = 60 # Seconds between writes of METRICS_FILE
+PROFILE_MAX_SECONDS = 120 # Longest capture /dev profile allows
+PROFILE_TOP_FUNCTIONS = 40 # Functions listed in the report of /dev profile
+MEMORY_TRACE_SECONDS = 30 # Seconds /dev memory traces allocations for if tracemalloc isn't running already
+MEMORY_TOP_ALLOCATIONS = 25 # Source lines listed in the report of /dev memory
+
 ENCHANTS = (
     'Good',
     'Great',
@@ -38,4 +107,8 @@ ENCHANTS = (
     'GODLY',
     'VOID',
     'None',
-)
\ No newline at end of file
+)
+
+# Lowercase enchant name: index in ENCHANTS
+ENCHANT_INDEXES = {enchant.lower(): index for index, enchant in enumerate(ENCHANTS)}
+ENCHANT_INDEX_NONE = ENCHANT_INDEXES['none']
@@ -0,0 +1,58 @@
+# single_flight.py
+"""Contains the single flight groups that let concurrent handlers share one call instead of each making their own"""
+
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, Hashable
+
+from resources import metrics
+
+
+SINGLE_FLIGHTS: Dict[str, 'SingleFlight'] = {}
+
+# Calls that joined a running call of their group instead of making their own, per group.
+# 'superseded enchants' counts enchants that lost their mute decision to a newer enchant of the same user.
+CONTENTION = metrics.counters('contention', ('member fetches', 'member queries', 'user settings', 'superseded enchants'))
+
+
+class SingleFlight:
+    """Runs at most one call per key at a time. Callers with a key that is already running wait for that call and
+    get its result or exception.
+
+    Arguments
+    ---------
+    name: Name the group is registered under in SINGLE_FLIGHTS and counted under in CONTENTION.
+    """
+    def __init__(self, name: str):
+        self.name = name
+        self._calls: Dict[Hashable, asyncio.Future] = {}
+        SINGLE_FLIGHTS[name] = self
+
+    def __len__(self) -> int:
+        return len(self._calls)
+
+    async def run(self, key: Hashable, function: Callable[..., Awaitable[Any]], *args: Any) -> Any:
+        """Returns the result of function(*args), or of the call with the same key that is already running"""
+        future = self._calls.get(key)
+        if future is not None:
+            CONTENTION[self.name] += 1
+            # Shielded, so a waiter that is cancelled doesn't cancel the call for everyone else
+            return await asyncio.shield(future)
+        future = self._calls[key] = asyncio.get_running_loop().create_future()
+        try:
+            result = await function(*args)
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except BaseException as error:
+            future.set_exception(error)
+            # Marks the exception as retrieved in case nobody else waited for it
+            future.exception()
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            del self._calls[key]
+
+
+metrics.gauges('in_flight', lambda: {name: len(group) for name, group in SINGLE_FLIGHTS.items()})
@@ -0,0 +1,111 @@
+# stats.py
+"""Contains the bot statistics: enchants per tier, mutes and mute failures per guild and overall, and the user count.
+
+Counters are increased in memory and written to the stats table every STATS_FLUSH_INTERVAL seconds by flush().
+Reads are served from memory. They reread the overall stats from the database at most every STATS_FLUSH_INTERVAL
+seconds, so the user count (kept up to date by triggers on settings_user) and the stats of other processes
+(see launcher.py) show up as well.
+"""
+
+import asyncio
+from collections import Counter
+import sqlite3
+import time
+from typing import Dict, Optional
+
+import database
+from resources import settings
+
+
+# Guild id of the overall stats
+TOTAL = 0
+
+STAT_USERS = 'users'
+STAT_MUTES = 'mutes'
+STAT_MUTE_FAILURES = 'mute failures'
+
+# Stats as last read from the database, guild id: Counter
+_totals: Dict[int, Counter] = {}
+# Increases that are not written yet, guild id: Counter
+_pending: Dict[int, Counter] = {}
+_loaded = False
+_refreshed_at = 0.0
+_flush_handle: Optional[asyncio.TimerHandle] = None
+
+
+def get_enchant_stat(enchant_index: int) -> str:
+    """Returns the stat name of an enchant tier"""
+    return f'enchant {settings.ENCHANTS[enchant_index]}'
+
+
+def increase(guild_id: int, stat: str, count: int = 1) -> None:
+    """Increases a stat of a guild and the overall stat"""
+    for stats_guild_id in (guild_id, TOTAL):
+        guild_pending = _pending.get(stats_guild_id)
+        if guild_pending is None:
+            guild_pending = _pending[stats_guild_id] = Counter()
+        guild_pending[stat] += count
+    _schedule_flush()
+
+
+async def get_stats(guild_id: int = TOTAL) -> Counter:
+    """Returns the stats of a guild or, by default, the overall stats.
+
+    Raises
+    ------
+    sqlite3.Error if the stats have to be read and something happened within the database.
+    Also logs this error to the database.
+    """
+    global _loaded, _totals, _refreshed_at
+    if not _loaded:
+        _totals = {stats_guild_id: Counter(guild_stats) for stats_guild_id, guild_stats in
+                   (await database.get_stats()).items()}
+        _loaded = True
+        _refreshed_at = time.monotonic()
+    elif time.monotonic() - _refreshed_at >= settings.STATS_FLUSH_INTERVAL:
+        await flush()
+    return _totals.get(guild_id, Counter()) + _pending.get(guild_id, Counter())
+
+
+async def flush() -> None:
+    """Writes all pending increases to the database and rereads the overall stats.
+
+    Raises
+    ------
+    sqlite3.Error if something happened within the database. The increases stay pending in that case.
+    Also logs this error to the database.
+    """
+    global _flush_handle, _pending, _refreshed_at
+    if _flush_handle is not None:
+        _flush_handle.cancel()
+        _flush_handle = None
+    pending = _pending
+    _pending = {}
+    try:
+        updated_stats = await database.add_stats({guild_id: dict(stats) for guild_id, stats in pending.items()})
+    except sqlite3.Error:
+        for guild_id, stats in pending.items():
+            _pending.setdefault(guild_id, Counter()).update(stats)
+        _schedule_flush()
+        raise
+    _refreshed_at = time.monotonic()
+    if _loaded:
+        for guild_id, guild_stats in updated_stats.items():
+            _totals[guild_id] = Counter(guild_stats)
+
+
+async def _flush_in_background() -> None:
+    """Runs flush() from the flush timer. Errors are already logged there."""
+    try:
+        await flush()
+    except sqlite3.Error:
+        pass
+
+
+def _schedule_flush() -> None:
+    """Makes sure pending increases are written after STATS_FLUSH_INTERVAL seconds at the latest"""
+    global _flush_handle
+    if _flush_handle is None:
+        _flush_handle = asyncio.get_running_loop().call_later(
+            settings.STATS_FLUSH_INTERVAL, lambda: asyncio.ensure_future(_flush_in_background())
+        )
@@ -0,0 +1,127 @@
+# user_store.py
+"""Contains the compact in-memory store of all user settings, see USER_STORE in settings.py.
+
+User ids are kept in a sorted array of unsigned 64 bit ints, the target enchants in a byte array in the same order.
+That is 9 bytes per user. Users that are added after loading go into an overflow dict until the next snapshot merges
+them into the arrays.
+A snapshot file contains both arrays after a small header. It is memory-mapped when loaded, so loading doesn't copy
+or parse anything.
+"""
+
+from array import array
+from bisect import bisect_left
+import heapq
+import mmap
+import os
+import struct
+from typing import Dict, Iterable, Iterator, Optional, Tuple
+
+
+SNAPSHOT_MAGIC = b'ARCHUSR1'
+# Magic, user count, size and modification time (ns) of the database file the snapshot belongs to.
+# The header size is a multiple of 8, so the id array that follows is aligned.
+SNAPSHOT_HEADER = struct.Struct('<8sQqq')
+
+
+class UserStore:
+    """Compact store of user_id: target_enchant.
+
+    Arguments
+    ---------
+    ids: Sorted user ids, an array('Q') or a memoryview with format 'Q'.
+    enchants: Target enchants in the order of ids, an array('b') or a writable memoryview with format 'b'.
+    snapshot: The memory map ids and enchants point into, if they were loaded from a snapshot.
+    """
+    def __init__(self, ids, enchants, snapshot: Optional[mmap.mmap] = None):
+        self.ids = ids
+        self.enchants = enchants
+        self.overflow: Dict[int, int] = {}
+        self._snapshot = snapshot
+
+    def __len__(self) -> int:
+        return len(self.ids) + len(self.overflow)
+
+    def get(self, user_id: int) -> Optional[int]:
+        """Returns the target enchant of a user or None if the user is unknown"""
+        target_enchant = self.overflow.get(user_id)
+        if target_enchant is not None:
+            return target_enchant
+        index = bisect_left(self.ids, user_id)
+        if index < len(self.ids) and self.ids[index] == user_id:
+            return self.enchants[index]
+        return None
+
+    def set(self, user_id: int, target_enchant: int) -> None:
+        """Adds or changes a user. Known users are changed in place, new users go into the overflow."""
+        index = bisect_left(self.ids, user_id)
+        if index < len(self.ids) and self.ids[index] == user_id:
+            self.enchants[index] = target_enchant
+        else:
+            self.overflow[user_id] = target_enchant
+
+    def items(self) -> Iterator[Tuple[int, int]]:
+        """Yields (user_id, target_enchant) of all users, sorted by user id"""
+        return heapq.merge(zip(self.ids, self.enchants), sorted(self.overflow.items()))
+
+    @property
+    def nbytes(self) -> int:
+        """Bytes used by the arrays, not counting the overflow"""
+        return len(self.ids) * 8 + len(self.enchants)
+
+    @classmethod
+    def from_records(cls, records: Iterable[Tuple[int, int]]) -> 'UserStore':
+        """Builds a store from (user_id, target_enchant) records sorted by user id"""
+        ids = array('Q')
+        enchants = array('b')
+        for user_id, target_enchant in records:
+            ids.append(user_id)
+            enchants.append(target_enchant)
+        return cls(ids, enchants)
+
+    # --- Snapshots ---
+    def save(self, file_name: str, database_stat: Tuple[int, int]) -> None:
+        """Writes a snapshot. The file is replaced atomically.
+
+        Arguments
+        ---------
+        file_name: Path of the snapshot file.
+        database_stat: (size, modification time in ns) of the database file after its last write.
+        """
+        if self.overflow:
+            merged = UserStore.from_records(self.items())
+            ids, enchants = merged.ids, merged.enchants
+        else:
+            ids, enchants = self.ids, self.enchants
+        temp_file_name = f'{file_name}.tmp'
+        with open(temp_file_name, 'wb') as snapshot_file:
+            snapshot_file.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, len(ids), *database_stat))
+            snapshot_file.write(ids)
+            snapshot_file.write(enchants)
+        os.replace(temp_file_name, file_name)
+
+    @classmethod
+    def load(cls, file_name: str, database_stat: Tuple[int, int]) -> Optional['UserStore']:
+        """Memory-maps a snapshot. Changes to the store are copy-on-write and never written back to the file.
+
+        Returns
+        -------
+        The store or None if there is no valid snapshot for this database_stat.
+        """
+        try:
+            with open(file_name, 'rb') as snapshot_file:
+                snapshot = mmap.mmap(snapshot_file.fileno(), 0, access=mmap.ACCESS_COPY)
+        except (OSError, ValueError):
+            return None
+        if len(snapshot) < SNAPSHOT_HEADER.size:
+            snapshot.close()
+            return None
+        magic, user_count, *snapshot_database_stat = SNAPSHOT_HEADER.unpack_from(snapshot)
+        ids_end = SNAPSHOT_HEADER.size + user_count * 8
+        if (magic != SNAPSHOT_MAGIC or tuple(snapshot_database_stat) != tuple(database_stat)
+                or len(snapshot) != ids_end + user_count):
+            snapshot.close()
+            return None
+        view = memoryview(snapshot)
+        ids = view[SNAPSHOT_HEADER.size:ids_end].cast('Q')
+        enchants = view[ids_end:].cast('b')
+        return cls(ids, enchants, snapshot)
@@ -0,0 +1,90 @@
+# warm_state.py
+"""Contains saving and restoring the warm state, the caches a restart would otherwise have to fill again.
+
+The state is saved to WARM_STATE_FILE (one per cluster of launcher.py) when the bot is closed and restored (and deleted) on the next start:
+- the caches in WARM_CACHES, with their remaining time to live
+- the member name index, see members.restore_name_index()
+Caches in DATABASE_CACHES are only restored if the database file didn't change in between.
+"""
+
+import os
+import pickle
+import time
+from typing import Optional, Tuple
+
+from resources import caches, logs, members
+
+
+WARM_STATE_VERSION = 1
+
+WARM_CACHES = ('user_settings', 'interaction_users', 'seen_enchants')
+DATABASE_CACHES = ('user_settings',)
+
+
+def save(file_name: str, database_stat: Optional[Tuple[int, int]]) -> None:
+    """Writes the warm state. The file is replaced atomically.
+
+    Arguments
+    ---------
+    file_name: Path of the warm state file.
+    database_stat: (size, modification time in ns) of the database file after its last write, see
+    database.get_database_stat(). If None, DATABASE_CACHES are not saved.
+    """
+    state = {
+        'version': WARM_STATE_VERSION,
+        'saved_at': time.time(),
+        'database_stat': database_stat,
+        'caches': {
+            name: caches.CACHES[name].export() for name in WARM_CACHES
+            if name in caches.CACHES and (database_stat is not None or name not in DATABASE_CACHES)
+        },
+        'member_name_index': members.MEMBER_NAME_INDEX,
+    }
+    temp_file_name = f'{file_name}.tmp'
+    with open(temp_file_name, 'wb') as state_file:
+        pickle.dump(state, state_file, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(temp_file_name, file_name)
+
+
+def restore(file_name: str, database_stat: Optional[Tuple[int, int]]) -> bool:
+    """Restores the warm state if there is one and deletes the file, so it is never restored twice.
+    Call this after all cogs are loaded, as some caches are created by them. A state that can't be read or restored,
+    e.g. one of an older version of the bot, is logged and skipped, it never stops the start.
+
+    Returns
+    -------
+    True if a warm state was restored.
+    """
+    try:
+        with open(file_name, 'rb') as state_file:
+            state = pickle.load(state_file)
+    except FileNotFoundError:
+        return False
+    except Exception as error:
+        logs.logger.error(f'Error reading the warm state: {error!r}')
+        state = None
+    finally:
+        try:
+            os.remove(file_name)
+        except FileNotFoundError:
+            pass
+    if not isinstance(state, dict) or state.get('version') != WARM_STATE_VERSION:
+        return False
+    try:
+        elapsed = max(time.time() - state['saved_at'], 0)
+        database_unchanged = database_stat is not None and state['database_stat'] == database_stat
+        for name, entries in state['caches'].items():
+            cache = caches.CACHES.get(name)
+            if cache is None or (name in DATABASE_CACHES and not database_unchanged):
+                continue
+            cache.restore(entries, elapsed)
+        members.restore_name_index(state['member_name_index'])
+    except Exception as error:
+        logs.logger.error(f'Error restoring the warm state: {error!r}')
+        return False
+    logs.logger.info(
+        f'Restored the warm state saved {elapsed:,.1f} seconds ago: '
+        f'{", ".join(f"{len(caches.CACHES[name]):,} {name}" for name in state["caches"] if name in caches.CACHES)}, '
+        f'{len(state["member_name_index"]):,} member name indexes'
+    )
+    return True